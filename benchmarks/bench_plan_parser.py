@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: regex template matching vs the indexed plan parser on a
+synthetic plan of roughly 50k lines.
+
+    python benchmarks/bench_plan_parser.py [--lines 50000] [--repeat 5]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+
+from plan_parser import COMPUTED, parse_plan, template_to_re  # noqa: E402
+
+HEADER_ATTRIBUTES = (
+    ('action', '"set"'),
+    ('cache_condition', '""'),
+    ('destination', '"http.X-Header-{n}"'),
+    ('ignore_if_set', '"false"'),
+    ('name', '"header {n}"'),
+    ('priority', '"100"'),
+    ('regex', '<computed>'),
+    ('request_condition', '""'),
+    ('response_condition', '""'),
+    ('source', '"\\"value {n}\\""'),
+    ('substitution', '<computed>'),
+    ('type', '"cache"'),
+)
+
+# the element the assertions look for is placed last, so both approaches
+# have to get through the whole plan
+TEMPLATE = """
+      header.{ident}.action:             "delete"
+      header.{ident}.cache_condition:    ""
+      header.{ident}.destination:        "http.X-Powered-By"
+      header.{ident}.ignore_if_set:      "false"
+      header.{ident}.name:               "Remove X-Powered-By header"
+      header.{ident}.priority:           "100"
+      header.{ident}.regex:              <computed>
+      header.{ident}.request_condition:  ""
+      header.{ident}.response_condition: ""
+      header.{ident}.source:             <computed>
+      header.{ident}.substitution:       <computed>
+      header.{ident}.type:               "cache"
+""".strip()
+
+
+def synthetic_plan(lines):
+    out = [
+        'Terraform will perform the following actions:',
+        '',
+        '  + module.fastly.fastly_service_v1.fastly',
+        '      id:                                 <computed>',
+    ]
+    n = 0
+    while len(out) < lines:
+        ident = 1000000 + n
+        for attribute, value in HEADER_ATTRIBUTES:
+            out.append('      header.{}.{}:{}{}'.format(
+                ident, attribute, ' ' * 8, value.format(n=n)
+            ))
+        n += 1
+    out.extend(
+        '      ' + line.strip().replace('{ident}', '42')
+        for line in TEMPLATE.splitlines()
+    )
+    out.extend(['', '', 'Plan: 1 to add, 0 to change, 0 to destroy.'])
+    return '\n'.join(out) + '\n'
+
+
+def regex_search(output):
+    # what the tests used to do: rebuild the pattern and scan the whole plan
+    return re.search(template_to_re.__wrapped__(TEMPLATE), output)
+
+
+def index_lookup(output):
+    parse_plan.cache_clear()
+    return parse_plan(output).has_block(
+        'header',
+        action='delete',
+        destination='http.X-Powered-By',
+        source=COMPUTED,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    output = synthetic_plan(args.lines)
+    assert regex_search(output) and index_lookup(output)
+    plan = parse_plan(output)
+
+    print('plan: {} lines, {} bytes'.format(
+        output.count('\n'), len(output)
+    ))
+    for name, fn in (
+        ('regex search (per assertion)', lambda: regex_search(output)),
+        ('parse + lookup (first assertion)', lambda: index_lookup(output)),
+        ('lookup on parsed plan (each further assertion)', lambda: (
+            plan.has_block(
+                'header', action='delete', destination='http.X-Powered-By'
+            )
+        )),
+    ):
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print('{:<48} {:>10.3f} ms'.format(name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Throughput of the offline VCL engine on the default rendered custom.vcl, with
+a Zipf-like URL popularity and a mix of methods and origin behaviours.
+
+    python benchmarks/bench_vcl_engine.py [--requests 100000] [--urls 5000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tools.vcl_engine import Engine, Program, Request, Response  # noqa: E402
+from tools.vcl_template import dictionaries, render  # noqa: E402
+
+
+def origin(bereq):
+    if bereq.url.startswith('/account'):
+        return Response(200, {'Set-Cookie': 'session=1'}, body_size=2000)
+    if bereq.url.startswith('/private'):
+        return Response(200, {'Cache-Control': 'private'}, body_size=2000)
+    return Response(
+        200, {'Cache-Control': 'max-age=300'}, body_size=20000
+    )
+
+
+def workload(requests, urls, seed):
+    rng = random.Random(seed)
+    paths = ['/page/{}'.format(i) for i in range(urls)]
+    paths[::50] = ['/account/{}'.format(i) for i in range(0, urls, 50)]
+    paths[::77] = ['/private/{}'.format(i) for i in range(0, urls, 77)]
+    weights = [1.0 / (rank + 1) for rank in range(urls)]
+    chosen = rng.choices(paths, weights, k=requests)
+    return [
+        Request(
+            'POST' if i % 100 == 0 else 'GET', path, {'Host': 'example.com'}
+        )
+        for i, path in enumerate(chosen)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--urls', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    program = Program(render())
+    compiled = time.perf_counter() - started
+
+    requests = workload(args.requests, args.urls, args.seed)
+    engine = Engine(program, origin, tables=dictionaries())
+    started = time.perf_counter()
+    for i, request in enumerate(requests):
+        engine.handle(request, now=i * 0.01)
+    elapsed = time.perf_counter() - started
+
+    print('compile: {:.1f} ms'.format(compiled * 1000))
+    print('{} requests in {:.2f} s: {:,.0f} requests/s'.format(
+        args.requests, elapsed, args.requests / elapsed
+    ))
+    print('hit ratio {:.1%}, origin fetches {}'.format(
+        engine.hit_ratio(), engine.stats['origin_fetches']
+    ))
+
+
+if __name__ == '__main__':
+    main()
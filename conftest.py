@@ -0,0 +1,2 @@
+# Lives at the repository root so that pytest puts the root on sys.path and
+# the tests can import the `tools` package.
@@ -8,6 +8,225 @@ module "secretsmanager" {
 
 locals {
   full_domain_name = "${var.env == "live" ? "" : format("%s-", var.env)}${var.domain_name}"
+
+  # regexes for custom.vcl - "(?!)" never matches, for empty lists
+  static_extensions    = "${length(var.static_extensions) > 0 ? format("(?i)^(%s)$", join("|", var.static_extensions)) : "(?!)"}"
+  static_path_patterns = "${length(var.static_path_patterns) > 0 ? join("|", var.static_path_patterns) : "(?!)"}"
+  preserve_cookies     = "${length(var.preserve_cookies) > 0 ? join("|", var.preserve_cookies) : "(?!)"}"
+
+  # var.backends, or a single backend for backend_address - the backend
+  # blocks index into this, so the default is appended rather than chosen
+  backends = "${concat(var.backends, list(map("address", var.backend_address)))}"
+
+  # collapse Accept-Encoding to the one encoding that will be used, so each
+  # object has at most one compressed variant in cache
+  accept_encoding_gzip = <<EOF
+if (req.http.Accept-Encoding) {
+    if (req.http.Accept-Encoding ~ "gzip") {
+      set req.http.Accept-Encoding = "gzip";
+    } else {
+      unset req.http.Accept-Encoding;
+    }
+  }
+EOF
+
+  accept_encoding_brotli = <<EOF
+if (req.http.Accept-Encoding) {
+    if (req.http.Accept-Encoding ~ "br") {
+      set req.http.Accept-Encoding = "br";
+    } elsif (req.http.Accept-Encoding ~ "gzip") {
+      set req.http.Accept-Encoding = "gzip";
+    } else {
+      unset req.http.Accept-Encoding;
+    }
+  }
+EOF
+
+  accept_encoding = "${var.prefer_brotli == "true" ? local.accept_encoding_brotli : local.accept_encoding_gzip}"
+
+  # keeps the query string of a redirected request, appending it to any in
+  # the target
+  redirect_querystring = <<EOF
+if (req.url.qs != "") {
+      if (req.http.X-Redirect-Location ~ "\?") {
+        set req.http.X-Redirect-Location = req.http.X-Redirect-Location "&" req.url.qs;
+      } else {
+        set req.http.X-Redirect-Location = req.http.X-Redirect-Location "?" req.url.qs;
+      }
+    }
+EOF
+
+  redirect_responses = {
+    "301" = "Moved Permanently"
+    "302" = "Found"
+    "307" = "Temporary Redirect"
+    "308" = "Permanent Redirect"
+  }
+
+  # a backend declared in the custom VCL rather than in the service, for
+  # the data.template_file.*_backend data sources in templates.tf
+  vcl_backend = <<EOF
+backend $${name} {
+  .host = "$${address}";
+  .port = "$${port}";
+  .ssl = true;
+  .ssl_cert_hostname = "$${hostname}";
+  .ssl_sni_hostname = "$${hostname}";
+  .ssl_check_cert = $${check_cert};
+  .connect_timeout = ${var.connect_timeout}ms;
+  .first_byte_timeout = ${var.first_byte_timeout}ms;
+  .between_bytes_timeout = ${var.between_bytes_timeout}ms;$${probe}
+}
+EOF
+
+  # health checks take unhealthy origins out of the director - a format()
+  # string for the path and Host header of each origin's .probe
+  vcl_probe = "\n  .probe = {\n    .request = \"HEAD %s HTTP/1.1\" \"Host: %s\" \"Connection: close\";\n    .expected_response = 200;\n    .interval = ${var.healthcheck_interval}ms;\n    .timeout = ${var.healthcheck_timeout}ms;\n    .window = 5;\n    .threshold = 3;\n    .initial = 2;\n  }"
+
+  # failed GET and HEAD requests are restarted against the fallback origin
+  fallback_backend = <<EOF
+if (req.restarts > 0) {
+    set req.backend = fallback_backend;
+  }
+EOF
+
+  fallback_backend_host = <<EOF
+if (req.restarts > 0) {
+    set bereq.http.Host = "${var.fallback_backend_host}";
+  }
+EOF
+
+  # a backend that can't be reached ends up in vcl_error rather than vcl_fetch
+  fallback_restart = <<EOF
+if (req.restarts < ${var.max_restarts} && (req.request == "GET" || req.request == "HEAD")) {
+     restart;
+   }
+EOF
+
+  # time to first byte here and from the backend - only measured for
+  # Server-Timing, log_ttfb or the shield-to-origin stream
+  measure_ttfb = "${var.server_timing == "true" || var.log_ttfb == "true" || var.log_shield_origin == "true" ? "true" : "false"}"
+
+  fetch_start = <<EOF
+set req.http.X-Fetch-Start = time.elapsed.msec;
+EOF
+
+  # the shield's, for a shielded miss
+  origin_ttfb = <<EOF
+declare local var.origin_ttfb INTEGER;
+
+  set var.origin_ttfb = time.elapsed.msec;
+  set var.origin_ttfb -= std.atoi(req.http.X-Fetch-Start);
+  set req.http.X-Origin-TTFB = var.origin_ttfb;
+EOF
+
+  edge_ttfb = <<EOF
+set req.http.X-Edge-TTFB = time.elapsed.msec;
+EOF
+
+  # Server-Timing for responses from the edge, after any the backend sent:
+  # time to first byte here and from the backend, and the cache state
+  server_timing = <<EOF
+if (!req.http.Fastly-FF) {
+    if (resp.http.Server-Timing) {
+      set resp.http.Server-Timing = resp.http.Server-Timing ", edge;dur=" req.http.X-Edge-TTFB;
+    } else {
+      set resp.http.Server-Timing = "edge;dur=" req.http.X-Edge-TTFB;
+    }
+    if (req.http.X-Origin-TTFB) {
+      set resp.http.Server-Timing = resp.http.Server-Timing ", origin;dur=" req.http.X-Origin-TTFB;
+    }
+    set resp.http.Server-Timing = resp.http.Server-Timing ", cache;desc=" fastly_info.state;
+  }
+EOF
+
+  # only clients in data.template_file.server_timing_acl see any
+  server_timing_strip = <<EOF
+if (!req.http.Fastly-FF && client.ip !~ server_timing_clients) {
+    unset resp.http.Server-Timing;
+  }
+EOF
+
+  # origin protection - on the edge, each client's requests are put in a
+  # class (reads, writes or the longest matching rate_limit_paths prefix);
+  # misses and passes are counted per client and class, and a client over
+  # its class's limit goes in the penalty box. X-Rate-Limit flags the
+  # request for the log, and in block mode it gets a 429 from vcl_error
+  rate_limit_declarations = <<EOF
+ratecounter rate_limit_counter {}
+penaltybox rate_limit_penaltybox {}
+EOF
+
+  rate_limit_block = "${var.rate_limit == "block" ? "error 829;" : ""}"
+
+  rate_limit_recv = <<EOF
+if (req.request == "GET" || req.request == "HEAD") {
+      set req.http.X-Rate-Limit-Class = "reads";
+      set req.http.X-Rate-Limit-Max = "${var.rate_limit_reads}";
+    } else {
+      set req.http.X-Rate-Limit-Class = "writes";
+      set req.http.X-Rate-Limit-Max = "${var.rate_limit_writes}";
+    }
+    ${join("\n    ", data.template_file.rate_limit_path.*.rendered)}
+    set req.http.X-Rate-Limit-Key = req.http.X-Client-IP ":" req.http.X-Rate-Limit-Class;
+    if (ratelimit.penaltybox_has(rate_limit_penaltybox, req.http.X-Rate-Limit-Key)) {
+      set req.http.X-Rate-Limit = "penalised";
+      ${local.rate_limit_block}
+    }
+EOF
+
+  # restarts aren't counted again
+  rate_limit_check = <<EOF
+if (req.http.X-Rate-Limit-Key && req.restarts == 0) {
+    if (ratelimit.check_rate(req.http.X-Rate-Limit-Key, rate_limit_counter, 1, ${var.rate_limit_window}, std.atoi(req.http.X-Rate-Limit-Max), rate_limit_penaltybox, ${var.rate_limit_penalty}s)) {
+      set req.http.X-Rate-Limit = "exceeded";
+      ${local.rate_limit_block}
+    }
+  }
+EOF
+
+  # private, so shared caches downstream don't turn one client away for all
+  rate_limit_response = <<EOF
+if (obj.status == 829) {
+   set obj.status = 429;
+   set obj.response = "Too Many Requests";
+   set obj.http.Retry-After = "${var.rate_limit_penalty}";
+   set obj.http.Cache-Control = "private, max-age=${var.rate_limit_penalty}";
+   set obj.http.Content-Type = "text/plain";
+   synthetic {"Too Many Requests"};
+   return(deliver);
+ }
+EOF
+
+  # no-cache only means "revalidate before reuse": with a validator the
+  # object is kept, already stale, for revalidate_keep (grace), so Fastly
+  # revalidates it with a conditional request and a 304 refreshes it
+  # without the body. Errors fall through to the ERROR branch
+  revalidate_no_cache = <<EOF
+if (beresp.status < 500 && beresp.http.Cache-Control ~ "no-cache" && beresp.http.Cache-Control !~ "private|no-store" && (beresp.http.ETag || beresp.http.Last-Modified)) {
+    set req.http.Fastly-Cachetype = "REVALIDATE";
+    set beresp.ttl = 0s;
+    set beresp.grace = ${var.revalidate_keep}s;
+    set beresp.stale_while_revalidate = 0s;
+    set beresp.stale_if_error = ${var.stale_if_error}s;
+    return(deliver);
+  }
+EOF
+
+  # keyed by log_profile and log_format_options (see tools/log_format.py)
+  log_formats = {
+    minimal         = "dd_log_format_minimal.json"
+    "minimal+ttfb"  = "dd_log_format_minimal.json"
+    standard        = "dd_log_format_standard.json"
+    "standard+ttfb" = "dd_log_format_standard_ttfb.json"
+    full            = "dd_log_format.json"
+    "full+ttfb"     = "dd_log_format_ttfb.json"
+  }
+
+  log_format_options = "${var.log_ttfb == "true" ? "+ttfb" : ""}"
+
+  # cache hits other than errors (HITPASS is a pass)
+  log_sampled_statement = "fastly_info.state ~ \"^HIT($|-)\" && resp.status < 500"
 }
 
 resource "fastly_service_v1" "fastly" {
@@ -18,25 +237,40 @@ resource "fastly_service_v1" "fastly" {
   }
 
   default_host = "${var.override_host == "true" ? local.full_domain_name : ""}"
-  default_ttl  = 60
+  default_ttl  = "${var.default_ttl}"
 
+  # backend_address, or the first of backends - with more than one, they are
+  # declared in the custom VCL and this node's origin requests go to the
+  # director instead
   backend {
-    address               = "${var.backend_address}"
+    address               = "${lookup(local.backends[0], "address")}"
     name                  = "default backend"
-    port                  = 443
+    port                  = "${lookup(local.backends[0], "port", 443)}"
     use_ssl               = "true"
-    ssl_check_cert        = "${var.ssl_cert_check}"
-    ssl_cert_hostname     = "${var.ssl_cert_hostname}"
+    ssl_check_cert        = "${lookup(local.backends[0], "ssl_check_cert", var.ssl_cert_check)}"
+    ssl_cert_hostname     = "${lookup(local.backends[0], "ssl_cert_hostname", var.ssl_cert_hostname)}"
     connect_timeout       = "${var.connect_timeout}"
     first_byte_timeout    = "${var.first_byte_timeout}"
     between_bytes_timeout = "${var.between_bytes_timeout}"
     shield                = "${var.shield}"
   }
 
+  # vcl_fetch looks up per-path ttls here - the items are managed by
+  # fastly_service_dictionary_items_v1.ttl_policy
+  dictionary {
+    name = "ttl_policy"
+  }
+
+  # path -> target for redirects answered at the edge - the items are managed
+  # by fastly_service_dictionary_items_v1.redirects
+  dictionary {
+    name = "redirects"
+  }
+
   gzip {
     name          = "file extensions and content types"
-    extensions    = ["css", "js"]
-    content_types = ["text/html", "text/css", "application/json"]
+    extensions    = ["${var.gzip_extensions}"]
+    content_types = ["${var.gzip_content_types}"]
   }
 
   request_setting {
@@ -61,6 +295,58 @@ resource "fastly_service_v1" "fastly" {
     priority  = 5
     statement = "req.url ${var.env == "live" ? "!~ \".*\"" : "~ \"^/robots.txt\""}"
   }
+  condition {
+    name      = "response-404-condition"
+    type      = "CACHE"
+    priority  = 5
+    statement = "${var.not_found_response == "" ? "now.sec == \"\"" : "beresp.status == 404 && req.http.Cookie:viewerror != \"true\""}"
+  }
+  condition {
+    name      = "response-500-condition"
+    type      = "CACHE"
+    priority  = 5
+    statement = "${var.error_response == "" ? "now.sec == \"\"" : "beresp.status == 500 && req.http.Cookie:viewerror != \"true\""}"
+  }
+  condition {
+    name      = "response-503-condition"
+    type      = "CACHE"
+    priority  = 5
+    statement = "beresp.status == 503 && req.http.Cookie:viewerror != \"true\""
+  }
+  condition {
+    name      = "response-502-condition"
+    type      = "CACHE"
+    priority  = 5
+    statement = "beresp.status == 502 && req.http.Cookie:viewerror != \"true\""
+  }
+  condition {
+    name      = "surrogate-key-condition"
+    type      = "CACHE"
+    priority  = 10
+    statement = "beresp.http.${var.surrogate_key_name} != \"\""
+  }
+  # every error, miss and pass is logged from the edge...
+  condition {
+    name      = "syslog-no-shield-condition"
+    type      = "RESPONSE"
+    priority  = 10
+    statement = "!req.http.Fastly-FF && !(${local.log_sampled_statement})"
+  }
+  # ...but only one in log_hit_sample_rate cache hits
+  condition {
+    name      = "syslog-sampled-hits-condition"
+    type      = "RESPONSE"
+    priority  = 10
+    statement = "!req.http.Fastly-FF && ${local.log_sampled_statement} && randombool(1, ${var.log_hit_sample_rate})"
+  }
+  # the shield's own fetches from the origin - the endpoint is always there,
+  # but never matches unless log_shield_origin is on
+  condition {
+    name      = "syslog-shield-origin-condition"
+    type      = "RESPONSE"
+    priority  = 10
+    statement = "${var.log_shield_origin == "true" ? "req.http.Fastly-FF && fastly_info.state ~ \"^(MISS|PASS|HITPASS)\"" : "now.sec == \"\""}"
+  }
 
   response_object {
     name            = "error-response-404"
@@ -71,13 +357,6 @@ resource "fastly_service_v1" "fastly" {
     cache_condition = "response-404-condition"
   }
 
-  condition {
-    name      = "response-404-condition"
-    type      = "CACHE"
-    priority  = 5
-    statement = "${var.not_found_response == "" ? "now.sec == \"\"" : "beresp.status == 404 && req.http.Cookie:viewerror != \"true\""}"
-  }
-
   response_object {
     name            = "error-response-500"
     status          = 500
@@ -87,13 +366,6 @@ resource "fastly_service_v1" "fastly" {
     cache_condition = "response-500-condition"
   }
 
-  condition {
-    name      = "response-500-condition"
-    type      = "CACHE"
-    priority  = 5
-    statement = "${var.error_response == "" ? "now.sec == \"\"" : "beresp.status == 500 && req.http.Cookie:viewerror != \"true\""}"
-  }
-
   # 503 error handling
   response_object {
     name            = "error-response-503"
@@ -104,13 +376,6 @@ resource "fastly_service_v1" "fastly" {
     cache_condition = "response-503-condition"
   }
 
-  condition {
-    name      = "response-503-condition"
-    type      = "CACHE"
-    priority  = 5
-    statement = "beresp.status == 503 && req.http.Cookie:viewerror != \"true\""
-  }
-
   # 502 error handling
   response_object {
     name            = "error-response-502"
@@ -120,27 +385,6 @@ resource "fastly_service_v1" "fastly" {
     content_type    = "text/html"
     cache_condition = "response-502-condition"
   }
-
-  condition {
-    name      = "response-502-condition"
-    type      = "CACHE"
-    priority  = 5
-    statement = "beresp.status == 502 && req.http.Cookie:viewerror != \"true\""
-  }
-
-  condition {
-    name      = "surrogate-key-condition"
-    type      = "CACHE"
-    priority  = 10
-    statement = "beresp.http.${var.surrogate_key_name} != \"\""
-  }
-
-  condition {
-    name      = "syslog-no-shield-condition"
-    type      = "RESPONSE"
-    priority  = 10
-    statement = "!req.http.Fastly-FF"
-  }
   
   # Sanitise HTTP headers
   header {
@@ -173,12 +417,34 @@ resource "fastly_service_v1" "fastly" {
     address            = "intake.logs.datadoghq.com"
     port               = "10516"
     message_type       = "blank"
-    format             = "${module.secretsmanager.datadog_api_key} ${replace(data.local_file.container_definitions.content, "\n", "")}"
+    format             = "${module.secretsmanager.datadog_api_key} ${data.template_file.log_format.rendered}"
     format_version     = "2"
-    use_tls            = true
+    use_tls            = "true"
     tls_hostname       = "intake.logs.datadoghq.com"
     response_condition = "syslog-no-shield-condition"
   }
+  syslog {
+    name               = "${local.full_domain_name}-syslog-sampled-hits"
+    address            = "intake.logs.datadoghq.com"
+    port               = "10516"
+    message_type       = "blank"
+    format             = "${module.secretsmanager.datadog_api_key} ${data.template_file.log_format_sampled_hits.rendered}"
+    format_version     = "2"
+    use_tls            = "true"
+    tls_hostname       = "intake.logs.datadoghq.com"
+    response_condition = "syslog-sampled-hits-condition"
+  }
+  syslog {
+    name               = "${local.full_domain_name}-syslog-shield-origin"
+    address            = "intake.logs.datadoghq.com"
+    port               = "10516"
+    message_type       = "blank"
+    format             = "${module.secretsmanager.datadog_api_key} ${data.template_file.log_format_origin.rendered}"
+    format_version     = "2"
+    use_tls            = "true"
+    tls_hostname       = "intake.logs.datadoghq.com"
+    response_condition = "syslog-shield-origin-condition"
+  }
 
   vcl {
     name    = "custom_vcl"
@@ -189,18 +455,66 @@ resource "fastly_service_v1" "fastly" {
   force_destroy = true
 }
 
+# dictionary items change without activating a new service version
+resource "fastly_service_dictionary_items_v1" "ttl_policy" {
+  count         = "${length(keys(var.ttl_policy)) > 0 ? 1 : 0}"
+  service_id    = "${fastly_service_v1.fastly.id}"
+  dictionary_id = "${lookup(zipmap(fastly_service_v1.fastly.dictionary.*.name, fastly_service_v1.fastly.dictionary.*.dictionary_id), "ttl_policy")}"
+  items         = "${var.ttl_policy}"
+}
+
+resource "fastly_service_dictionary_items_v1" "redirects" {
+  count         = "${length(keys(var.redirects)) > 0 ? 1 : 0}"
+  service_id    = "${fastly_service_v1.fastly.id}"
+  dictionary_id = "${lookup(zipmap(fastly_service_v1.fastly.dictionary.*.name, fastly_service_v1.fastly.dictionary.*.dictionary_id), "redirects")}"
+  items         = "${var.redirects}"
+}
+
 data "template_file" "custom_vcl" {
   template = "${file("${path.module}/custom.vcl")}"
 
   vars {
     proxy_error_response        = "${var.proxy_error_response}"
     custom_vcl_backends         = "${var.custom_vcl_backends}"
+    vcl_backends                = "${join("", concat(data.template_file.backend.*.rendered, data.template_file.regional_backend.*.rendered, data.template_file.fallback_backend.*.rendered))}"
     custom_vcl_recv             = "${var.custom_vcl_recv}"
     custom_vcl_recv_no_shield   = "${var.custom_vcl_recv_no_shield}"
     custom_vcl_recv_shield_only = "${var.custom_vcl_recv_shield_only}"
     custom_vcl_error            = "${var.custom_vcl_error}"
     custom_vcl_deliver          = "${var.custom_vcl_deliver}"
     vcl_recv_default_action     = "${var.caching == "true" ? "lookup" : "pass"}"
+    fallback_ttl                = "${var.fallback_ttl}"
+    shield_fallback_ttl         = "${var.shield_fallback_ttl == "" ? var.fallback_ttl : var.shield_fallback_ttl}"
+    stale_while_revalidate      = "${var.stale_while_revalidate}"
+    stale_if_error              = "${var.stale_if_error}"
+    querystring_filter          = "${join("", data.template_file.querystring_filter.*.rendered)}"
+    querystring_sort            = "${var.querystring_sort == "true" ? "set req.url = querystring.sort(req.url);" : ""}"
+    static_extensions           = "${local.static_extensions}"
+    static_path_patterns        = "${local.static_path_patterns}"
+    preserve_cookies            = "${local.preserve_cookies}"
+    director                    = "${join("", data.template_file.director.*.rendered)}"
+    director_backend            = "${length(var.backends) > 1 ? "set req.backend = origin_director;" : ""}"
+    accept_encoding             = "${var.normalise_accept_encoding == "true" ? local.accept_encoding : ""}"
+    max_restarts                = "${var.max_restarts}"
+    redirect_status             = "${var.redirect_status}"
+    redirect_response           = "${lookup(local.redirect_responses, var.redirect_status)}"
+    redirect_querystring        = "${var.redirect_preserve_querystring == "true" ? local.redirect_querystring : ""}"
+    fallback_backend            = "${var.fallback_backend_address != "" ? local.fallback_backend : ""}"
+    fallback_backend_host       = "${var.fallback_backend_address != "" && var.fallback_backend_host != "" ? local.fallback_backend_host : ""}"
+    fallback_restart            = "${var.fallback_backend_address != "" ? local.fallback_restart : ""}"
+    fetch_start                 = "${local.measure_ttfb == "true" ? local.fetch_start : ""}"
+    origin_ttfb                 = "${local.measure_ttfb == "true" ? local.origin_ttfb : ""}"
+    edge_ttfb                   = "${local.measure_ttfb == "true" ? local.edge_ttfb : ""}"
+    server_timing               = "${var.server_timing == "true" ? local.server_timing : ""}"
+    server_timing_acl           = "${join("", data.template_file.server_timing_acl.*.rendered)}"
+    server_timing_strip         = "${length(var.server_timing_clients) > 0 ? local.server_timing_strip : ""}"
+    rate_limit_declarations     = "${var.rate_limit != "off" ? local.rate_limit_declarations : ""}"
+    rate_limit_recv             = "${var.rate_limit != "off" ? local.rate_limit_recv : ""}"
+    rate_limit_check            = "${var.rate_limit != "off" ? local.rate_limit_check : ""}"
+    rate_limit_response         = "${var.rate_limit == "block" ? local.rate_limit_response : ""}"
+    origin_region               = "${join(" else ", data.template_file.origin_region.*.rendered)}"
+    regional_backend            = "${join(" else ", data.template_file.regional_backend_choice.*.rendered)}"
+    revalidate_no_cache         = "${var.revalidate_no_cache == "true" ? local.revalidate_no_cache : ""}"
   }
 }
 
@@ -213,8 +527,9 @@ resource "fastly_service_v1" "fastly_bare_domain_redirection" {
     name = "${var.bare_redirect_domain_name}"
   }
 
+  # backend_address, or the first of backends if only those are given
   backend {
-    address               = "${var.backend_address}"
+    address               = "${var.backend_address != "" ? var.backend_address : lookup(local.backends[0], "address")}"
     name                  = "default backend"
     port                  = 443
     ssl_check_cert        = "false"
@@ -249,6 +564,30 @@ resource "fastly_service_v1" "fastly_bare_domain_redirection" {
   }
 }
 
-data "local_file" "container_definitions" {
-  filename = "${path.module}/dd_log_format.json"
+# log line formats, generated from log_fields.json by tools/log_format.py -
+# sample_rate is how many requests each line stands for. Errors, misses and
+# passes are always logged with every field, whatever log_profile is
+data "template_file" "log_format" {
+  template = "${file("${path.module}/${lookup(local.log_formats, "full${local.log_format_options}")}")}"
+
+  vars {
+    sample_rate = 1
+  }
+}
+
+data "template_file" "log_format_sampled_hits" {
+  template = "${file("${path.module}/${lookup(local.log_formats, "${var.log_profile}${local.log_format_options}")}")}"
+
+  vars {
+    sample_rate = "${var.log_hit_sample_rate}"
+  }
+}
+
+# every origin fetch on a shield is logged, whatever log_profile is
+data "template_file" "log_format_origin" {
+  template = "${file("${path.module}/dd_log_format_origin.json")}"
+
+  vars {
+    sample_rate = 1
+  }
 }
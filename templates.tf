@@ -4,3 +4,156 @@ User-agent: *
 Disallow: /
 EOF
 }
+
+# query string normalisation for vcl_recv - keeps only the allowlisted
+# parameters if there are any, otherwise strips the listed ones
+data "template_file" "querystring_filter" {
+  count    = "${length(var.querystring_allowlist) + length(var.querystring_strip) > 0 ? 1 : 0}"
+  template = "set req.url = querystring.$${function}(req.url, \"^($${params})$\");"
+
+  vars {
+    function = "${length(var.querystring_allowlist) > 0 ? "regfilter_except" : "regfilter"}"
+    params   = "${length(var.querystring_allowlist) > 0 ? join("|", var.querystring_allowlist) : join("|", var.querystring_strip)}"
+  }
+}
+
+# the fallback origin is only declared in the custom VCL, so Fastly never
+# picks it as the default backend and it needs no request condition
+data "template_file" "fallback_backend" {
+  count    = "${var.fallback_backend_address != "" ? 1 : 0}"
+  template = "${local.vcl_backend}"
+
+  vars {
+    name       = "fallback_backend"
+    address    = "${var.fallback_backend_address}"
+    port       = 443
+    hostname   = "${var.fallback_backend_host != "" ? var.fallback_backend_host : var.fallback_backend_address}"
+    check_cert = "${var.ssl_cert_check == "true" ? "always" : "never"}"
+    probe      = ""
+  }
+}
+
+# each of var.backends, declared in the custom VCL with a health check when
+# there's more than one, for the director
+data "template_file" "backend" {
+  count    = "${length(var.backends) > 1 ? length(var.backends) : 0}"
+  template = "${local.vcl_backend}"
+
+  vars {
+    name       = "backend_${count.index}"
+    address    = "${lookup(var.backends[count.index], "address")}"
+    port       = "${lookup(var.backends[count.index], "port", 443)}"
+    hostname   = "${lookup(var.backends[count.index], "ssl_cert_hostname", var.ssl_cert_hostname != "" ? var.ssl_cert_hostname : lookup(var.backends[count.index], "address"))}"
+    check_cert = "${lookup(var.backends[count.index], "ssl_check_cert", var.ssl_cert_check) == "true" ? "always" : "never"}"
+    probe      = "${format(local.vcl_probe, lookup(var.backends[count.index], "healthcheck_path", var.healthcheck_path), lookup(var.backends[count.index], "healthcheck_host", local.full_domain_name))}"
+  }
+}
+
+# spreads requests over var.backends when there's more than one
+data "template_file" "director" {
+  count = "${length(var.backends) > 1 ? 1 : 0}"
+
+  template = <<EOF
+director origin_director $${type} {
+  .quorum = $${quorum}%;$${settings}
+$${backends}
+}
+EOF
+
+  # random directors retry other backends; chash ones hash .key (the cache
+  # key or the client) onto a ring seeded with .seed, and identify each
+  # backend by .id rather than weighting it
+  vars {
+    type     = "${var.director_type}"
+    quorum   = "${var.director_quorum}"
+    settings = "${var.director_type == "random" ? format("\n  .retries = %d;", length(var.backends)) : var.director_type == "chash" ? format("\n  .key = %s;\n  .seed = %s;", var.director_chash_key, var.director_chash_seed) : ""}"
+    backends = "${join("\n", data.template_file.director_backend.*.rendered)}"
+  }
+}
+
+data "template_file" "director_backend" {
+  count    = "${length(var.backends)}"
+  template = "  { .backend = backend_$${index}; $${setting} }"
+
+  vars {
+    index   = "${count.index}"
+    setting = "${var.director_type == "chash" ? format(".id = \"backend_%d\";", count.index) : format(".weight = %s;", lookup(var.backends[count.index], "weight", 100))}"
+  }
+}
+
+# a rate limit class for each rate_limit_paths prefix - keys() sorts them, so
+# a longer prefix comes after (and overrides) any shorter one it starts with
+data "template_file" "rate_limit_path" {
+  count    = "${length(keys(var.rate_limit_paths))}"
+  template = "if (std.prefixof(req.url.path, \"$${prefix}\")) {\n      set req.http.X-Rate-Limit-Class = \"$${prefix}\";\n      set req.http.X-Rate-Limit-Max = \"$${limit}\";\n    }"
+
+  vars {
+    prefix = "${element(keys(var.rate_limit_paths), count.index)}"
+    limit  = "${lookup(var.rate_limit_paths, element(keys(var.rate_limit_paths), count.index))}"
+  }
+}
+
+# the first regional backend whose region matches server.region (or the
+# client's continent) names the origin region
+data "template_file" "origin_region" {
+  count    = "${length(var.regional_backends)}"
+  template = "if ($${source} ~ \"$${region}\") {\n      set req.http.X-Origin-Region = \"$${name}\";\n    }"
+
+  vars {
+    source = "${var.region_source == "client" ? "client.geo.continent_code" : "server.region"}"
+    region = "${lookup(var.regional_backends[count.index], "region")}"
+    name   = "${lookup(var.regional_backends[count.index], "name")}"
+  }
+}
+
+# each region's origin, declared in the custom VCL so it is only picked by
+# regional_backend_choice
+data "template_file" "regional_backend" {
+  count    = "${length(var.regional_backends)}"
+  template = "${local.vcl_backend}"
+
+  vars {
+    name       = "regional_backend_${lookup(var.regional_backends[count.index], "name")}"
+    address    = "${lookup(var.regional_backends[count.index], "address")}"
+    port       = "${lookup(var.regional_backends[count.index], "port", 443)}"
+    hostname   = "${lookup(var.regional_backends[count.index], "ssl_cert_hostname", lookup(var.regional_backends[count.index], "address"))}"
+    check_cert = "${lookup(var.regional_backends[count.index], "ssl_check_cert", var.ssl_cert_check) == "true" ? "always" : "never"}"
+    probe      = ""
+  }
+}
+
+# sends an origin request to the origin of the region vcl_recv tagged it with
+data "template_file" "regional_backend_choice" {
+  count    = "${length(var.regional_backends)}"
+  template = "if (req.http.X-Origin-Region == \"$${name}\") {\n      set req.backend = regional_backend_$${name};\n    }"
+
+  vars {
+    name = "${lookup(var.regional_backends[count.index], "name")}"
+  }
+}
+
+# clients that see Server-Timing headers, when server_timing_clients is set
+data "template_file" "server_timing_acl" {
+  count = "${length(var.server_timing_clients) > 0 ? 1 : 0}"
+
+  template = <<EOF
+acl server_timing_clients {
+$${entries}
+}
+EOF
+
+  vars {
+    entries = "${join("\n", data.template_file.server_timing_client.*.rendered)}"
+  }
+}
+
+# "address" or "address"/prefix for each address or CIDR block
+data "template_file" "server_timing_client" {
+  count    = "${length(var.server_timing_clients)}"
+  template = "  \"$${address}\"$${prefix};"
+
+  vars {
+    address = "${element(split("/", var.server_timing_clients[count.index]), 0)}"
+    prefix  = "${replace(var.server_timing_clients[count.index], "/^[^/]*/", "")}"
+  }
+}
@@ -16,18 +16,56 @@ provider "aws" {
 module "fastly" {
   source = "../.."
 
-  domain_name                 = "${var.domain_name}"
-  backend_address             = "${var.backend_address}"
-  env                         = "${var.env}"
-  bare_redirect_domain_name   = "${var.bare_redirect_domain_name}"
-  proxy_error_response        = "${var.proxy_error_response}"
-  custom_vcl_backends         = "${var.custom_vcl_backends}"
-  custom_vcl_recv             = "${var.custom_vcl_recv}"
-  custom_vcl_recv_no_shield   = "${var.custom_vcl_recv_no_shield}"
-  custom_vcl_recv_shield_only = "${var.custom_vcl_recv_shield_only}"
-  custom_vcl_error            = "${var.custom_vcl_error}"
-  custom_vcl_deliver          = "${var.custom_vcl_deliver}"
-  run_data                    = false
+  domain_name                   = "${var.domain_name}"
+  backend_address               = "${var.backend_address}"
+  env                           = "${var.env}"
+  bare_redirect_domain_name     = "${var.bare_redirect_domain_name}"
+  proxy_error_response          = "${var.proxy_error_response}"
+  custom_vcl_backends           = "${var.custom_vcl_backends}"
+  custom_vcl_recv               = "${var.custom_vcl_recv}"
+  custom_vcl_recv_no_shield     = "${var.custom_vcl_recv_no_shield}"
+  custom_vcl_recv_shield_only   = "${var.custom_vcl_recv_shield_only}"
+  custom_vcl_error              = "${var.custom_vcl_error}"
+  custom_vcl_deliver            = "${var.custom_vcl_deliver}"
+  default_ttl                   = "${var.default_ttl}"
+  fallback_ttl                  = "${var.fallback_ttl}"
+  shield_fallback_ttl           = "${var.shield_fallback_ttl}"
+  stale_while_revalidate        = "${var.stale_while_revalidate}"
+  stale_if_error                = "${var.stale_if_error}"
+  querystring_strip             = "${var.querystring_strip}"
+  querystring_allowlist         = "${var.querystring_allowlist}"
+  querystring_sort              = "${var.querystring_sort}"
+  static_extensions             = "${var.static_extensions}"
+  static_path_patterns          = "${var.static_path_patterns}"
+  preserve_cookies              = "${var.preserve_cookies}"
+  gzip_extensions               = "${var.gzip_extensions}"
+  gzip_content_types            = "${var.gzip_content_types}"
+  normalise_accept_encoding     = "${var.normalise_accept_encoding}"
+  prefer_brotli                 = "${var.prefer_brotli}"
+  log_profile                   = "${var.log_profile}"
+  log_hit_sample_rate           = "${var.log_hit_sample_rate}"
+  log_ttfb                      = "${var.log_ttfb}"
+  log_shield_origin             = "${var.log_shield_origin}"
+  fallback_backend_address      = "${var.fallback_backend_address}"
+  fallback_backend_host         = "${var.fallback_backend_host}"
+  max_restarts                  = "${var.max_restarts}"
+  ttl_policy                    = "${var.ttl_policy}"
+  redirects                     = "${var.redirects}"
+  redirect_status               = "${var.redirect_status}"
+  redirect_preserve_querystring = "${var.redirect_preserve_querystring}"
+  server_timing                 = "${var.server_timing}"
+  server_timing_clients         = "${var.server_timing_clients}"
+  rate_limit                    = "${var.rate_limit}"
+  rate_limit_reads              = "${var.rate_limit_reads}"
+  rate_limit_writes             = "${var.rate_limit_writes}"
+  rate_limit_paths              = "${var.rate_limit_paths}"
+  rate_limit_window             = "${var.rate_limit_window}"
+  rate_limit_penalty            = "${var.rate_limit_penalty}"
+  regional_backends             = "${var.regional_backends}"
+  region_source                 = "${var.region_source}"
+  revalidate_no_cache           = "${var.revalidate_no_cache}"
+  revalidate_keep               = "${var.revalidate_keep}"
+  run_data                      = false
 }
 
 module "fastly_custom_timeouts" {
@@ -92,6 +130,30 @@ module "fastly_set_surrogate_key" {
   run_data           = false
 }
 
+module "fastly_multiple_backends" {
+  source = "../.."
+
+  domain_name   = "${var.domain_name}"
+  env           = "${var.env}"
+  director_type = "${var.director_type}"
+  shield        = "london-uk"
+  run_data      = false
+
+  bare_redirect_domain_name = "${var.bare_redirect_domain_name}"
+
+  backends = [
+    {
+      address = "eu.${var.backend_address}"
+      weight  = "200"
+    },
+    {
+      address          = "us.${var.backend_address}"
+      ssl_check_cert   = "false"
+      healthcheck_path = "/health"
+    },
+  ]
+}
+
 # variables
 variable "domain_name" {}
 
@@ -162,3 +224,171 @@ variable "shield" {
 variable "surrogate_key_name" {
   default = ""
 }
+
+variable "director_type" {
+  default = "random"
+}
+
+variable "default_ttl" {
+  default = 60
+}
+
+variable "fallback_ttl" {
+  default = 3600
+}
+
+variable "shield_fallback_ttl" {
+  default = ""
+}
+
+variable "stale_while_revalidate" {
+  default = 0
+}
+
+variable "stale_if_error" {
+  default = 0
+}
+
+variable "querystring_strip" {
+  type    = "list"
+  default = []
+}
+
+variable "querystring_allowlist" {
+  type    = "list"
+  default = []
+}
+
+variable "querystring_sort" {
+  default = "false"
+}
+
+variable "static_extensions" {
+  type    = "list"
+  default = []
+}
+
+variable "static_path_patterns" {
+  type    = "list"
+  default = []
+}
+
+variable "preserve_cookies" {
+  type    = "list"
+  default = ["viewerror"]
+}
+
+variable "gzip_extensions" {
+  type    = "list"
+  default = ["css", "js", "mjs", "json", "map", "html", "htm", "txt", "xml", "svg", "ico", "ttf", "otf", "eot"]
+}
+
+variable "gzip_content_types" {
+  type    = "list"
+  default = ["text/html", "text/css", "text/plain", "text/xml", "text/javascript", "application/javascript", "application/x-javascript", "application/json", "application/ld+json", "application/manifest+json", "application/xml", "application/rss+xml", "application/atom+xml", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon", "font/ttf", "font/otf", "application/x-font-ttf", "application/vnd.ms-fontobject"]
+}
+
+variable "normalise_accept_encoding" {
+  default = "true"
+}
+
+variable "prefer_brotli" {
+  default = "false"
+}
+
+variable "log_profile" {
+  default = "full"
+}
+
+variable "log_hit_sample_rate" {
+  default = "1"
+}
+
+variable "fallback_backend_address" {
+  default = ""
+}
+
+variable "fallback_backend_host" {
+  default = ""
+}
+
+variable "max_restarts" {
+  default = "1"
+}
+
+variable "ttl_policy" {
+  type    = "map"
+  default = {}
+}
+
+variable "redirects" {
+  type    = "map"
+  default = {}
+}
+
+variable "redirect_status" {
+  default = "301"
+}
+
+variable "redirect_preserve_querystring" {
+  default = "false"
+}
+
+variable "server_timing" {
+  default = "false"
+}
+
+variable "server_timing_clients" {
+  type    = "list"
+  default = []
+}
+
+variable "rate_limit" {
+  default = "off"
+}
+
+variable "rate_limit_reads" {
+  default = "100"
+}
+
+variable "rate_limit_writes" {
+  default = "10"
+}
+
+variable "rate_limit_paths" {
+  type    = "map"
+  default = {}
+}
+
+variable "rate_limit_window" {
+  default = "10"
+}
+
+variable "rate_limit_penalty" {
+  default = "120"
+}
+
+variable "regional_backends" {
+  type    = "list"
+  default = []
+}
+
+variable "region_source" {
+  default = "pop"
+}
+
+variable "revalidate_no_cache" {
+  default = "false"
+}
+
+variable "revalidate_keep" {
+  default = 86400
+}
+
+variable "log_ttfb" {
+  default = "false"
+}
+
+variable "log_shield_origin" {
+  default = "false"
+}
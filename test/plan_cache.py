@@ -0,0 +1,187 @@
+"""
+Session-scoped cache for `terraform plan` output.
+
+`terraform init` runs at most once per session, and only when a plan is not
+already cached. Each plan's output is stored on disk under a key made from
+the argv, any extra environment and a digest of every file that can change
+the plan, so later tests and later runs reuse it until one of those files is
+edited.
+
+`prefetch` computes every missing plan at once in a process pool. Each worker
+initialises its own `TF_DATA_DIR`, and all of them share one provider plugin
+cache, so the suite's wall time scales with cores rather than with tests.
+"""
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from subprocess import check_call, check_output
+
+# files and directories (relative to the repo root) whose contents feed into
+# the plan - anything with one of these suffixes at the top level, plus the
+# listed directories
+INPUT_SUFFIXES = ('.tf', '.vcl', '.json')
+INPUT_DIRS = ('modules', os.path.join('test', 'infra'))
+
+DEFAULT_CACHE_DIR = os.path.join('test', '.plan_cache')
+
+
+def _terraform_env(plugin_cache_dir, data_dir=None, env=None):
+    full_env = os.environ.copy()
+    full_env.update(env or {})
+    full_env.setdefault('TF_PLUGIN_CACHE_DIR', plugin_cache_dir)
+    full_env['TF_IN_AUTOMATION'] = '1'
+    if data_dir is not None:
+        full_env['TF_DATA_DIR'] = data_dir
+    return full_env
+
+
+def _init(root, env):
+    check_call(['terraform', 'init', 'test/infra'], cwd=root, env=env)
+    check_call(['terraform', 'get', 'test/infra'], cwd=root, env=env)
+
+
+# per-process state of a prefetch worker
+_worker = {}
+
+
+def _init_worker(root, plugin_cache_dir):
+    data_dir = tempfile.mkdtemp(prefix='tf-data-')
+    atexit.register(shutil.rmtree, data_dir, True)
+    _worker.update(
+        root=root, plugin_cache_dir=plugin_cache_dir, data_dir=data_dir
+    )
+    _init(root, _terraform_env(plugin_cache_dir, data_dir))
+
+
+def _plan_in_worker(argv, env):
+    return check_output(argv, cwd=_worker['root'], env=_terraform_env(
+        _worker['plugin_cache_dir'], _worker['data_dir'], env
+    )).decode('utf-8')
+
+
+class PlanCache(object):
+
+    def __init__(self, root, cache_dir=None):
+        self.root = root
+        self.cache_dir = os.path.join(root, cache_dir or os.environ.get(
+            'PLAN_CACHE_DIR', DEFAULT_CACHE_DIR
+        ))
+        self.plugin_cache_dir = os.path.join(self.cache_dir, 'plugins')
+        self._lock = threading.Lock()
+        self._initialised = False
+        self._inputs_digest = None
+
+    def _input_files(self):
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if name.endswith(INPUT_SUFFIXES) and os.path.isfile(path):
+                yield name
+        for directory in INPUT_DIRS:
+            for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.root, directory)
+            ):
+                dirnames[:] = sorted(
+                    d for d in dirnames if not d.startswith('.')
+                )
+                for name in sorted(filenames):
+                    yield os.path.relpath(
+                        os.path.join(dirpath, name), self.root
+                    )
+
+    def inputs_digest(self):
+        if self._inputs_digest is None:
+            digest = hashlib.sha256()
+            for name in self._input_files():
+                digest.update(name.encode('utf-8') + b'\0')
+                with open(os.path.join(self.root, name), 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+            self._inputs_digest = digest.hexdigest()
+        return self._inputs_digest
+
+    def key(self, argv, env=None):
+        return hashlib.sha256(json.dumps({
+            'argv': list(argv),
+            'env': sorted((env or {}).items()),
+            'inputs': self.inputs_digest(),
+        }, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, argv, env=None):
+        return os.path.join(self.cache_dir, self.key(argv, env) + '.txt')
+
+    def get(self, argv, env=None):
+        try:
+            with open(self.path(argv, env), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, argv, env, output):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(argv, env)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(output)
+        os.replace(tmp, path)
+
+    def init(self):
+        with self._lock:
+            if not self._initialised:
+                os.makedirs(self.plugin_cache_dir, exist_ok=True)
+                _init(self.root, _terraform_env(self.plugin_cache_dir))
+                self._initialised = True
+
+    def plan(self, argv, env=None):
+        output = self.get(argv, env)
+        if output is None:
+            self.init()
+            output = check_output(argv, cwd=self.root, env=_terraform_env(
+                self.plugin_cache_dir, env=env
+            )).decode('utf-8')
+            self.put(argv, env, output)
+        return output
+
+    def prefetch(self, argvs, env=None, workers=None):
+        """
+        Computes every plan in `argvs` that is not already cached, running
+        them concurrently in a pool of `workers` processes.
+        """
+        missing = []
+        for argv in argvs:
+            argv = list(argv)
+            if argv not in missing and self.get(argv, env) is None:
+                missing.append(argv)
+        if not missing:
+            return
+        # the first init populates the shared plugin cache, so workers only
+        # have to link providers into their own data dirs
+        self.init()
+        workers = min(workers or os.cpu_count() or 1, len(missing))
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(self.root, self.plugin_cache_dir),
+        ) as pool:
+            futures = [
+                (argv, pool.submit(_plan_in_worker, argv, env))
+                for argv in missing
+            ]
+            for argv, future in futures:
+                self.put(argv, env, future.result())
+
+
+_session = None
+
+
+def session(root=None):
+    """
+    Returns the PlanCache shared by every test in this session.
+    """
+    global _session
+    if _session is None:
+        _session = PlanCache(root or os.getcwd())
+    return _session
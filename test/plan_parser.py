@@ -0,0 +1,198 @@
+"""
+Reads `terraform plan -no-color` output (Terraform 0.11 format) once into an
+index, so assertions about set blocks are dictionary lookups instead of
+backtracking regex scans over the whole plan:
+
+    plan = parse_plan(output)
+    assert plan.has_block(
+        'header', action='delete', destination='http.X-Powered-By'
+    )
+
+The index is resource address -> block type -> set-element ident ->
+attribute -> value. Values are decoded from their quoted form, and
+`<computed>` values compare equal to `COMPUTED`.
+"""
+import json
+import re
+from functools import lru_cache
+
+COMPUTED = '<computed>'
+
+_RESOURCE = re.compile(r'^\s*(-/\+|[-+~]|<=) (\S+)(?: \(.*\))?$')
+_SUMMARY = re.compile(
+    r'^Plan: (\d+) to add, (\d+) to change, (\d+) to destroy\.$'
+)
+_SUFFIX = re.compile(r'\s+\(forces new resource\)$')
+
+
+def _decode(raw):
+    if raw.endswith(')'):
+        raw = _SUFFIX.sub('', raw)
+    if ' => ' in raw:
+        # updates render as `"old" => "new"` - the index holds the new value
+        raw = raw.rsplit(' => ', 1)[1]
+    if raw.startswith('"') and raw.endswith('"') and len(raw) > 1:
+        if '\\' not in raw:
+            return raw[1:-1]
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw[1:-1]
+    return raw
+
+
+class Resource(object):
+
+    def __init__(self, address, action):
+        self.address = address
+        self.action = action
+        # top-level attributes, including set counts such as `header.#`
+        self.attributes = {}
+        # block type -> ident -> attribute -> value
+        self.blocks = {}
+        # block type -> (attribute, value) -> set of idents
+        self._by_value = {}
+
+    def add(self, key, value):
+        parts = key.split('.', 2)
+        if len(parts) < 3:
+            self.attributes[key] = value
+            return
+        block, ident, attribute = parts
+        elements = self.blocks.get(block)
+        if elements is None:
+            elements = self.blocks[block] = {}
+            self._by_value[block] = {}
+        element = elements.get(ident)
+        if element is None:
+            element = elements[ident] = {}
+        element[attribute] = value
+        by_value = self._by_value[block]
+        idents = by_value.get((attribute, value))
+        if idents is None:
+            by_value[(attribute, value)] = {ident}
+        else:
+            idents.add(ident)
+
+    def find_blocks(self, block, **attributes):
+        """
+        Returns the attributes of each `block` element whose attributes
+        include all of the given ones.
+        """
+        elements = self.blocks.get(block, {})
+        by_value = self._by_value.get(block, {})
+        idents = None
+        for item in attributes.items():
+            matching = by_value.get(item, set())
+            idents = matching if idents is None else idents & matching
+            if not idents:
+                return []
+        if idents is None:
+            idents = elements
+        return [elements[ident] for ident in sorted(idents)]
+
+
+class Plan(object):
+
+    def __init__(self):
+        self.resources = {}
+        self.summary = None
+
+    def resource(self, address):
+        return self.resources[address]
+
+    def _candidates(self, resource):
+        if resource is None:
+            return self.resources.values()
+        return [self.resources[resource]] if resource in self.resources \
+            else []
+
+    def find_blocks(self, block, resource=None, **attributes):
+        return [
+            element
+            for candidate in self._candidates(resource)
+            for element in candidate.find_blocks(block, **attributes)
+        ]
+
+    def has_block(self, block, resource=None, **attributes):
+        return any(
+            candidate.find_blocks(block, **attributes)
+            for candidate in self._candidates(resource)
+        )
+
+    def attribute(self, key, resource=None):
+        """
+        Returns the values of the top-level `key` attribute across resources.
+        """
+        return [
+            candidate.attributes[key]
+            for candidate in self._candidates(resource)
+            if key in candidate.attributes
+        ]
+
+
+@lru_cache(maxsize=64)
+def parse_plan(output):
+    plan = Plan()
+    resource = None
+    for line in output.splitlines():
+        if resource is not None and line.startswith('      '):
+            key, _, value = line.strip().partition(':')
+            resource.add(key, _decode(value.strip()))
+            continue
+        match = _RESOURCE.match(line)
+        if match:
+            resource = Resource(match.group(2), match.group(1))
+            plan.resources[resource.address] = resource
+            continue
+        match = _SUMMARY.match(line)
+        if match:
+            plan.summary = tuple(int(n) for n in match.groups())
+        resource = None
+    return plan
+
+
+"""
+Takes a template (i.e. what you'd call `.format(...)` on, and returns a regex
+to to match it:
+
+    print(re.match(
+        template_to_re("hello {name}"),
+        "hello world"
+    ).group("name"))
+    # prints "world"
+
+Patterns are memoised; `compile_template` also keeps the compiled regex.
+"""
+
+
+@lru_cache(maxsize=None)
+def template_to_re(t):
+    seen = dict()
+
+    def pattern(placeholder, open_curly, close_curly, text, whitespace):
+        if text is not None:
+            return re.escape(text)
+        elif whitespace is not None:
+            return r'\s+'
+        elif open_curly is not None:
+            return r'\{'
+        elif close_curly is not None:
+            return r'\}'
+        elif seen.get(placeholder):
+            return '(?P={})'.format(placeholder)
+        else:
+            seen[placeholder] = True
+            return '(?P<{}>.*?)'.format(placeholder)
+
+    return "".join([
+        pattern(*match.groups())
+        for match in re.finditer(
+            r'{([\w_]+)}|(\{\{)|(\}\})|([^{}\s]+)|(\s+)', t
+        )
+    ])
+
+
+@lru_cache(maxsize=None)
+def compile_template(t):
+    return re.compile(template_to_re(t))
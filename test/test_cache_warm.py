@@ -0,0 +1,253 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tools.cache_warm import (
+    Warmer, WarmError, cache_state, main, parse_sitemap, report,
+    request_target, sitemap_urls, top_urls,
+)
+
+SITEMAP = '''<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url><loc>https://www.example.com/</loc></url>
+  <url>
+    <loc> https://www.example.com/a?page=2 </loc><priority>1</priority>
+  </url>
+</urlset>
+'''
+
+SITEMAP_INDEX = '''<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>{}/pages.xml</loc></sitemap>
+  <sitemap><loc>{}/sitemap.xml</loc></sitemap>
+</sitemapindex>
+'''
+
+
+class StubService(ThreadingHTTPServer):
+    """
+    A cache in front of nothing: the first request for each path is a MISS,
+    later ones HITs. `/chunked` is chunked, `/close` closes the connection
+    after the body and `/error` is a 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            seen = any(path == self.path for path, _ in server.requests)
+            server.requests.append((self.path, dict(self.headers)))
+            server.connections.add(self.client_address)
+        if self.path.endswith('.xml'):
+            content = (SITEMAP_INDEX.format(server.base_url, server.base_url)
+                       if self.path == '/sitemap.xml' else SITEMAP).encode()
+            content = gzip.compress(content)
+        else:
+            content = b'x' * 1000
+        self.send_response(503 if self.path == '/error' else 200)
+        self.send_header('X-Cache', 'MISS, HIT' if seen else 'MISS, MISS')
+        if self.path == '/chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in (content[:300], content[300:]):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+            self.wfile.write(b'0\r\n\r\n')
+        elif self.path == '/close':
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(content)
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+
+def log_line(url, state='MISS', status=200, method='GET', sample_rate=1):
+    record = {
+        'cache_state': state, 'sample_rate': sample_rate,
+        'http': {'url': url, 'status_code': str(status), 'method': method},
+    }
+    if state is None:
+        # logged before the field was added
+        del record['cache_state']
+    return 'apikey ' + json.dumps(record) + '\n'
+
+
+class TestCacheWarm(unittest.TestCase):
+
+    def _server(self):
+        server = StubService()
+        thread = threading.Thread(
+            target=server.serve_forever, args=(0.01,), daemon=True
+        )
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _file(self, lines, suffix='.log'):
+        f = tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.writelines(lines)
+        return f.name
+
+    def test_request_target(self):
+        assert request_target('https://www.example.com/a?b=1#c') == '/a?b=1'
+        assert request_target('https://www.example.com') == '/'
+        assert request_target('/path\n') == '/path'
+
+    def test_top_urls_are_weighted_by_sample_rate(self):
+        # Given
+        path = self._file([
+            log_line('/a'), log_line('/a'),
+            log_line('/b', state='HIT', sample_rate=10),
+            log_line('/c', state='HIT-STALE'),
+            log_line('/pass', state='PASS'),
+            log_line('/pass', state='HITPASS'),
+            log_line('/form', method='POST'),
+            log_line('/missing', status=404),
+            'not a log line\n',
+        ])
+
+        # When
+        urls = top_urls([path], top=3)
+
+        # Then
+        assert urls == ['/b', '/a', '/c']
+
+    def test_lines_without_a_cache_state_count(self):
+        # Given
+        path = self._file([
+            log_line('/old', state=None), log_line('/old', state=None),
+            log_line('/new'),
+            log_line('/old-form', state=None, method='POST'),
+        ])
+
+        # When
+        urls = top_urls([path])
+
+        # Then
+        assert urls == ['/old', '/new']
+
+    def test_sitemaps_and_indexes_are_followed(self):
+        # Given
+        server = self._server()
+
+        # When
+        urls = sitemap_urls(server.base_url + '/sitemap.xml')
+
+        # Then
+        assert urls == [
+            'https://www.example.com/', 'https://www.example.com/a?page=2'
+        ]
+        assert [path for path, _ in server.requests] == [
+            '/sitemap.xml', '/pages.xml'
+        ]
+        with self.assertRaises(WarmError):
+            parse_sitemap(b'<urlset>')
+
+    def test_urls_are_warmed_over_reused_connections(self):
+        # Given
+        server = self._server()
+        warmer = Warmer(server.base_url, concurrency=3, debug=True)
+        targets = ['https://www.example.com/{}'.format(i) for i in range(30)]
+
+        # When
+        first = warmer.warm(targets)
+        second = warmer.warm(targets[:10])
+
+        # Then
+        assert len(first.fetches) == 30
+        assert {f.status for f in first.fetches} == {200}
+        assert {f.size for f in first.fetches} == {1000}
+        assert {f.state for f in first.fetches} == {'MISS'}
+        assert {f.state for f in second.fetches} == {'HIT'}
+        assert first.connections == 3
+        assert len(server.connections) == 6
+        _, headers = server.requests[0]
+        assert headers['Host'] == server.base_url[len('http://'):]
+        assert headers['Accept-Encoding'] == 'gzip'
+        assert headers['Fastly-Debug'] == '1'
+
+    def test_chunked_closed_and_failed_responses(self):
+        # Given
+        server = self._server()
+        warmer = Warmer(server.base_url, concurrency=1)
+
+        # When
+        result = warmer.warm(['/chunked', '/close', '/close', '/error', '/'])
+
+        # Then
+        assert [(f.target, f.status, f.size) for f in result.fetches] == [
+            ('/chunked', 200, 1000), ('/close', 200, 1000),
+            ('/close', 200, 1000), ('/error', 503, 1000), ('/', 200, 1000),
+        ]
+        assert result.connections == 3
+        summary = report(result)
+        assert summary['errors'] == 1
+        assert summary['statuses'] == {'200': 4, '503': 1}
+
+    def test_unreachable_service_is_reported(self):
+        # Given
+        server = self._server()
+        base_url = server.base_url
+        server.shutdown()
+        server.server_close()
+
+        # When
+        result = Warmer(base_url, concurrency=2).warm(['/a', '/b'])
+
+        # Then
+        assert [f.status for f in result.fetches] == [None, None]
+        assert all(f.error for f in result.fetches)
+        assert report(result)['errors'] == 2
+
+    def test_cache_state(self):
+        assert cache_state({'x-cache': 'MISS, HIT'}) == 'HIT'
+        assert cache_state({'x-cache': 'MISS'}) == 'MISS'
+        assert cache_state({}) is None
+
+    def test_cli(self):
+        # Given
+        server = self._server()
+        path = self._file([log_line('/a'), log_line('/b')])
+        output = io.StringIO()
+
+        # When
+        with redirect_stdout(output):
+            status = main([server.base_url, '--logs', path])
+
+        # Then
+        assert status == 0
+        lines = output.getvalue().splitlines()
+        assert lines[0].startswith('2 requests in ')
+        assert lines[1].startswith('latency ms: p50 ')
+        assert 'status: 200 2' in lines
+        assert 'cache: MISS 2' in lines
@@ -0,0 +1,171 @@
+import json
+import os
+import tempfile
+import unittest
+
+from tools.log_format import (
+    ORIGIN, OUTPUTS, PROFILES, build, generate, load_schema,
+    profile_fields, validate,
+)
+
+
+class TestLogFormat(unittest.TestCase):
+
+    def test_generated_formats_are_up_to_date_and_valid(self):
+        # When
+        results = build(write=False)
+
+        # Then
+        for profile, (report, up_to_date) in results.items():
+            assert up_to_date, '{} is out of date'.format(OUTPUTS[profile])
+            assert report.problems == []
+
+    def test_profiles_are_nested(self):
+        # Given
+        schema = load_schema()
+
+        # When
+        names = [
+            {field['name'] for field in profile_fields(schema, profile)}
+            for profile in PROFILES
+        ]
+
+        # Then
+        minimal, standard, full = names
+        assert minimal < standard < full
+        assert {'http.url', 'cache_state', 'sample_rate'} <= minimal
+
+    def test_origin_stream_is_compact_and_labelled(self):
+        # Given
+        schema = load_schema()
+
+        # When
+        origin = {field['name'] for field in profile_fields(schema, ORIGIN)}
+        full = {
+            field['name'] for field in profile_fields(schema, 'full+ttfb')
+        }
+
+        # Then
+        assert {
+            'backend', 'http.origin_ttfb_ms', 'http.status_code',
+            'network.bytes_written', 'server_datacenter', 'sample_rate',
+        } <= origin
+        assert origin - full == {'log_stream'}
+        assert 'http.url' not in origin
+        report, _ = build(write=False)[ORIGIN]
+        assert report.worst_case_bytes < 8192
+
+    def test_optional_fields_are_only_in_formats_with_the_option(self):
+        # Given
+        schema = load_schema()
+        ttfb = {'http.edge_ttfb_ms', 'http.origin_ttfb_ms'}
+
+        # When
+        names = {
+            profile: {field['name'] for field in profile_fields(
+                schema, profile
+            )}
+            for profile in OUTPUTS
+        }
+
+        # Then
+        assert not ttfb & (names['standard'] | names['full'])
+        assert names['standard+ttfb'] - names['standard'] == ttfb
+        assert names['full+ttfb'] - names['full'] == ttfb
+        assert 'http.origin_ttfb_ms' in names[ORIGIN]
+
+    def test_generate_nests_dotted_names_and_escapes_strings(self):
+        # Given
+        schema = {'fields': [
+            {'name': 'http.url', 'vcl': 'req.url'},
+            {'name': 'http.status_code', 'directive': '%s'},
+            {'name': 'ua', 'request_header': 'User-Agent'},
+            {'name': 'bytes', 'directive': '%B'},
+            {'name': 'tls', 'vcl': 'req.is_ssl', 'type': 'bool'},
+        ]}
+
+        # When
+        log_format, _ = generate(schema, 'full')
+
+        # Then
+        assert log_format == (
+            '{"http":{"url":"%{json.escape(req.url)}V","status_code":"%s"},'
+            '"ua":"%{json.escape(req.http.User-Agent)}V",'
+            '"bytes":%B,'
+            '"tls":%{if(req.is_ssl, "true", "false")}V}'
+        )
+
+    def test_nullable_numbers_are_logged_as_null_unless_numeric(self):
+        # Given
+        schema = {'fields': [
+            {'name': 'ttfb', 'vcl': 'req.http.X-TTFB', 'type': 'integer',
+             'nullable': True},
+        ]}
+
+        # When
+        log_format, known = generate(schema, 'full')
+
+        # Then
+        assert log_format == (
+            '{"ttfb":%{if(req.http.X-TTFB ~ "^[0-9]+$", '
+            'req.http.X-TTFB, "null")}V}'
+        )
+        assert validate(log_format, known).problems == []
+
+    def test_unescaped_headers_are_reported(self):
+        # When
+        report = validate('{"ua": "%{User-Agent}i", "ok": "%{begin:%Y}t"}')
+
+        # Then
+        [(placeholder, sample, _)] = report.problems
+        assert (placeholder, sample) == ('%{User-Agent}i', '"')
+
+    def test_unquoted_variables_that_can_be_empty_are_reported(self):
+        # When
+        report = validate('{"size": %{req.body_bytes_read}V, "time": %D}')
+
+        # Then
+        assert [p[0] for p in report.problems] == ['%{req.body_bytes_read}V']
+
+    def test_known_placeholders_are_trusted(self):
+        # Given
+        _, known = generate(load_schema(), 'full')
+
+        # When
+        report = validate('{"size": %{req.body_bytes_read}V}', known)
+
+        # Then
+        assert report.problems == []
+
+    def test_structural_errors_are_reported(self):
+        # When
+        report = validate('{"a": "%m",}')
+
+        # Then
+        [(placeholder, _, _)] = report.problems
+        assert placeholder == ''
+
+    def test_worst_case_size_covers_escaped_values(self):
+        # When
+        report = validate('{"url":"%{json.escape(req.url)}V"}', {})
+
+        # Then
+        assert report.typical_bytes == len('{"url":"abc"}')
+        assert report.worst_case_bytes == len('{"url":""}') + 256 * 6
+
+    def test_build_writes_minified_formats(self):
+        # Given
+        root = tempfile.mkdtemp()
+
+        # When
+        build(root=root)
+
+        # Then
+        with open(os.path.join(root, OUTPUTS['minimal'])) as f:
+            log_format = f.read()
+        assert '\n' not in log_format
+        record = json.loads(
+            log_format.replace('${sample_rate}', '1')
+            .replace('%D', '1').replace('%B', '1')
+        )
+        assert record['ddsource'] == 'fastly'
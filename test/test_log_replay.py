@@ -0,0 +1,126 @@
+import json
+import unittest
+
+from tools import dd_logs
+from tools.log_replay import Scenario, parse_scenario, replay, report
+
+
+def log_line(url, pop='LHR', status=200, cache_control='(null)',
+             time_start='2018-01-01T00:00:00+0000', size=1000,
+             sample_rate=1):
+    return 'apikey ' + json.dumps({
+        'service': 'www.example.com',
+        'time_start': time_start,
+        'server_datacenter': pop,
+        'http': {'method': 'GET', 'url': url, 'status_code': str(status)},
+        'network': {'bytes_written': str(size)},
+        'response_cache_control': cache_control,
+        'sample_rate': sample_rate,
+    })
+
+
+class TestDDLogs(unittest.TestCase):
+
+    def test_parse_line_skips_the_syslog_prefix(self):
+        # When
+        record = dd_logs.parse_line('<134>1 host fastly: ' + log_line('/a'))
+
+        # Then
+        assert dd_logs.get(record, 'http.url') == '/a'
+        assert dd_logs.get(record, 'http.missing', 'x') == 'x'
+
+    def test_parse_line_ignores_non_json_lines(self):
+        assert dd_logs.parse_line('not a log line') is None
+
+    def test_timestamp(self):
+        assert dd_logs.timestamp('1970-01-01T00:01:00+0000') == 60
+        assert dd_logs.timestamp('(null)') is None
+
+
+class TestLogReplay(unittest.TestCase):
+
+    def _records(self, *lines):
+        return [dd_logs.parse_line(line) for line in lines]
+
+    def test_each_pop_has_its_own_cache(self):
+        # Given
+        records = self._records(
+            log_line('/a', pop='LHR'),
+            log_line('/a', pop='LHR'),
+            log_line('/a', pop='JFK'),
+        )
+        scenario = Scenario('current')
+
+        # When
+        replay(records, [scenario])
+
+        # Then
+        result = report([scenario], 0)['scenarios'][0]
+        assert result['origin_fetches'] == 2
+        assert result['bytes_from_cache'] == 1000
+        assert result['pops']['LHR']['origin_fetches'] == 1
+        assert result['pops']['JFK']['origin_fetches'] == 1
+
+    def test_scenarios_are_compared_on_the_same_records(self):
+        # Given
+        records = self._records(
+            log_line('/a', time_start='2018-01-01T00:00:00+0000'),
+            log_line('/a', time_start='2018-01-01T00:00:30+0000'),
+            log_line('/a', time_start='2018-01-01T00:01:00+0000'),
+        )
+        scenarios = [
+            Scenario('current'),
+            parse_scenario('no-caching:caching=false'),
+            parse_scenario('short:default_ttl=20,fallback_ttl=20'),
+        ]
+
+        # When
+        duration = replay(records, scenarios)
+
+        # Then
+        results = {
+            r['scenario']: r for r in report(scenarios, duration)['scenarios']
+        }
+        assert duration == 60
+        assert results['current']['origin_fetches'] == 1
+        assert results['no-caching']['origin_fetches'] == 3
+        assert results['short']['origin_fetches'] == 3
+        assert results['current']['origin_fetches_per_second'] == 1 / 60
+
+    def test_logged_cache_control_stands_in_for_the_origin(self):
+        # Given
+        records = self._records(
+            log_line('/me', cache_control='private'),
+            log_line('/me', cache_control='private'),
+        )
+        scenario = Scenario('current')
+
+        # When
+        replay(records, [scenario])
+
+        # Then
+        assert scenario.stats()['origin_fetches'] == 2
+
+    def test_sampled_lines_count_as_sample_rate_requests(self):
+        # Given
+        records = self._records(
+            log_line('/a'),
+            log_line('/a', sample_rate=10),
+            log_line('/b', sample_rate=5),
+        )
+        scenario = Scenario('current')
+
+        # When
+        replay(records, [scenario])
+
+        # Then
+        result = report([scenario], 0)['scenarios'][0]
+        assert result['requests'] == 16
+        assert result['origin_fetches'] == 2
+        assert result['hit_ratio'] == 14 / 16
+        assert result['bytes_from_origin'] == 2000
+        assert result['bytes_from_cache'] == 14000
+
+    def test_parse_scenario_rejects_bare_names_in_assignments(self):
+        with self.assertRaises(ValueError):
+            parse_scenario('bad:caching')
@@ -0,0 +1,240 @@
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from tools.log_stats import (
+    OTHER, Grouping, Sketch, _chunk_lines, chunks, main, path_prefix,
+    summarise_paths,
+)
+
+
+def log_line(url='/api/users', pop='LHR', status=200, state='MISS',
+             time_ms=100, size=1000, sample_rate=1, origin_ttfb='null'):
+    return 'apikey ' + json.dumps({
+        'service': 'www.example.com',
+        'server_datacenter': pop,
+        'cache_state': state,
+        'sample_rate': sample_rate,
+        'http': {
+            'url': url, 'status_code': str(status),
+            'request_time_ms': time_ms,
+            'origin_ttfb_ms': None if origin_ttfb == 'null' else origin_ttfb,
+        },
+        'network': {'bytes_written': size},
+    }) + '\n'
+
+
+class TestSketch(unittest.TestCase):
+
+    def test_quantiles_are_within_the_relative_accuracy(self):
+        # Given
+        rng = random.Random(1)
+        values = [rng.lognormvariate(5, 2) for _ in range(20000)]
+        sketch = Sketch(relative_accuracy=0.01)
+
+        # When
+        for value in values:
+            sketch.add(value)
+
+        # Then
+        values.sort()
+        for q in (0.1, 0.5, 0.95, 0.99, 0.999):
+            exact = values[int(q * (len(values) - 1))]
+            assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+        assert sketch.quantile(0) == values[0]
+        assert sketch.quantile(1) == values[-1]
+
+    def test_memory_is_bounded(self):
+        # Given
+        sketch = Sketch(relative_accuracy=0.01, max_buckets=64)
+
+        # When
+        for exponent in range(-100, 100):
+            sketch.add(10 ** (exponent / 10))
+
+        # Then
+        assert len(sketch.buckets) == 64
+        assert sketch.count == 200
+        assert abs(sketch.quantile(0.99) - 10 ** 9.7) <= 0.01 * 10 ** 9.7
+
+    def test_merged_sketches_match_one_sketch(self):
+        # Given
+        whole, a, b = Sketch(), Sketch(), Sketch()
+
+        # When
+        for value in range(1, 1001):
+            whole.add(value, 2)
+            (a if value % 2 else b).add(value, 2)
+        a.merge(b)
+
+        # Then
+        assert a.buckets == whole.buckets
+        assert (a.count, a.min, a.max) == (whole.count, 1, 1000)
+        assert a.quantile(0.5) == whole.quantile(0.5)
+
+    def test_zeros_and_empty_sketches(self):
+        # Given
+        sketch = Sketch()
+
+        # When
+        empty = sketch.quantile(0.5)
+        for value in (0, 0, 0, 5):
+            sketch.add(value)
+
+        # Then
+        assert empty is None
+        assert sketch.quantile(0.5) == 0
+        assert abs(sketch.quantile(1) - 5) <= 0.05
+
+
+class TestLogStats(unittest.TestCase):
+
+    def test_path_prefix(self):
+        assert path_prefix('/api/v1/users?x=/a/b') == '/api/'
+        assert path_prefix('/api/v1/users', depth=2) == '/api/v1/'
+        assert path_prefix('/favicon.ico') == '/'
+        assert path_prefix(None) == '/'
+
+    def test_lines_are_grouped_and_weighted_by_sample_rate(self):
+        # Given
+        lines = [
+            log_line(state='MISS', time_ms=200, origin_ttfb=150),
+            log_line(state='HIT', time_ms=10, sample_rate=10),
+            log_line(state='HITPASS', status=503),
+            log_line(url='/static/a.css', pop='JFK', state='HIT-STALE'),
+            'not a log line\n',
+        ]
+
+        # When
+        groups = Grouping(group_by=('prefix', 'pop')).summarise(lines)
+
+        # Then
+        assert set(groups) == {('/api/', 'LHR'), ('/static/', 'JFK')}
+        api = groups[('/api/', 'LHR')]
+        assert (api.requests, api.hits, api.misses, api.errors) == \
+            (12, 10, 1, 1)
+        assert api.hit_ratio() == 10 / 11
+        assert api.sketches['latency'].count == 12
+        assert abs(api.sketches['latency'].quantile(0.5) - 10) < 0.1
+        assert api.sketches['origin_ttfb'].count == 1
+        assert groups[('/static/', 'JFK')].hit_ratio() == 1
+
+    def test_where_filters_lines(self):
+        # Given
+        grouping = Grouping(
+            group_by=('pop',), where={'cache_state': 'MISS', 'prefix': '/api/'}
+        )
+
+        # When
+        groups = grouping.summarise([
+            log_line(), log_line(state='HIT'), log_line(url='/other/x'),
+        ])
+
+        # Then
+        assert {key: s.requests for key, s in groups.items()} == {
+            ('LHR',): 1
+        }
+
+    def test_groups_beyond_the_limit_are_counted_as_other(self):
+        # Given
+        grouping = Grouping(group_by=('prefix',), max_groups=2)
+
+        # When
+        groups = grouping.summarise(
+            [log_line(url='/{}/x'.format(i)) for i in range(5)]
+        )
+        grouping.merge(groups, grouping.summarise([log_line(url='/9/x')]))
+
+        # Then
+        assert {key: s.requests for key, s in groups.items()} == {
+            ('/0/',): 1, ('/1/',): 1, (OTHER,): 4,
+        }
+
+    def _log_file(self, lines):
+        f = tempfile.NamedTemporaryFile('w', suffix='.log', delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.writelines(lines)
+        return f.name
+
+    def test_chunks_split_files_between_lines(self):
+        # Given
+        lines = [log_line(url='/{}/'.format(i)) for i in range(50)]
+        path = self._log_file(lines)
+
+        # When
+        read = [
+            line for chunk in chunks([path], size=1000)
+            for line in _chunk_lines(*chunk)
+        ]
+
+        # Then
+        assert len(list(chunks([path], size=1000))) > 5
+        assert read == lines
+
+    def test_parallel_and_serial_summaries_match(self):
+        # Given
+        rng = random.Random(2)
+        path = self._log_file([
+            log_line(
+                url=rng.choice(['/a/', '/b/']), time_ms=rng.randint(1, 1000)
+            )
+            for _ in range(2000)
+        ])
+        grouping = Grouping(group_by=('prefix',))
+
+        # When
+        serial = summarise_paths(grouping, [path], jobs=1)
+        parallel = summarise_paths(grouping, [path], jobs=2)
+
+        # Then
+        assert set(serial) == set(parallel) == {('/a/',), ('/b/',)}
+        for key in serial:
+            assert serial[key].requests == parallel[key].requests
+            assert serial[key].sketches['latency'].buckets == \
+                parallel[key].sketches['latency'].buckets
+
+    def test_more_chunks_than_can_be_in_flight_are_all_merged(self):
+        # Given
+        paths = [
+            self._log_file([log_line(url='/{}/'.format(i % 3))] * (i + 1))
+            for i in range(12)
+        ]
+        grouping = Grouping(group_by=('prefix',))
+
+        # When
+        serial = summarise_paths(grouping, paths, jobs=1)
+        parallel = summarise_paths(grouping, paths, jobs=2)
+
+        # Then
+        assert {key: s.requests for key, s in parallel.items()} == \
+            {key: s.requests for key, s in serial.items()} == {
+                ('/0/',): 22, ('/1/',): 26, ('/2/',): 30,
+            }
+
+    def test_cli_reports_percentiles_as_json(self):
+        # Given
+        path = self._log_file(
+            [log_line(time_ms=t) for t in range(1, 101)]
+        )
+        output = io.StringIO()
+
+        # When
+        with redirect_stdout(output):
+            status = main([
+                path, '--jobs', '1', '--group-by', 'host,status',
+                '--quantiles', '0.5,0.99', '--json',
+            ])
+
+        # Then
+        assert status == 0
+        [row] = json.loads(output.getvalue())
+        assert (row['host'], row['status'], row['requests']) == \
+            ('www.example.com', '200', 100)
+        assert abs(row['latency']['p50'] - 50) <= 1
+        assert abs(row['latency']['p99'] - 99) <= 1
+        assert row['origin_ttfb']['p50'] is None
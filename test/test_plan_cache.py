@@ -0,0 +1,123 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from plan_cache import PlanCache
+
+
+class TestPlanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'test', 'infra'))
+        self._write('main.tf', 'resource "x" "y" {}')
+        self._write(os.path.join('test', 'infra', 'main.tf'), 'module {}')
+        self.argv = ['terraform', 'plan', '-no-color', 'test/infra']
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _fake_terraform(self):
+        # records each invocation and prints the argv and data dir as the plan
+        bin_dir = os.path.join(self.root, 'bin')
+        os.makedirs(bin_dir)
+        script = os.path.join(bin_dir, 'terraform')
+        with open(script, 'w') as f:
+            f.write(
+                '#!/bin/sh\n'
+                'echo "$1" >> "{}"\n'
+                'echo "plan $* ${{TF_DATA_DIR:-default}}"\n'.format(
+                    os.path.join(self.root, 'calls')
+                )
+            )
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+        path = os.environ['PATH']
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+
+    def _calls(self):
+        with open(os.path.join(self.root, 'calls')) as f:
+            return f.read().split()
+
+    def _write(self, name, content):
+        with open(os.path.join(self.root, name), 'w') as f:
+            f.write(content)
+
+    def test_cached_output_is_reused_without_running_terraform(self):
+        # Given
+        PlanCache(self.root).put(self.argv, {'A': 'b'}, 'cached plan')
+
+        # When
+        output = PlanCache(self.root).plan(self.argv, {'A': 'b'})
+
+        # Then
+        assert output == 'cached plan'
+
+    def test_key_depends_on_argv_and_env(self):
+        # Given
+        cache = PlanCache(self.root)
+
+        # When
+        key = cache.key(self.argv, {'A': 'b'})
+
+        # Then
+        assert key == cache.key(list(self.argv), {'A': 'b'})
+        assert key != cache.key(self.argv + ['-var', 'x=y'], {'A': 'b'})
+        assert key != cache.key(self.argv, {'A': 'c'})
+
+    def test_editing_an_input_invalidates_the_cache(self):
+        # Given
+        PlanCache(self.root).put(self.argv, None, 'stale plan')
+
+        # When
+        self._write(os.path.join('test', 'infra', 'main.tf'), 'changed')
+
+        # Then
+        assert PlanCache(self.root).get(self.argv) is None
+
+    def test_unrelated_files_do_not_invalidate_the_cache(self):
+        # Given
+        PlanCache(self.root).put(self.argv, None, 'plan')
+
+        # When
+        self._write('README.md', 'docs')
+
+        # Then
+        assert PlanCache(self.root).get(self.argv) == 'plan'
+
+    def test_prefetch_plans_missing_argvs_in_worker_data_dirs(self):
+        # Given
+        self._fake_terraform()
+        cache = PlanCache(self.root)
+        argvs = [
+            ['terraform', 'plan', '-var', 'x={}'.format(i), 'test/infra']
+            for i in range(3)
+        ]
+        cache.put(argvs[0], None, 'already cached')
+
+        # When
+        cache.prefetch(argvs + [argvs[1]], workers=2)
+
+        # Then
+        assert cache.get(argvs[0]) == 'already cached'
+        for i in (1, 2):
+            output = cache.get(argvs[i])
+            assert output.startswith(
+                'plan plan -var x={} test/infra '.format(i)
+            )
+            assert 'tf-data-' in output
+        assert self._calls().count('plan') == 2
+
+    def test_prefetch_does_nothing_when_everything_is_cached(self):
+        # Given
+        self._fake_terraform()
+        cache = PlanCache(self.root)
+        cache.put(self.argv, None, 'plan')
+
+        # When
+        cache.prefetch([self.argv])
+
+        # Then
+        assert not os.path.exists(os.path.join(self.root, 'calls'))
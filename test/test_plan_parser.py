@@ -0,0 +1,98 @@
+import unittest
+
+from plan_parser import (
+    COMPUTED, compile_template, parse_plan, template_to_re
+)
+
+PLAN = """
+Refreshing Terraform state in-memory prior to plan...
+
+Terraform will perform the following actions:
+
+  + module.fastly.fastly_service_v1.fastly
+      id:                                        <computed>
+      default_host:                              "ci-www.domain.com"
+      domain.#:                                  "1"
+      domain.1234.comment:                       ""
+      domain.1234.name:                          "ci-www.domain.com"
+      gzip.55.extensions.#:                      "2"
+      gzip.55.extensions.3:                      "css"
+      header.#:                                  "2"
+      header.111.action:                         "delete"
+      header.111.destination:                    "http.X-Powered-By"
+      header.111.source:                         <computed>
+      header.222.action:                         "set"
+      header.222.destination:                    "http.Server"
+      header.222.source:                         "\\"LHC\\""
+      response_object.9.content:                 "User-agent: *\\nDisallow: /\\n"
+
+  ~ module.fastly.fastly_service_v1.fastly_bare_domain_redirection
+      name:                                      "old" => "new"
+      backend.7.address:                         "1.1.1.1" => "2.2.2.2" (forces new resource)
+
+
+Plan: 1 to add, 1 to change, 0 to destroy.
+"""  # noqa
+
+
+class TestPlanParser(unittest.TestCase):
+
+    def test_indexes_resources_blocks_and_attributes(self):
+        # When
+        plan = parse_plan(PLAN)
+
+        # Then
+        service = plan.resource('module.fastly.fastly_service_v1.fastly')
+        assert service.action == '+'
+        assert service.attributes['default_host'] == 'ci-www.domain.com'
+        assert service.attributes['domain.#'] == '1'
+        assert service.blocks['header']['222']['source'] == '"LHC"'
+        assert service.blocks['gzip']['55']['extensions.#'] == '2'
+        assert service.blocks['response_object']['9']['content'] == \
+            'User-agent: *\nDisallow: /\n'
+
+    def test_finds_blocks_by_attribute_values(self):
+        # Given
+        plan = parse_plan(PLAN)
+
+        # Then
+        assert plan.has_block(
+            'header',
+            action='delete',
+            destination='http.X-Powered-By',
+            source=COMPUTED,
+        )
+        assert not plan.has_block(
+            'header', action='delete', destination='http.Server'
+        )
+        assert plan.find_blocks('header', action='set') == [{
+            'action': 'set',
+            'destination': 'http.Server',
+            'source': '"LHC"',
+        }]
+        assert not plan.has_block('header', 'no.such.resource')
+
+    def test_updates_index_the_new_value(self):
+        # When
+        plan = parse_plan(PLAN)
+
+        # Then
+        redirection = plan.resource(
+            'module.fastly.fastly_service_v1.fastly_bare_domain_redirection'
+        )
+        assert redirection.action == '~'
+        assert redirection.attributes['name'] == 'new'
+        assert plan.has_block('backend', address='2.2.2.2')
+
+    def test_summary(self):
+        assert parse_plan(PLAN).summary == (1, 1, 0)
+
+    def test_template_patterns_are_memoised(self):
+        # Given
+        template = 'header.{ident}.action: "delete"'
+
+        # Then
+        assert template_to_re(template) is template_to_re(template)
+        assert compile_template(template) is compile_template(template)
+        assert compile_template(template).search(PLAN).group('ident') == \
+            '111'
@@ -0,0 +1,197 @@
+import io
+import json
+import threading
+import unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tools.purge import MAX_BATCH_SIZE, PurgeError, Purger, batches, main
+
+
+class StubFastly(ThreadingHTTPServer):
+    """
+    Answers batch purge requests, failing the first `failures` of them with
+    `failure_status` and `failure_body`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, failures=0, failure_status=503, retry_after=None,
+                 failure_body=b'{"msg": "nope"}'):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.failures = failures
+        self.failure_status = failure_status
+        self.failure_body = failure_body
+        self.retry_after = retry_after
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers), body))
+            server.connections.add(self.client_address)
+            fail = server.failures > 0
+            server.failures -= 1
+        if fail:
+            self.send_response(server.failure_status)
+            if server.retry_after:
+                self.send_header('Retry-After', server.retry_after)
+            content = server.failure_body
+        else:
+            keys = json.loads(body.decode('utf-8'))['surrogate_keys']
+            content = json.dumps({key: 'id-' + key for key in keys}).encode()
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TestPurge(unittest.TestCase):
+
+    def _server(self, **kwargs):
+        server = StubFastly(**kwargs)
+        thread = threading.Thread(
+            target=server.serve_forever, args=(0.01,), daemon=True
+        )
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _purger(self, server, **kwargs):
+        return Purger(
+            'service-1', 'secret', endpoint=server.endpoint, backoff=0.001,
+            **kwargs
+        )
+
+    def test_batches(self):
+        # When
+        result = list(batches(['a', 'b', ' a ', '', 'c\n', 'd'], 2))
+
+        # Then
+        assert result == [['a', 'b'], ['c', 'd']]
+
+    def test_batch_size_is_limited(self):
+        with self.assertRaises(PurgeError):
+            list(batches(['a'], MAX_BATCH_SIZE + 1))
+
+    def test_keys_are_purged_in_batches_over_pooled_connections(self):
+        # Given
+        server = self._server()
+        keys = ['key-{}'.format(i) for i in range(2000)]
+
+        # When
+        result = self._purger(server, concurrency=4).purge(keys)
+
+        # Then
+        assert result.failed == {}
+        assert (result.keys, result.batches) == (2000, 8)
+        assert (result.requests, result.retries) == (8, 0)
+        purged = []
+        for path, headers, body in server.requests:
+            assert path == '/service/service-1/purge'
+            assert headers['Fastly-Key'] == 'secret'
+            assert 'Fastly-Soft-Purge' not in headers
+            purged += json.loads(body.decode('utf-8'))['surrogate_keys']
+        assert sorted(purged) == sorted(keys)
+        assert len(server.connections) <= 4
+
+    def test_soft_purge(self):
+        # Given
+        server = self._server()
+
+        # When
+        self._purger(server, soft=True).purge(['a'])
+
+        # Then
+        [(_, headers, _)] = server.requests
+        assert headers['Fastly-Soft-Purge'] == '1'
+
+    def test_transient_failures_are_retried(self):
+        # Given
+        server = self._server(failures=2, failure_status=429, retry_after='0')
+
+        # When
+        result = self._purger(server, concurrency=1).purge(['a', 'b'])
+
+        # Then
+        assert result.failed == {}
+        assert (result.requests, result.retries) == (3, 2)
+
+    def test_keys_are_reported_failed_after_the_last_retry(self):
+        # Given
+        server = self._server(failures=3)
+
+        # When
+        result = self._purger(
+            server, concurrency=1, retries=2, batch_size=1
+        ).purge(['a', 'b'])
+
+        # Then
+        assert list(result.failed) == ['a']
+        assert result.failed['a'].startswith('HTTP 503')
+        assert result.requests == 4
+
+    def test_client_errors_are_not_retried(self):
+        # Given
+        server = self._server(failures=1, failure_status=403)
+
+        # When
+        result = self._purger(server).purge(['a'])
+
+        # Then
+        assert list(result.failed) == ['a']
+        assert result.requests == 1
+
+    def test_non_json_responses_fail_their_batch_only(self):
+        # Given
+        server = self._server(
+            failures=1, failure_status=200,
+            failure_body=b'<html>' + b'x' * 500 + b'</html>',
+        )
+
+        # When
+        result = self._purger(
+            server, concurrency=1, batch_size=1
+        ).purge(['a', 'b'])
+
+        # Then
+        assert list(result.failed) == ['a']
+        assert result.failed['a'].startswith('HTTP 200: <html>xxx')
+        assert len(result.failed['a']) < 250
+        assert result.requests == 2
+
+    def test_cli_reports_throughput(self):
+        # Given
+        server = self._server()
+        output = io.StringIO()
+
+        # When
+        with redirect_stdout(output):
+            status = main([
+                '--service-id', 'service-1', '--api-key', 'secret',
+                '--endpoint', server.endpoint, 'a', 'b', 'c',
+            ])
+
+        # Then
+        assert status == 0
+        assert output.getvalue().startswith(
+            '3 keys in 1 batches, 1 requests (0 retries) in '
+        )
+        assert 'keys/s' in output.getvalue()
@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+import unittest
+
+from tools.redirects import check, flatten, load, main, parse_lines, resolve
+
+
+class TestRedirects(unittest.TestCase):
+
+    def test_parse_lines(self):
+        # Given
+        lines = [
+            '# legacy section\n',
+            '/old,/new\n',
+            '/tab\t/new\n',
+            '/spaced   https://www.example.com/x#top  # comment\n',
+            '\n',
+            '/old,/other\n',
+            'nonsense\n',
+        ]
+
+        # When
+        redirects, problems = parse_lines(lines)
+
+        # Then
+        assert redirects == {
+            '/old': '/new', '/tab': '/new',
+            '/spaced': 'https://www.example.com/x#top',
+        }
+        assert [p.kind for p in problems] == ['duplicate', 'syntax']
+
+    def test_chains_resolve_to_the_final_target(self):
+        # Given
+        redirects = {
+            '/a': '/b', '/b': 'https://www.example.com/c?x=1',
+            '/c': 'https://elsewhere.com/d',
+        }
+
+        # When
+        final, looping = resolve(redirects, ['www.example.com'])
+
+        # Then
+        assert final['/a'] == ('https://elsewhere.com/d', 3)
+        assert final['/c'] == ('https://elsewhere.com/d', 1)
+        assert looping == set()
+
+    def test_other_hosts_are_not_followed(self):
+        # When
+        final, _ = resolve({'/a': 'https://other.com/b', '/b': '/c'})
+
+        # Then
+        assert final['/a'] == ('https://other.com/b', 1)
+
+    def test_loops_are_reported(self):
+        # Given
+        redirects = {'/a': '/b', '/b': '/a', '/c': '/a', '/d': '/d'}
+
+        # When
+        problems = check(redirects)
+
+        # Then
+        assert sorted(p.source for p in problems if p.kind == 'loop') == [
+            '/a', '/b', '/c', '/d'
+        ]
+
+    def test_check_reports_chains_and_bad_entries(self):
+        # Given
+        redirects = {'/a': '/b', '/b': '/c', 'b': '/x', '/q?x=1': '/y'}
+
+        # When
+        problems = check(redirects, max_items=3)
+
+        # Then
+        assert [(p.kind, p.source) for p in problems] == [
+            ('size', ''), ('source', 'b'), ('source', '/q?x=1'),
+            ('chain', '/a'),
+        ]
+
+    def test_flatten(self):
+        # Given
+        redirects = {'/a': '/b', '/b': '/c', '/x': '/y', '/y': '/x'}
+
+        # When
+        flat = flatten(redirects)
+
+        # Then
+        assert flat == {'/a': '/c', '/b': '/c', '/x': '/y', '/y': '/x'}
+        assert [p.kind for p in check(flat)] == ['loop', 'loop']
+
+    def test_large_maps(self):
+        # Given
+        redirects = {
+            '/old/{}'.format(i): '/old/{}'.format(i + 1)
+            for i in range(20000)
+        }
+
+        # When
+        final, looping = resolve(redirects)
+
+        # Then
+        assert final['/old/0'] == ('/old/20000', 20000)
+        assert not looping
+
+    def test_cli_writes_tfvars(self):
+        # Given
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, 'redirects.csv')
+        tfvars = os.path.join(directory, 'redirects.auto.tfvars.json')
+        with open(source, 'w') as f:
+            f.write('/a,/b\n/b,/c\n')
+
+        # When
+        status = main([source, '--flatten', '--tfvars', tfvars])
+
+        # Then
+        assert status == 0
+        with open(tfvars) as f:
+            assert json.load(f) == {'redirects': {'/a': '/c', '/b': '/c'}}
+        assert load(tfvars)[0] == {'/a': '/c', '/b': '/c'}
+
+    def test_cli_fails_on_chains(self):
+        # Given
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, 'redirects.json')
+        with open(source, 'w') as f:
+            json.dump({'/a': '/b', '/b': '/c'}, f)
+
+        # When
+        status = main([source, '--tfvars', os.path.join(directory, 'out')])
+
+        # Then
+        assert status == 1
+        assert not os.path.exists(os.path.join(directory, 'out'))
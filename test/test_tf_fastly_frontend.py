@@ -1,311 +1,432 @@
 import unittest
 import os
 import re
-from subprocess import check_call, check_output
 
-cwd = os.getcwd()
+from plan_cache import session
+from plan_parser import (
+    COMPUTED, compile_template, parse_plan, template_to_re
+)
 
-"""
-Takes a template (i.e. what you'd call `.format(...)` on, and returns a regex
-to to match it:
+cwd = os.getcwd()
 
-    print(re.match(
-        template_to_re("hello {name}"),
-        "hello world"
-    ).group("name"))
-    # prints "world"
 
-"""
+def plan_argv(target, *variables):
+    argv = ['terraform', 'plan']
+    for variable in variables:
+        argv += ['-var', variable]
+    return argv + [
+        '-target=module.{}'.format(target), '-no-color', 'test/infra'
+    ]
+
+
+DEFAULT_VARIABLES = (
+    'domain_name=www.domain.com',
+    'backend_address=1.1.1.1',
+    'env=ci',
+)
+
+# every distinct plan the tests below consume, so they can all be computed up
+# front in parallel
+PLANS = {
+    'default': plan_argv('fastly', *DEFAULT_VARIABLES),
+    'without_data': plan_argv(
+        'fastly', *DEFAULT_VARIABLES + ('run_data=false',)
+    ),
+    'bare_redirect': plan_argv(
+        'fastly',
+        'domain_name=www.domain.com',
+        'bare_redirect_domain_name=domain.com',
+        'backend_address=1.1.1.1',
+        'env=any',
+    ),
+    'disable_force_ssl': plan_argv(
+        'fastly_disable_force_ssl',
+        *DEFAULT_VARIABLES + ('force_ssl=false',)
+    ),
+    'custom_timeouts': plan_argv(
+        'fastly_custom_timeouts',
+        *DEFAULT_VARIABLES + (
+            'connect_timeout=12345',
+            'first_byte_timeout=54321',
+            'between_bytes_timeout=31337',
+        )
+    ),
+    'proxy_error_response': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + ('proxy_error_response=<html>error</html>',)
+    ),
+    'ssl_cert_hostname': plan_argv(
+        'fastly_ssl_cert_hostname',
+        *DEFAULT_VARIABLES + ('ssl_cert_hostname=test-hostname',)
+    ),
+    'set_shield': plan_argv(
+        'fastly_set_shield', *DEFAULT_VARIABLES + ('shield=test-shield',)
+    ),
+    'set_surrogate_key': plan_argv(
+        'fastly_set_surrogate_key',
+        *DEFAULT_VARIABLES + (
+            'surrogate_key_name=my-custom-surrogate-key',
+        )
+    ),
+    'override_host_disabled': plan_argv(
+        'fastly', *DEFAULT_VARIABLES + ('override_host=false',)
+    ),
+    'custom_ttls': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'default_ttl=300', 'fallback_ttl=86400',
+            'shield_fallback_ttl=604800',
+        )
+    ),
+    'custom_stale': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'stale_while_revalidate=30', 'stale_if_error=600'
+        )
+    ),
+    'querystring_strip': plan_argv(
+        'fastly', *DEFAULT_VARIABLES + ('querystring_strip=["ref","sid"]',)
+    ),
+    'querystring_allowlist': plan_argv(
+        'fastly', *DEFAULT_VARIABLES + ('querystring_allowlist=["page","q"]',)
+    ),
+    'querystring_normalised': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'querystring_strip=["utm_[a-z]+","gclid","fbclid"]',
+            'querystring_sort=true',
+        )
+    ),
+    'static_assets': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'static_extensions=["css","js"]',
+            'static_path_patterns=["^/assets/"]',
+            'preserve_cookies=["viewerror","consent"]',
+        )
+    ),
+    'no_static_assets': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'static_extensions=[]', 'preserve_cookies=[]'
+        )
+    ),
+    'multiple_backends': plan_argv(
+        'fastly_multiple_backends',
+        'domain_name=www.domain.com',
+        'backend_address=example.com',
+        'env=ci',
+        'director_type=hash',
+    ),
+    'multiple_backends_chash': plan_argv(
+        'fastly_multiple_backends',
+        'domain_name=www.domain.com',
+        'backend_address=example.com',
+        'env=ci',
+        'director_type=chash',
+    ),
+    'multiple_backends_bare_redirect': plan_argv(
+        'fastly_multiple_backends',
+        'domain_name=www.domain.com',
+        'bare_redirect_domain_name=domain.com',
+        'backend_address=example.com',
+        'env=ci',
+    ),
+    'custom_gzip': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'gzip_extensions=["css"]',
+            'gzip_content_types=["text/css","image/svg+xml"]',
+        )
+    ),
+    'prefer_brotli': plan_argv(
+        'fastly', *DEFAULT_VARIABLES + ('prefer_brotli=true',)
+    ),
+    'no_accept_encoding_normalisation': plan_argv(
+        'fastly', *DEFAULT_VARIABLES + ('normalise_accept_encoding=false',)
+    ),
+    'sampled_logging': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + ('log_profile=minimal', 'log_hit_sample_rate=10')
+    ),
+    'shield_origin_logging': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + ('log_shield_origin=true', 'log_profile=minimal')
+    ),
+    'ttl_policy': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + ('ttl_policy={"/assets/"="1d,7d", css="1h"}',)
+    ),
+    'redirects': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'redirects={"/old"="/new", "/legacy"="https://example.com/"}',
+            'redirect_status=302', 'redirect_preserve_querystring=true',
+        )
+    ),
+    'server_timing': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'server_timing=true',
+            'server_timing_clients=["10.0.0.0/8","192.0.2.1"]',
+        )
+    ),
+    'log_ttfb': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + ('log_ttfb=true', 'log_profile=standard')
+    ),
+    'rate_limit': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'rate_limit=block', 'rate_limit_writes=5',
+            'rate_limit_paths={"/login"="2"}', 'rate_limit_penalty=300',
+        )
+    ),
+    'regional_backends': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'regional_backends=[{name="us",region="^US-",'
+            'address="us.example.com"}]',
+        )
+    ),
+    'revalidate_no_cache': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + ('revalidate_no_cache=true',)
+    ),
+    'fallback_backend': plan_argv(
+        'fastly',
+        *DEFAULT_VARIABLES + (
+            'fallback_backend_address=mirror.s3.amazonaws.com',
+            'fallback_backend_host=mirror.s3.amazonaws.com',
+            'max_restarts=2',
+        )
+    ),
+}
 
 
-def template_to_re(t):
-    seen = dict()
+def set_values(element, attribute):
+    """
+    The values of a list or set attribute of a block element.
+    """
+    prefix = attribute + '.'
+    return {
+        value for key, value in element.items()
+        if key.startswith(prefix) and key != prefix + '#'
+    }
 
-    def pattern(placeholder, open_curly, close_curly, text, whitespace):
-        if text is not None:
-            return re.escape(text)
-        elif whitespace is not None:
-            return r'\s+'
-        elif open_curly is not None:
-            return r'\{'
-        elif close_curly is not None:
-            return r'\}'
-        elif seen.get(placeholder):
-            return '(?P={})'.format(placeholder)
-        else:
-            seen[placeholder] = True
-            return '(?P<{}>.*?)'.format(placeholder)
 
-    return "".join([
-        pattern(*match.groups())
-        for match in re.finditer(
-            r'{([\w_]+)}|(\{\{)|(\}\})|([^{}\s]+)|(\s+)', t
-        )
-    ])
+PLAN_ENV = {'FASTLY_API_KEY': 'qwerty'}
 
 
 class TestTFFastlyFrontend(unittest.TestCase):
 
-    def setUp(self):
-        check_call(['terraform', 'init', 'test/infra'])
-        check_call(['terraform', 'get', 'test/infra'])
+    @classmethod
+    def setUpClass(cls):
+        cls.plans = session(cwd)
+        cls.plans.prefetch(PLANS.values(), PLAN_ENV)
 
-    def _env_for_check_output(self, fastly_api_key):
-        env = os.environ.copy()
-        env.update({
-            'FASTLY_API_KEY': fastly_api_key
-        })
-        return env
+    def _plan(self, argv):
+        return self.plans.plan(argv, PLAN_ENV)
 
     def test_create_fastly_service(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'run_data=false',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['without_data'])
 
         # Then
-        assert re.search(template_to_re("""
-      domain.#:               "1"
-      domain.{ident}.comment: ""
-      domain.{ident}.name:    "ci-www.domain.com"
-        """.strip()), output)
+        plan = parse_plan(output)
+        assert plan.attribute('domain.#') == ['1']
+        assert plan.has_block(
+            'domain', comment='', name='ci-www.domain.com'
+        )
 
-        assert """
-Plan: 1 to add, 0 to change, 0 to destroy.
-        """.strip() in output
+        assert plan.summary == (1, 0, 0)
 
     def test_syslog_logging_config(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # Then
-        assert re.search(template_to_re("""
-        syslog.#:                                     "1"
-        syslog.{ident}.address:                     "intake.logs.datadoghq.com"
-          """.strip()), output)  # noqa
-
-        assert re.search("""
-        syslog.*.format:                     \" {  \\\\\"ddsource\\\\\": \\\\\"fastly\\\\\",  \\\\\"service\\\\\": \\\\\"%{req.http.host}V\\\\\"
-          """.strip(), output)  # noqa
-
-        assert re.search(template_to_re("""
-        condition.{ident}.name:                    "syslog-no-shield-condition"
-        condition.{ident}.priority:                "10"
-        condition.{ident}.statement:               "!req.http.Fastly-FF"
-        condition.{ident}.type:                    "RESPONSE"
-          """.strip()), output)  # noqa
+        plan = parse_plan(output)
+        assert plan.attribute('syslog.#') == ['3']
+        assert plan.has_block(
+            'syslog', name='ci-www.domain.com-syslog-shield-origin',
+            response_condition='syslog-shield-origin-condition',
+        )
+        assert plan.has_block(
+            'condition', name='syslog-shield-origin-condition',
+            statement='now.sec == ""',
+        )
+        assert plan.has_block('syslog', address='intake.logs.datadoghq.com')
 
-        assert re.search(template_to_re("""
-        syslog.{ident}.format_version:             "2"
-        syslog.{ident}.message_type:               "blank"
-        syslog.{ident}.name:                       "ci-www.domain.com-syslog"
-        syslog.{ident}.placement:                  ""
-        syslog.{ident}.port:                       "10516"
-        syslog.{ident}.response_condition:         "syslog-no-shield-condition"
-          """.strip()), output)  # noqa
+        [syslog] = plan.find_blocks(
+            'syslog', name='ci-www.domain.com-syslog'
+        )
+        assert ' {"ddsource":"fastly",' \
+            '"service":"%{json.escape(req.http.host)}V",' in syslog['format']
+
+        assert plan.has_block(
+            'condition',
+            name='syslog-no-shield-condition',
+            priority='10',
+            statement=(
+                '!req.http.Fastly-FF && '
+                '!(fastly_info.state ~ "^HIT($|-)" && resp.status < 500)'
+            ),
+            type='RESPONSE',
+        )
 
-        assert re.search(template_to_re("""
-        syslog.{ident}.response_condition:          "syslog-no-shield-condition"
-        syslog.{ident}.tls_ca_cert:                 ""
-        syslog.{ident}.tls_hostname:                "intake.logs.datadoghq.com"
-        syslog.{ident}.token:                       ""
-        syslog.{ident}.use_tls:                     "true"
-          """.strip()), output)  # noqa
+        assert plan.has_block(
+            'syslog',
+            format_version='2',
+            message_type='blank',
+            name='ci-www.domain.com-syslog',
+            placement='',
+            port='10516',
+            response_condition='syslog-no-shield-condition',
+            tls_ca_cert='',
+            tls_hostname='intake.logs.datadoghq.com',
+            token='',
+            use_tls='true',
+        )
 
     def test_create_fastly_service_creates_redirection(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'bare_redirect_domain_name=domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=any',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['bare_redirect'])
 
         # Then
         assert """
 + module.fastly.fastly_service_v1.fastly
         """.strip() in output
 
-        assert re.search(template_to_re("""
-      domain.#:               "1"
-      domain.{ident}.comment: ""
-      domain.{ident}.name:    "any-www.domain.com"
-        """.strip()), output)
+        plan = parse_plan(output)
+        service = 'module.fastly.fastly_service_v1.fastly'
+        assert plan.resource(service).attributes['domain.#'] == '1'
+        assert plan.has_block(
+            'domain', service, comment='', name='any-www.domain.com'
+        )
 
         assert """
 + module.fastly.fastly_service_v1.fastly_bare_domain_redirection
         """.strip() in output
 
-        assert re.search(template_to_re("""
-      header.{ident}.source: "\\"https://any-www.domain.com\\" + req.url"
-        """.strip()), output)  # noqa
+        assert plan.has_block(
+            'header',
+            'module.fastly.fastly_service_v1.fastly_bare_domain_redirection',
+            source='"https://any-www.domain.com" + req.url',
+        )
 
-        assert """
-Plan: 2 to add, 0 to change, 0 to destroy.
-        """.strip() in output
+        assert plan.summary == (2, 0, 0)
 
     def test_delete_x_powered_by_header(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # Then
-        assert re.search(template_to_re("""
-      header.{ident}.action:             "delete"
-      header.{ident}.cache_condition:    ""
-      header.{ident}.destination:        "http.X-Powered-By"
-      header.{ident}.ignore_if_set:      "false"
-      header.{ident}.name:               "Remove X-Powered-By header"
-      header.{ident}.priority:           "100"
-      header.{ident}.regex:              <computed>
-      header.{ident}.request_condition:  ""
-      header.{ident}.response_condition: ""
-      header.{ident}.source:             <computed>
-      header.{ident}.substitution:       <computed>
-      header.{ident}.type:               "cache"
-        """.strip()), output)
+        assert parse_plan(output).has_block(
+            'header',
+            action='delete',
+            cache_condition='',
+            destination='http.X-Powered-By',
+            ignore_if_set='false',
+            name='Remove X-Powered-By header',
+            priority='100',
+            regex=COMPUTED,
+            request_condition='',
+            response_condition='',
+            source=COMPUTED,
+            substitution=COMPUTED,
+            type='cache',
+        )
 
     def test_obfuscate_server_header(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-no-color',
-            '-target=module.fastly',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # Then
-        assert re.search(template_to_re("""
-      header.{ident}.action:             "set"
-      header.{ident}.cache_condition:    ""
-      header.{ident}.destination:        "http.Server"
-      header.{ident}.ignore_if_set:      "false"
-      header.{ident}.name:               "Obfuscate Server header"
-      header.{ident}.priority:           "100"
-      header.{ident}.regex:              <computed>
-      header.{ident}.request_condition:  ""
-      header.{ident}.response_condition: ""
-      header.{ident}.source:             "\\"LHC\\""
-      header.{ident}.substitution:       <computed>
-      header.{ident}.type:               "cache"
-        """.strip()), output)
+        assert parse_plan(output).has_block(
+            'header',
+            action='set',
+            cache_condition='',
+            destination='http.Server',
+            ignore_if_set='false',
+            name='Obfuscate Server header',
+            priority='100',
+            regex=COMPUTED,
+            request_condition='',
+            response_condition='',
+            source='"LHC"',
+            substitution=COMPUTED,
+            type='cache',
+        )
 
     def test_override_robots_for_non_live_environments(self):
         # given
 
         # when
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-no-color',
-            '-target=module.fastly',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # then
-        assert re.search(template_to_re("""
-      response_object.{ident}.cache_condition:   ""
-      response_object.{ident}.content:           "User-agent: *\\nDisallow: /\\n"
-      response_object.{ident}.content_type:      "text/plain"
-      response_object.{ident}.name:              "override-robots.txt"
-      response_object.{ident}.request_condition: "override-robots.txt-condition"
-      response_object.{ident}.response:          "OK"
-      response_object.{ident}.status:            "200"
-
-        """.strip()), output)  # noqa
+        plan = parse_plan(output)
+        assert plan.has_block(
+            'response_object',
+            cache_condition='',
+            content='User-agent: *\nDisallow: /\n',
+            content_type='text/plain',
+            name='override-robots.txt',
+            request_condition='override-robots.txt-condition',
+            response='OK',
+            status='200',
+        )
 
-        assert re.search(template_to_re("""
-      condition.{ident}.name:      "override-robots.txt-condition"
-      condition.{ident}.priority:  "5"
-      condition.{ident}.statement: "req.url ~ \\"^/robots.txt\\""
-      condition.{ident}.type:      "REQUEST"
-        """.strip()), output)  # noqa
+        assert plan.has_block(
+            'condition',
+            name='override-robots.txt-condition',
+            priority='5',
+            statement='req.url ~ "^/robots.txt"',
+            type='REQUEST',
+        )
 
     def test_force_ssl_enabled_by_default(self):
         # given
 
         # when
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-no-color',
-            '-target=module.fastly',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # then
-        assert re.search(template_to_re("""
-      request_setting.#:                         "1"
-      request_setting.{ident}.action:            ""
-      request_setting.{ident}.bypass_busy_wait:  "false"
-      request_setting.{ident}.default_host:      ""
-      request_setting.{ident}.force_miss:        ""
-      request_setting.{ident}.force_ssl:         "true"
-      request_setting.{ident}.geo_headers:       ""
-      request_setting.{ident}.hash_keys:         ""
-      request_setting.{ident}.max_stale_age:     ""
-      request_setting.{ident}.name:              "request-setting"
-      request_setting.{ident}.request_condition: ""
-      request_setting.{ident}.timer_support:     ""
-      request_setting.{ident}.xff:               "append"
-        """.strip()), output)  # noqa
+        plan = parse_plan(output)
+        assert plan.attribute('request_setting.#') == ['1']
+        assert plan.has_block(
+            'request_setting',
+            action='',
+            bypass_busy_wait='false',
+            default_host='',
+            force_miss='',
+            force_ssl='true',
+            geo_headers='',
+            hash_keys='',
+            max_stale_age='',
+            name='request-setting',
+            request_condition='',
+            timer_support='',
+            xff='append',
+        )
 
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_caching_enabled_by_default(self):
         # given
 
         # when
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -314,7 +435,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-no-color',
             '-target=module.fastly',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # then
         assert re.search(template_to_re("""
@@ -324,7 +445,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_disable_caching(self):
         # when
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -334,7 +455,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-no-color',
             '-target=module.fastly_disable_caching',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # then
         assert re.search(template_to_re("""
@@ -343,117 +464,72 @@ Plan: 2 to add, 0 to change, 0 to destroy.
 
     def test_disable_force_ssl(self):
         # when
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'force_ssl=false',
-            '-var', 'env=ci',
-            '-no-color',
-            '-target=module.fastly_disable_force_ssl',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['disable_force_ssl'])
 
         # then
-        assert re.search(template_to_re("""
-      request_setting.#:                            "1"
-      request_setting.{ident}.action:            ""
-      request_setting.{ident}.bypass_busy_wait:  "false"
-      request_setting.{ident}.default_host:      ""
-      request_setting.{ident}.force_miss:        ""
-      request_setting.{ident}.force_ssl:         "false"
-      request_setting.{ident}.geo_headers:       ""
-      request_setting.{ident}.hash_keys:         ""
-      request_setting.{ident}.max_stale_age:     ""
-      request_setting.{ident}.name:              "request-setting"
-      request_setting.{ident}.request_condition: ""
-      request_setting.{ident}.timer_support:     ""
-      request_setting.{ident}.xff:               "append"
-        """.strip()), output)  # noqa
+        plan = parse_plan(output)
+        assert plan.attribute('request_setting.#') == ['1']
+        assert plan.has_block(
+            'request_setting',
+            action='',
+            bypass_busy_wait='false',
+            default_host='',
+            force_miss='',
+            force_ssl='false',
+            geo_headers='',
+            hash_keys='',
+            max_stale_age='',
+            name='request-setting',
+            request_condition='',
+            timer_support='',
+            xff='append',
+        )
 
     def test_custom_timeouts(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'connect_timeout=12345',
-            '-var', 'first_byte_timeout=54321',
-            '-var', 'between_bytes_timeout=31337',
-            '-target=module.fastly_custom_timeouts',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['custom_timeouts'])
 
         # Then
-        assert re.search(template_to_re("""
-      backend.{ident}.between_bytes_timeout: "31337"
-      backend.{ident}.connect_timeout:       "12345"
-      backend.{ident}.error_threshold:       "0"
-      backend.{ident}.first_byte_timeout:    "54321"
-        """.strip()), output)
+        assert parse_plan(output).has_block(
+            'backend',
+            between_bytes_timeout='31337',
+            connect_timeout='12345',
+            error_threshold='0',
+            first_byte_timeout='54321',
+        )
 
     def test_502_error_condition_page(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'proxy_error_response=<html>error</html>',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['proxy_error_response'])
 
         # then
-        assert re.search(template_to_re("""
-      response_object.{ident}.content: "<html>error</html>"
-        """.strip()), output)
+        assert parse_plan(output).has_block(
+            'response_object', content='<html>error</html>'
+        )
 
     def test_503_error_condition_page(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'proxy_error_response=<html>error</html>',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['proxy_error_response'])
 
         # then
-        assert re.search(template_to_re("""
-      response_object.{ident}.content:           "<html>error</html>"
-        """.strip()), output)
+        assert parse_plan(output).has_block(
+            'response_object', content='<html>error</html>'
+        )
 
     def test_502_error_condition(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'proxy_error_response=<html>error</html>',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
-
-        assert re.search(template_to_re("""
-      condition.{ident}.name:      "response-502-condition"
-      condition.{ident}.priority:  "5"
-      condition.{ident}.statement: "beresp.status == 502 && req.http.Cookie:viewerror != \\"true\\""
-      condition.{ident}.type:      "CACHE"
-        """.strip()), output)  # noqa
+        output = self._plan(PLANS['proxy_error_response'])
+
+        assert parse_plan(output).has_block(
+            'condition',
+            name='response-502-condition',
+            priority='5',
+            statement=(
+                'beresp.status == 502 && '
+                'req.http.Cookie:viewerror != "true"'
+            ),
+            type='CACHE',
+        )
 
 # Fastly provider no longer hashes VCL
 #        assert re.search(template_to_re("""
@@ -464,65 +540,37 @@ Plan: 2 to add, 0 to change, 0 to destroy.
 
     def test_503_error_condition(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'proxy_error_response=<html>error</html>',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
-
-        assert re.search(template_to_re("""
-      condition.{ident}.name:      "response-503-condition"
-      condition.{ident}.priority:  "5"
-      condition.{ident}.statement: "beresp.status == 503 && req.http.Cookie:viewerror != \\"true\\""
-      condition.{ident}.type:      "CACHE"
-        """.strip()), output)  # noqa
+        output = self._plan(PLANS['proxy_error_response'])
+
+        assert parse_plan(output).has_block(
+            'condition',
+            name='response-503-condition',
+            priority='5',
+            statement=(
+                'beresp.status == 503 && '
+                'req.http.Cookie:viewerror != "true"'
+            ),
+            type='CACHE',
+        )
 
     def test_ssl_cert_hostname(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'ssl_cert_hostname=test-hostname',
-            '-target=module.fastly_ssl_cert_hostname',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['ssl_cert_hostname'])
 
-        assert re.search(template_to_re("""
-     backend.{ident}.ssl_cert_hostname: "test-hostname"
-        """.strip()), output)  # noqa
+        assert parse_plan(output).has_block(
+            'backend', ssl_cert_hostname='test-hostname'
+        )
 
     def test_use_ssl(self):
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'ssl_cert_hostname=test-hostname',
-            '-target=module.fastly_ssl_cert_hostname',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['ssl_cert_hostname'])
 
-        assert re.search(template_to_re("""
-     backend.{ident}.use_ssl: "true"
-        """.strip()), output)  # noqa
+        assert parse_plan(output).has_block('backend', use_ssl='true')
 
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_custom_vcl_backends_added(self):
         # Given When
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -532,7 +580,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-target=module.fastly',
             '-no-color',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # Then
         assert re.search(template_to_re("""
@@ -544,7 +592,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_custom_vcl_recv_added(self):
         # Given When
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -554,7 +602,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-target=module.fastly',
             '-no-color',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # Then
         assert re.search(template_to_re("""
@@ -566,7 +614,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_custom_vcl_recv_no_shield_added(self):
         # Given When
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -576,7 +624,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-target=module.fastly',
             '-no-color',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # Then
         assert re.search(template_to_re("""
@@ -588,7 +636,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_custom_vcl_recv_shield_only_added(self):
         # Given When
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -598,7 +646,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-target=module.fastly',
             '-no-color',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # Then
         assert re.search(template_to_re("""
@@ -610,7 +658,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_custom_vcl_error_added(self):
         # Given When
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -620,7 +668,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-target=module.fastly',
             '-no-color',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # Then
         assert re.search(template_to_re("""
@@ -633,120 +681,88 @@ Plan: 2 to add, 0 to change, 0 to destroy.
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # Then
-        assert re.search(r'backend.\d+.shield:\s+""', output)
+        assert parse_plan(output).has_block('backend', shield='')
 
     def test_shield_set(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'shield=test-shield',
-            '-target=module.fastly_set_shield',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['set_shield'])
 
         # Then
-        assert re.search(r'backend.\d+.shield:\s+"test-shield"', output)
+        assert parse_plan(output).has_block('backend', shield='test-shield')
 
     def test_default_surrogate_header(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-no-color',
-            '-target=module.fastly',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['default'])
 
         # Then
-        assert re.search(template_to_re("""
-      condition.{ident}.name:      "surrogate-key-condition"
-      condition.{ident}.priority:  "10"
-      condition.{ident}.statement: "beresp.http.default-surrogate-key != \\"\\""
-      condition.{ident}.type:      "CACHE"
-          """.strip()), output)  # noqa
+        plan = parse_plan(output)
+        assert plan.has_block(
+            'condition',
+            name='surrogate-key-condition',
+            priority='10',
+            statement='beresp.http.default-surrogate-key != ""',
+            type='CACHE',
+        )
 
-        assert re.search(template_to_re("""
-      header.{ident}.action:             "set"
-      header.{ident}.cache_condition:    "surrogate-key-condition"
-      header.{ident}.destination:        "http.Surrogate-Key"
-      header.{ident}.ignore_if_set:      "false"
-      header.{ident}.name:               "Surrogate Key to Amazon"
-      header.{ident}.priority:           "10"
-      header.{ident}.regex:              <computed>
-      header.{ident}.request_condition:  ""
-      header.{ident}.response_condition: ""
-      header.{ident}.source:             "beresp.http.default-surrogate-key"
-      header.{ident}.substitution:       <computed>
-      header.{ident}.type:               "cache"
-        """.strip()), output)
+        assert plan.has_block(
+            'header',
+            action='set',
+            cache_condition='surrogate-key-condition',
+            destination='http.Surrogate-Key',
+            ignore_if_set='false',
+            name='Surrogate Key to Amazon',
+            priority='10',
+            regex=COMPUTED,
+            request_condition='',
+            response_condition='',
+            source='beresp.http.default-surrogate-key',
+            substitution=COMPUTED,
+            type='cache',
+        )
 
     def test_custom_surrogate_header(self):
         # Given
 
         # When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'surrogate_key_name=my-custom-surrogate-key',
-            '-target=module.fastly_set_surrogate_key',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['set_surrogate_key'])
 
         # Then
-        assert re.search(template_to_re("""
-      condition.{ident}.name:      "surrogate-key-condition"
-      condition.{ident}.priority:  "10"
-      condition.{ident}.statement: "beresp.http.my-custom-surrogate-key != \\"\\""
-      condition.{ident}.type:      "CACHE"
-          """.strip()), output)  # noqa
+        plan = parse_plan(output)
+        assert plan.has_block(
+            'condition',
+            name='surrogate-key-condition',
+            priority='10',
+            statement='beresp.http.my-custom-surrogate-key != ""',
+            type='CACHE',
+        )
 
-        assert re.search(template_to_re("""
-      header.{ident}.action:             "set"
-      header.{ident}.cache_condition:    "surrogate-key-condition"
-      header.{ident}.destination:        "http.Surrogate-Key"
-      header.{ident}.ignore_if_set:      "false"
-      header.{ident}.name:               "Surrogate Key to Amazon"
-      header.{ident}.priority:           "10"
-      header.{ident}.regex:              <computed>
-      header.{ident}.request_condition:  ""
-      header.{ident}.response_condition: ""
-      header.{ident}.source:             "beresp.http.my-custom-surrogate-key"
-      header.{ident}.substitution:       <computed>
-      header.{ident}.type:               "cache"
-        """.strip()), output)
+        assert plan.has_block(
+            'header',
+            action='set',
+            cache_condition='surrogate-key-condition',
+            destination='http.Surrogate-Key',
+            ignore_if_set='false',
+            name='Surrogate Key to Amazon',
+            priority='10',
+            regex=COMPUTED,
+            request_condition='',
+            response_condition='',
+            source='beresp.http.my-custom-surrogate-key',
+            substitution=COMPUTED,
+            type='cache',
+        )
 
     @unittest.skip("Fastly provider no longer hashes the VCL content")
     def test_custom_vcl_deliver_added(self):
         # Given When
-        output = check_output([
+        output = self._plan([
             'terraform',
             'plan',
             '-var', 'domain_name=www.domain.com',
@@ -756,7 +772,7 @@ Plan: 2 to add, 0 to change, 0 to destroy.
             '-target=module.fastly',
             '-no-color',
             'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        ])
 
         # Then
         assert re.search(template_to_re("""
@@ -767,38 +783,526 @@ Plan: 2 to add, 0 to change, 0 to destroy.
 
     def test_explicit_default_host(self):
         # Given When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'override_host=false',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['override_host_disabled'])
 
         # Then
-        assert re.search(template_to_re("""
+        assert compile_template("""
         default_host: "ci-www.domain.com"
-        """.strip()), output)  # noqa
+        """.strip()).search(output)  # noqa
 
     def test_override_host_disabled(self):
         # Given When
-        output = check_output([
-            'terraform',
-            'plan',
-            '-var', 'domain_name=www.domain.com',
-            '-var', 'backend_address=1.1.1.1',
-            '-var', 'env=ci',
-            '-var', 'override_host=false',
-            '-target=module.fastly',
-            '-no-color',
-            'test/infra'
-        ], env=self._env_for_check_output('qwerty')).decode('utf-8')
+        output = self._plan(PLANS['override_host_disabled'])
 
         # Then
-        assert re.search(template_to_re("""
+        assert compile_template("""
         default_host: ""
-        """.strip()), output)  # noqa
+        """.strip()).search(output)  # noqa
+
+    def test_default_ttl(self):
+        # Given When
+        default = self._plan(PLANS['default'])
+        custom = self._plan(PLANS['custom_ttls'])
+
+        # Then
+        assert parse_plan(default).attribute('default_ttl') == ['60']
+        assert parse_plan(custom).attribute('default_ttl') == ['300']
+
+    def test_fallback_ttl(self):
+        # Given When
+        output = self._plan(PLANS['custom_ttls'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'set beresp.ttl = 86400s;' in vcl['content']
+
+    def test_shield_fallback_ttl(self):
+        # Given When
+        default = self._plan(PLANS['default'])
+        custom = self._plan(PLANS['custom_ttls'])
+
+        # Then
+        [vcl] = parse_plan(default).find_blocks('vcl', name='custom_vcl')
+        assert 'set beresp.http.Surrogate-Control = "max-age=3600";' \
+            in vcl['content']
+        [vcl] = parse_plan(custom).find_blocks('vcl', name='custom_vcl')
+        assert 'set beresp.ttl = 604800s;' in vcl['content']
+        assert 'set beresp.http.Surrogate-Control = "max-age=604800";' \
+            in vcl['content']
+        assert 'beresp.ttl > 86400s' in vcl['content']
+
+    def test_ttl_policy_dictionary(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['ttl_policy']))
+
+        # Then
+        assert default.has_block('dictionary', name='ttl_policy')
+        assert default.attribute('items.%') == []
+        [vcl] = default.find_blocks('vcl', name='custom_vcl')
+        assert 'set var.ttl_policy = table.lookup(ttl_policy, ' \
+            'req.url.ext, "");' in vcl['content']
+        assert custom.attribute('items.%') == ['2']
+        assert custom.attribute('items./assets/') == ['1d,7d']
+        assert custom.attribute('items.css') == ['1h']
+
+    def test_redirects_dictionary(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['redirects']))
+
+        # Then
+        assert default.has_block('dictionary', name='redirects')
+        assert custom.attribute('items./old') == ['/new']
+        assert custom.attribute('items./legacy') == ['https://example.com/']
+
+    def test_redirects_vcl(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['redirects']))
+
+        # Then
+        [vcl] = default.find_blocks('vcl', name='custom_vcl')
+        assert 'table.contains(redirects, req.url.path)' in vcl['content']
+        assert 'set obj.status = 301;' in vcl['content']
+        assert 'set obj.response = "Moved Permanently";' in vcl['content']
+        assert 'req.url.qs' not in vcl['content']
+        [vcl] = custom.find_blocks('vcl', name='custom_vcl')
+        assert 'set obj.status = 302;' in vcl['content']
+        assert 'set obj.response = "Found";' in vcl['content']
+        assert 'req.http.X-Redirect-Location "?" req.url.qs;' \
+            in vcl['content']
+
+    def test_stale_windows(self):
+        # Given When
+        output = self._plan(PLANS['custom_stale'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'set beresp.stale_while_revalidate = 30s;' in vcl['content']
+        assert 'set beresp.stale_if_error = 600s;' in vcl['content']
+        assert 'return(deliver_stale);' in vcl['content']
+
+    def test_querystring_normalisation(self):
+        # Given When
+        output = self._plan(PLANS['querystring_normalised'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'set req.url = querystring.regfilter(req.url, ' \
+            '"^(utm_[a-z]+|gclid|fbclid)$");' in vcl['content']
+        assert 'set req.url = querystring.sort(req.url);' in vcl['content']
+
+    def test_querystring_strip(self):
+        # Given When
+        output = self._plan(PLANS['querystring_strip'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'set req.url = querystring.regfilter(req.url, ' \
+            '"^(ref|sid)$");' in vcl['content']
+
+    def test_querystring_allowlist(self):
+        # Given When
+        output = self._plan(PLANS['querystring_allowlist'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'set req.url = querystring.regfilter_except(req.url, ' \
+            '"^(page|q)$");' in vcl['content']
+        assert 'querystring.regfilter(' not in vcl['content']
+        assert 'querystring.sort' not in vcl['content']
+
+    def test_querystring_untouched_by_default(self):
+        # Given When
+        output = self._plan(PLANS['default'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'querystring.' not in vcl['content']
+
+    def test_static_assets(self):
+        # Given When
+        output = self._plan(PLANS['static_assets'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        condition = 'if (req.url.ext ~ "(?i)^(css|js)$" || ' \
+            'req.url.path ~ "^/assets/") {'
+        assert vcl['content'].count(condition) == 2
+        assert '";(viewerror|consent)=", "; \\1="' in vcl['content']
+        assert 'unset beresp.http.Set-Cookie;' in vcl['content']
+
+    def test_no_static_assets(self):
+        # Given When
+        output = self._plan(PLANS['no_static_assets'])
+
+        # Then
+        [vcl] = parse_plan(output).find_blocks('vcl', name='custom_vcl')
+        assert 'if (req.url.ext ~ "(?!)" || req.url.path ~ "(?!)") {' \
+            in vcl['content']
+        assert '";((?!))=", "; \\1="' in vcl['content']
+
+    def test_single_backend_by_default(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['default']))
+
+        # Then
+        assert plan.has_block(
+            'backend', name='default backend', address='1.1.1.1',
+            port='443', healthcheck='',
+        )
+        assert not plan.find_blocks('healthcheck')
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'origin_director' not in vcl['content']
+
+    def test_multiple_backends(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['multiple_backends']))
+
+        # Then
+        assert plan.has_block(
+            'backend', name='default backend', address='eu.example.com',
+            shield='london-uk',
+        )
+        assert len(plan.find_blocks('backend')) == 1
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'backend backend_0 {\n  .host = "eu.example.com";\n' \
+            in vcl['content']
+        assert 'backend backend_1 {\n  .host = "us.example.com";\n' \
+            in vcl['content']
+        assert '  .ssl_check_cert = never;\n' in vcl['content']
+
+    def test_multiple_backends_healthchecks(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['multiple_backends']))
+
+        # Then
+        assert not plan.find_blocks('healthcheck')
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert '    .request = "HEAD / HTTP/1.1" ' \
+            '"Host: ci-www.domain.com" "Connection: close";\n' \
+            in vcl['content']
+        assert '    .request = "HEAD /health HTTP/1.1" ' \
+            '"Host: ci-www.domain.com" "Connection: close";\n' \
+            in vcl['content']
+
+    def test_multiple_backends_director(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['multiple_backends']))
+
+        # Then
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'director origin_director hash {\n  .quorum = 50%;\n  {' \
+            in vcl['content']
+        assert '.retries' not in vcl['content']
+        assert '{ .backend = backend_0; .weight = 200; }' in vcl['content']
+        assert '{ .backend = backend_1; .weight = 100; }' in vcl['content']
+        assert 'set req.backend = origin_director;' in vcl['content']
+
+    def test_multiple_backends_consistent_hashing_director(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['multiple_backends_chash']))
+
+        # Then
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'director origin_director chash {\n  .quorum = 50%;\n' \
+            '  .key = object;\n  .seed = 0;\n' in vcl['content']
+        assert '{ .backend = backend_0; .id = "backend_0"; }' \
+            in vcl['content']
+        assert '.weight' not in vcl['content']
+
+    def test_bare_redirect_uses_the_first_of_several_backends(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['multiple_backends_bare_redirect']))
+
+        # Then
+        assert plan.has_block(
+            'backend',
+            'module.fastly_multiple_backends.fastly_service_v1.'
+            'fastly_bare_domain_redirection',
+            name='default backend', address='eu.example.com',
+        )
+
+    def test_no_fallback_backend_by_default(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['default']))
+
+        # Then
+        assert not plan.find_blocks(
+            'condition', name='fallback-backend-condition'
+        )
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'fallback_backend' not in vcl['content']
+        assert 'if (req.restarts < 1 && (req.request == "GET" || ' \
+            'req.request == "HEAD")) {' in vcl['content']
+
+    def test_fallback_backend(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['fallback_backend']))
+
+        # Then
+        service = plan.resource('module.fastly.fastly_service_v1.fastly')
+        assert service.attributes['backend.#'] == '1'
+        assert plan.has_block('backend', name='default backend')
+        assert not plan.find_blocks(
+            'condition', name='fallback-backend-condition'
+        )
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'backend fallback_backend {\n' \
+            '  .host = "mirror.s3.amazonaws.com";\n' \
+            '  .port = "443";\n' \
+            '  .ssl = true;\n' \
+            '  .ssl_cert_hostname = "mirror.s3.amazonaws.com";\n' \
+            in vcl['content']
+
+    def test_fallback_backend_vcl(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['fallback_backend']))
+
+        # Then
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'set req.backend = fallback_backend;' in vcl['content']
+        assert 'set bereq.http.Host = "mirror.s3.amazonaws.com";' \
+            in vcl['content']
+        assert vcl['content'].count(
+            'if (req.restarts < 2 && (req.request == "GET" || '
+            'req.request == "HEAD")) {'
+        ) == 2
+
+    def test_regional_backends(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['regional_backends']))
+
+        # Then
+        assert not plan.has_block('backend', name='regional backend us')
+        assert plan.has_block('backend', name='default backend')
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'backend regional_backend_us {\n' \
+            '  .host = "us.example.com";\n' \
+            '  .port = "443";\n' in vcl['content']
+        assert 'if (server.region ~ "^US-") {\n' \
+            '      set req.http.X-Origin-Region = "us";\n' in vcl['content']
+        assert 'if (req.http.X-Origin-Region == "us") {\n' \
+            '      set req.backend = regional_backend_us;\n' in vcl['content']
+
+    def test_revalidate_no_cache(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['revalidate_no_cache']))
+
+        # Then
+        [vcl] = default.find_blocks('vcl', name='custom_vcl')
+        assert 'REVALIDATE' not in vcl['content']
+        [vcl] = custom.find_blocks('vcl', name='custom_vcl')
+        assert 'if (beresp.status < 500 && ' \
+            'beresp.http.Cache-Control ~ "no-cache" && ' in vcl['content']
+        assert 'beresp.http.Cache-Control !~ "private|no-store" && ' \
+            '(beresp.http.ETag || beresp.http.Last-Modified)) {' \
+            in vcl['content']
+        assert 'set beresp.grace = 86400s;\n' in vcl['content']
+        assert 'set beresp.stale_if_error = 0s;\n' \
+            '    return(deliver);' in vcl['content']
+
+    def test_restarts_and_backend_are_logged(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['default']))
+
+        # Then
+        [syslog] = plan.find_blocks('syslog', name='ci-www.domain.com-syslog')
+        assert '"restarts":%{req.restarts}V,' in syslog['format']
+        assert '"backend":"%{json.escape(req.backend.name)}V",' \
+            in syslog['format']
+
+    def test_server_timing(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['server_timing']))
+
+        # Then
+        [vcl] = default.find_blocks('vcl', name='custom_vcl')
+        assert 'X-Edge-TTFB = ' not in vcl['content']
+        assert 'X-Fetch-Start = ' not in vcl['content']
+        assert 'resp.http.Server-Timing' not in vcl['content']
+        [vcl] = custom.find_blocks('vcl', name='custom_vcl')
+        assert 'set req.http.X-Edge-TTFB = time.elapsed.msec;' \
+            in vcl['content']
+        assert vcl['content'].count(
+            'set req.http.X-Fetch-Start = time.elapsed.msec;'
+        ) == 2
+        assert '", origin;dur=" req.http.X-Origin-TTFB;' in vcl['content']
+        assert 'acl server_timing_clients {\n' \
+            '  "10.0.0.0"/8;\n' \
+            '  "192.0.2.1";\n' \
+            '}\n' in vcl['content']
+        assert 'client.ip !~ server_timing_clients' in vcl['content']
+
+    def test_timings_are_logged(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['log_ttfb']))
+
+        # Then
+        [syslog] = default.find_blocks(
+            'syslog', name='ci-www.domain.com-syslog'
+        )
+        assert '"cache_hits":%{obj.hits}V,' in syslog['format']
+        assert 'ttfb_ms' not in syslog['format']
+        [vcl] = custom.find_blocks('vcl', name='custom_vcl')
+        assert 'set req.http.X-Origin-TTFB = var.origin_ttfb;' \
+            in vcl['content']
+        for name in ('-syslog', '-syslog-sampled-hits'):
+            [syslog] = custom.find_blocks(
+                'syslog', name='ci-www.domain.com' + name
+            )
+            assert '"origin_ttfb_ms":%{if(req.http.X-Origin-TTFB ~ ' \
+                in syslog['format']
+            assert '"edge_ttfb_ms":' in syslog['format']
+
+    def test_rate_limit(self):
+        # Given When
+        default = parse_plan(self._plan(PLANS['default']))
+        custom = parse_plan(self._plan(PLANS['rate_limit']))
+
+        # Then
+        [vcl] = default.find_blocks('vcl', name='custom_vcl')
+        assert 'ratelimit.' not in vcl['content']
+        [vcl] = custom.find_blocks('vcl', name='custom_vcl')
+        assert 'ratecounter rate_limit_counter {}\n' in vcl['content']
+        assert 'set req.http.X-Rate-Limit-Max = "5";' in vcl['content']
+        assert 'if (std.prefixof(req.url.path, "/login")) {' \
+            in vcl['content']
+        assert 'std.atoi(req.http.X-Rate-Limit-Max), ' \
+            'rate_limit_penaltybox, 300s)) {' in vcl['content']
+        assert 'set obj.status = 429;' in vcl['content']
+        [syslog] = custom.find_blocks(
+            'syslog', name='ci-www.domain.com-syslog'
+        )
+        assert '"rate_limit":"%{json.escape(req.http.X-Rate-Limit)}V",' \
+            in syslog['format']
+
+    def test_gzip_defaults(self):
+        # Given When
+        [gzip] = parse_plan(self._plan(PLANS['default'])).find_blocks('gzip')
+
+        # Then
+        assert {'css', 'js', 'json', 'map', 'svg', 'xml', 'ttf'} <= \
+            set_values(gzip, 'extensions')
+        assert {
+            'text/html', 'application/javascript', 'application/json',
+            'image/svg+xml', 'application/xml', 'font/ttf',
+        } <= set_values(gzip, 'content_types')
+
+    def test_gzip_custom(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['custom_gzip']))
+
+        # Then
+        [gzip] = plan.find_blocks('gzip')
+        assert set_values(gzip, 'extensions') == {'css'}
+        assert set_values(gzip, 'content_types') == {
+            'text/css', 'image/svg+xml'
+        }
+
+    def test_accept_encoding_normalised_to_gzip_by_default(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['default']))
+
+        # Then
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'set req.http.Accept-Encoding = "gzip";' in vcl['content']
+        assert 'set req.http.Accept-Encoding = "br";' not in vcl['content']
+
+    def test_accept_encoding_prefers_brotli(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['prefer_brotli']))
+
+        # Then
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'if (req.http.Accept-Encoding ~ "br") {\n' \
+            '      set req.http.Accept-Encoding = "br";\n' \
+            '    } elsif (req.http.Accept-Encoding ~ "gzip") {' \
+            in vcl['content']
+
+    def test_accept_encoding_left_alone(self):
+        # Given When
+        output = self._plan(PLANS['no_accept_encoding_normalisation'])
+        plan = parse_plan(output)
+
+        # Then
+        [vcl] = plan.find_blocks('vcl', name='custom_vcl')
+        assert 'Accept-Encoding' not in vcl['content']
+
+    def test_every_hit_is_logged_by_default(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['default']))
+
+        # Then
+        assert plan.has_block(
+            'condition',
+            name='syslog-sampled-hits-condition',
+            priority='10',
+            statement=(
+                '!req.http.Fastly-FF && '
+                'fastly_info.state ~ "^HIT($|-)" && resp.status < 500 && '
+                'randombool(1, 1)'
+            ),
+            type='RESPONSE',
+        )
+        [hits] = plan.find_blocks(
+            'syslog', name='ci-www.domain.com-syslog-sampled-hits'
+        )
+        assert hits['response_condition'] == 'syslog-sampled-hits-condition'
+        assert '"sample_rate":1,' in hits['format']
+        assert 'socket_tcpi_rtt' in hits['format']
+
+    def test_shield_origin_logging(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['shield_origin_logging']))
+
+        # Then
+        assert plan.attribute('syslog.#') == ['3']
+        assert plan.has_block(
+            'condition', name='syslog-shield-origin-condition',
+            priority='10', type='RESPONSE',
+            statement=(
+                'req.http.Fastly-FF && '
+                'fastly_info.state ~ "^(MISS|PASS|HITPASS)"'
+            ),
+        )
+        [origin] = plan.find_blocks(
+            'syslog', name='ci-www.domain.com-syslog-shield-origin'
+        )
+        assert origin['response_condition'] == \
+            'syslog-shield-origin-condition'
+        assert origin['address'] == 'intake.logs.datadoghq.com'
+        assert origin['use_tls'] == 'true'
+        assert ' {"ddsource":"fastly",' in origin['format']
+        assert '"log_stream":"origin","sample_rate":1}' in origin['format']
+        assert '"backend":"%{json.escape(req.backend.name)}V",' \
+            in origin['format']
+        assert 'req.url' not in origin['format']
+
+    def test_sampled_hits_and_log_profile(self):
+        # Given When
+        plan = parse_plan(self._plan(PLANS['sampled_logging']))
+
+        # Then
+        assert plan.has_block(
+            'condition',
+            name='syslog-sampled-hits-condition',
+            statement=(
+                '!req.http.Fastly-FF && '
+                'fastly_info.state ~ "^HIT($|-)" && resp.status < 500 && '
+                'randombool(1, 10)'
+            ),
+        )
+        [hits] = plan.find_blocks(
+            'syslog', name='ci-www.domain.com-syslog-sampled-hits'
+        )
+        [rest] = plan.find_blocks('syslog', name='ci-www.domain.com-syslog')
+        assert '"sample_rate":10}' in hits['format']
+        assert '"sample_rate":1}' in rest['format']
+        assert '"cache_state"' in hits['format']
+        assert 'socket_tcpi_rtt' not in hits['format']
+        assert 'socket_tcpi_rtt' in rest['format']
@@ -0,0 +1,777 @@
+import unittest
+
+from tools.vcl_engine import Engine, Program, Request, Response, VCLError
+from tools.vcl_template import dictionaries, render
+
+
+class Origin(object):
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, bereq):
+        self.requests.append(bereq)
+        response = self.responses[min(
+            len(self.requests), len(self.responses)
+        ) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def engine_for(origin, **variables):
+    return Engine(
+        Program(render(variables)), origin, tables=dictionaries(variables)
+    )
+
+
+class TestVCLEngine(unittest.TestCase):
+
+    def test_second_request_is_a_hit(self):
+        # Given
+        origin = Origin(Response(200, body_size=100))
+        engine = engine_for(origin)
+
+        # When
+        first = engine.handle(Request('GET', '/page'))
+        second = engine.handle(Request('GET', '/page'))
+
+        # Then
+        assert (first.state, second.state) == ('MISS', 'HIT')
+        assert len(origin.requests) == 1
+        assert engine.stats['bytes_from_cache'] == 100
+        assert engine.hit_ratio() == 0.5
+
+    def test_non_get_requests_are_passed(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(origin)
+
+        # When
+        results = [engine.handle(Request('POST', '/form')) for _ in range(2)]
+
+        # Then
+        assert [r.state for r in results] == ['PASS', 'PASS']
+        assert len(origin.requests) == 2
+
+    def test_disable_caching_passes_everything(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(origin, caching='false')
+
+        # When
+        results = [engine.handle(Request('GET', '/page')) for _ in range(2)]
+
+        # Then
+        assert [r.state for r in results] == ['PASS', 'PASS']
+
+    def test_set_cookie_responses_become_hit_for_pass(self):
+        # Given
+        origin = Origin(Response(200, {'Set-Cookie': 'session=1'}))
+        engine = engine_for(origin)
+
+        # When
+        results = [engine.handle(Request('GET', '/account')) for _ in range(2)]
+
+        # Then
+        assert [r.state for r in results] == ['MISS', 'HITPASS']
+        assert len(origin.requests) == 2
+
+    def test_private_responses_are_not_cached(self):
+        # Given
+        origin = Origin(Response(200, {'Cache-Control': 'private'}))
+        engine = engine_for(origin)
+
+        # When
+        engine.handle(Request('GET', '/me'))
+        engine.handle(Request('GET', '/me'))
+
+        # Then
+        assert len(origin.requests) == 2
+
+    def test_default_ttl_applies_without_caching_headers(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(origin, stale_while_revalidate='0')
+
+        # When
+        engine.handle(Request('GET', '/page'), now=0)
+        cached = engine.handle(Request('GET', '/page'), now=3599)
+        expired = engine.handle(Request('GET', '/page'), now=3600)
+
+        # Then
+        assert (cached.state, expired.state) == ('HIT', 'MISS')
+
+    def test_origin_max_age_is_respected(self):
+        # Given
+        origin = Origin(Response(200, {'Cache-Control': 'max-age=10'}))
+        engine = engine_for(origin, stale_while_revalidate='0')
+
+        # When
+        engine.handle(Request('GET', '/page'), now=0)
+        expired = engine.handle(Request('GET', '/page'), now=10)
+
+        # Then
+        assert expired.state == 'MISS'
+
+    def _edge_and_shield(self, origin, **variables):
+        shield = engine_for(origin, stale_while_revalidate='0', **variables)
+
+        def via_shield(bereq):
+            result = shield.handle(Request(
+                bereq.method, bereq.url, dict(bereq.http, **{
+                    'Fastly-FF': 'cache-lhr1',
+                })
+            ), now=edge.now)
+            return Response(result.status, result.headers, result.body_size)
+
+        edge = engine_for(via_shield, stale_while_revalidate='0', **variables)
+        return edge, shield
+
+    def test_shield_fallback_ttl_applies_on_shield_nodes(self):
+        # Given
+        origin = Origin(Response(200))
+        edge, shield = self._edge_and_shield(
+            origin, fallback_ttl='60', shield_fallback_ttl='3600'
+        )
+
+        # When
+        edge.handle(Request('GET', '/page'), now=0)
+        refreshed = edge.handle(Request('GET', '/page'), now=60)
+
+        # Then
+        assert refreshed.state == 'MISS'
+        assert len(origin.requests) == 1
+        assert shield.stats['hits'] == 1
+
+    def test_surrogate_control_only_applies_on_shield_nodes(self):
+        # Given
+        origin = Origin(Response(200, {
+            'Surrogate-Control': 'max-age=86400',
+            'Cache-Control': 'max-age=60',
+        }))
+        edge, shield = self._edge_and_shield(origin, fallback_ttl='300')
+
+        # When
+        first = edge.handle(Request('GET', '/page'), now=0)
+        cached = edge.handle(Request('GET', '/page'), now=299)
+        refreshed = edge.handle(Request('GET', '/page'), now=300)
+        later = edge.handle(Request('GET', '/page'), now=80000)
+
+        # Then
+        assert first.headers['surrogate-control'] == 'max-age=300'
+        assert (cached.state, refreshed.state, later.state) == (
+            'HIT', 'MISS', 'MISS'
+        )
+        assert len(origin.requests) == 1
+
+    def test_short_surrogate_control_reaches_edges_unchanged(self):
+        # Given
+        origin = Origin(Response(200, {'Surrogate-Control': 'max-age=30'}))
+        edge, _ = self._edge_and_shield(origin, fallback_ttl='300')
+
+        # When
+        first = edge.handle(Request('GET', '/page'), now=0)
+        refreshed = edge.handle(Request('GET', '/page'), now=30)
+
+        # Then
+        assert first.headers['surrogate-control'] == 'max-age=30'
+        assert refreshed.state == 'MISS'
+        assert len(origin.requests) == 2
+
+    def test_ttl_policy_overrides_caching_headers(self):
+        # Given
+        origin = Origin(Response(200, {'Cache-Control': 'max-age=10'}))
+        engine = engine_for(
+            origin, stale_while_revalidate='0',
+            ttl_policy={'/assets/': '1h', 'css': '1d', '/a/b/': '60,600'},
+        )
+
+        # When
+        engine.handle(Request('GET', '/assets/app.css'), now=0)
+        engine.handle(Request('GET', '/static/app.css'), now=0)
+        engine.handle(Request('GET', '/a/b/page'), now=0)
+        engine.handle(Request('GET', '/a/page'), now=0)
+
+        # Then
+        assert engine.cache[('', '/assets/app.css')].ttl == 3600
+        assert engine.cache[('', '/static/app.css')].ttl == 86400
+        policy = engine.cache[('', '/a/b/page')]
+        assert (policy.ttl, policy.grace) == (60, 600)
+        assert engine.cache[('', '/a/page')].ttl == 10
+
+    def test_redirects_are_answered_without_the_backend(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(origin, redirects={
+            '/old': '/new', '/gone': 'https://www.example.com/x?a=1',
+        })
+
+        # When
+        old = engine.handle(Request('GET', '/old?utm_source=x'))
+        gone = engine.handle(Request('HEAD', '/gone'))
+        post = engine.handle(Request('POST', '/old'))
+
+        # Then
+        assert (old.status, old.headers['location']) == (301, '/new')
+        assert gone.headers['location'] == 'https://www.example.com/x?a=1'
+        assert post.status == 200
+        assert len(origin.requests) == 1
+
+    def test_redirects_can_keep_the_query_string(self):
+        # Given
+        engine = engine_for(
+            Origin(Response(200)), redirect_status='302',
+            redirect_preserve_querystring='true',
+            redirects={'/a': '/b', '/c': '/d?x=1'},
+        )
+
+        # When
+        a = engine.handle(Request('GET', '/a?q=1'))
+        c = engine.handle(Request('GET', '/c?q=1'))
+        bare = engine.handle(Request('GET', '/a'))
+
+        # Then
+        assert (a.status, a.headers['location']) == (302, '/b?q=1')
+        assert c.headers['location'] == '/d?x=1&q=1'
+        assert bare.headers['location'] == '/b'
+
+    def test_origin_503_restarts_once(self):
+        # Given
+        origin = Origin(Response(503), Response(200))
+        engine = engine_for(origin)
+
+        # When
+        result = engine.handle(Request('GET', '/page'))
+
+        # Then
+        assert result.status == 200
+        assert result.restarts == 1
+        assert result.headers['fastly-restarts'] == '1'
+        assert len(origin.requests) == 2
+
+    def test_backend_failure_serves_proxy_error_response(self):
+        # Given
+        origin = Origin(ConnectionError())
+        engine = engine_for(origin, proxy_error_response='<p>down</p>')
+
+        # When
+        result = engine.handle(Request('GET', '/page'))
+
+        # Then
+        assert (result.status, result.state) == (503, 'ERROR')
+        assert result.body == '<p>down</p>'
+
+    def test_custom_vcl_recv_hooks_run_per_node_role(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin,
+            custom_vcl_recv_no_shield='set req.http.X-Edge = "1";',
+            custom_vcl_recv_shield_only='set req.http.X-Shield = "1";',
+        )
+
+        # When
+        engine.handle(Request('POST', '/', {'X-Forwarded-For': '1.2.3.4'}))
+        engine.handle(Request('POST', '/', {'Fastly-FF': 'cache-lhr1'}))
+
+        # Then
+        edge, shield = origin.requests
+        assert 'x-edge' in edge.http and 'x-shield' not in edge.http
+        assert 'x-shield' in shield.http and 'x-edge' not in shield.http
+
+    def test_unsupported_vcl_is_rejected(self):
+        with self.assertRaises(VCLError):
+            Program('sub vcl_recv { frobnicate; }')
+
+    def test_stale_while_revalidate_serves_the_expired_object(self):
+        # Given
+        origin = Origin(
+            Response(200, {'Cache-Control': 'max-age=10'}, body_size=1),
+            Response(200, {'Cache-Control': 'max-age=10'}, body_size=2),
+        )
+        engine = engine_for(origin, stale_while_revalidate='30')
+
+        # When
+        engine.handle(Request('GET', '/page'), now=0)
+        stale = engine.handle(Request('GET', '/page'), now=15)
+        fresh = engine.handle(Request('GET', '/page'), now=16)
+
+        # Then
+        assert (stale.state, stale.body_size) == ('HIT-STALE', 1)
+        assert (fresh.state, fresh.body_size) == ('HIT', 2)
+        assert len(origin.requests) == 2
+
+    def test_stale_if_error_replaces_origin_errors(self):
+        # Given
+        origin = Origin(
+            Response(200, {'Cache-Control': 'max-age=10'}),
+            Response(503),
+        )
+        engine = engine_for(
+            origin, stale_while_revalidate='0', stale_if_error='600'
+        )
+
+        # When
+        engine.handle(Request('GET', '/page'), now=0)
+        result = engine.handle(Request('GET', '/page'), now=100)
+
+        # Then
+        assert (result.status, result.state) == (200, 'STALE')
+        assert result.restarts == 0
+        assert len(origin.requests) == 2
+
+    def test_stale_if_error_covers_failed_connections(self):
+        # Given
+        origin = Origin(
+            Response(200, {'Cache-Control': 'max-age=10'}),
+            ConnectionError(),
+        )
+        engine = engine_for(
+            origin, stale_while_revalidate='0', stale_if_error='600'
+        )
+
+        # When
+        engine.handle(Request('GET', '/page'), now=0)
+        within = engine.handle(Request('GET', '/page'), now=100)
+        beyond = engine.handle(Request('GET', '/page'), now=700)
+
+        # Then
+        assert (within.status, within.state) == (200, 'STALE')
+        assert (beyond.status, beyond.state) == (503, 'ERROR')
+
+    def test_tracking_parameters_are_stripped_from_the_cache_key(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, querystring_strip=['utm_[a-z]+', 'gclid'],
+            querystring_sort='true'
+        )
+
+        # When
+        engine.handle(Request('GET', '/page?b=2&a=1&utm_source=x'))
+        result = engine.handle(Request('GET', '/page?gclid=y&a=1&b=2'))
+
+        # Then
+        assert result.state == 'HIT'
+        assert origin.requests[0].url == '/page?a=1&b=2'
+
+    def test_querystring_allowlist_drops_other_parameters(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, querystring_allowlist=['page']
+        )
+
+        # When
+        engine.handle(Request('GET', '/list?q=1&page=2&sort=x'))
+
+        # Then
+        assert origin.requests[0].url == '/list?page=2'
+
+    def test_static_assets_are_cached_despite_cookies(self):
+        # Given
+        origin = Origin(Response(200, {'Set-Cookie': 'tracking=1'}))
+        engine = engine_for(origin, static_extensions=['css', 'js'])
+        cookie = {'Cookie': '_ga=GA1.2; viewerror=true; session=abc'}
+
+        # When
+        first = engine.handle(Request('GET', '/app.CSS', cookie))
+        second = engine.handle(Request('GET', '/app.CSS', cookie))
+
+        # Then
+        assert (first.state, second.state) == ('MISS', 'HIT')
+        assert 'set-cookie' not in second.headers
+        assert origin.requests[0].http['cookie'] == 'viewerror=true'
+
+    def test_static_assets_keep_their_cookies_by_default(self):
+        # Given
+        origin = Origin(Response(200, {'Set-Cookie': 'tracking=1'}))
+        engine = engine_for(origin)
+        cookie = {'Cookie': '_ga=GA1.2; session=abc'}
+
+        # When
+        first = engine.handle(Request('GET', '/pixel.gif', cookie))
+        second = engine.handle(Request('GET', '/pixel.gif', cookie))
+
+        # Then
+        assert (first.state, second.state) == ('MISS', 'HITPASS')
+        assert first.headers['set-cookie'] == 'tracking=1'
+        assert origin.requests[0].http['cookie'] == '_ga=GA1.2; session=abc'
+
+    def test_static_path_patterns_strip_all_cookies(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, static_path_patterns=['^/static/'], preserve_cookies=[]
+        )
+
+        # When
+        engine.handle(Request('GET', '/static/x', {'Cookie': 'viewerror=1'}))
+        engine.handle(Request('GET', '/page', {'Cookie': 'viewerror=1'}))
+
+        # Then
+        static, page = origin.requests
+        assert 'cookie' not in static.http
+        assert page.http['cookie'] == 'viewerror=1'
+
+    def test_requests_go_to_the_director_for_several_backends(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, backends=[{'address': 'a'}, {'address': 'b'}],
+            env='live', domain_name='www.example.com',
+        )
+
+        # When
+        result = engine.handle(Request('GET', '/'))
+
+        # Then
+        assert result.backend == 'origin_director'
+
+    def _failover_engine(self, primary, **variables):
+        fallback = Origin(Response(200, body_size=10))
+
+        def origin(bereq):
+            if engine.last_backend == 'fallback_backend':
+                return fallback(bereq)
+            return primary(bereq)
+
+        engine = engine_for(
+            origin, fallback_backend_address='mirror.example.com',
+            **variables
+        )
+        return engine, fallback
+
+    def test_origin_5xx_fails_over_to_the_fallback_backend(self):
+        # Given
+        primary = Origin(Response(503))
+        engine, fallback = self._failover_engine(
+            primary, fallback_backend_host='mirror.s3.amazonaws.com'
+        )
+
+        # When
+        result = engine.handle(Request('GET', '/page', {'Host': 'a.com'}))
+        cached = engine.handle(Request('GET', '/page', {'Host': 'a.com'}))
+
+        # Then
+        assert (result.status, result.restarts) == (200, 1)
+        assert result.backend == 'fallback_backend'
+        assert result.headers['fastly-restarts'] == '1'
+        assert len(primary.requests) == len(fallback.requests) == 1
+        assert fallback.requests[0].http['host'] == 'mirror.s3.amazonaws.com'
+        assert cached.state == 'HIT'
+
+    def test_unreachable_origin_fails_over_to_the_fallback_backend(self):
+        # Given
+        primary = Origin(ConnectionError())
+        engine, fallback = self._failover_engine(primary)
+
+        # When
+        result = engine.handle(Request('GET', '/page', {'Host': 'a.com'}))
+
+        # Then
+        assert (result.status, result.restarts) == (200, 1)
+        assert fallback.requests[0].http['host'] == 'a.com'
+
+    def test_restarts_are_limited_by_max_restarts(self):
+        # Given
+        origin = Origin(Response(503))
+        engine = engine_for(
+            origin, max_restarts='2', stale_if_error='0',
+            proxy_error_response='down',
+        )
+
+        # When
+        result = engine.handle(Request('GET', '/page'))
+
+        # Then
+        assert result.restarts == 2
+        assert len(origin.requests) == 3
+
+    def test_server_timing_breaks_down_the_response_time(self):
+        # Given
+        origin = Origin(
+            Response(200, {'Server-Timing': 'db;dur=3'}, latency=0.05)
+        )
+        engine = engine_for(origin, server_timing='true')
+
+        # When
+        miss = engine.handle(Request('GET', '/page'))
+        hit = engine.handle(Request('GET', '/page'))
+        shield = engine.handle(Request('GET', '/page', {'Fastly-FF': 'x'}))
+
+        # Then
+        assert miss.headers['server-timing'] == \
+            'db;dur=3, edge;dur=50, origin;dur=50, cache;desc=MISS'
+        assert hit.headers['server-timing'] == \
+            'db;dur=3, edge;dur=0, cache;desc=HIT'
+        assert shield.headers['server-timing'] == 'db;dur=3'
+
+    def test_server_timing_can_be_limited_to_internal_clients(self):
+        # Given
+        origin = Origin(Response(200, {'Server-Timing': 'db;dur=3'}))
+        engine = engine_for(
+            origin, server_timing='true',
+            server_timing_clients=['10.0.0.0/8', '192.0.2.1'],
+        )
+
+        # When
+        results = [
+            engine.handle(Request('GET', '/page', client={'ip': ip}))
+            for ip in ('10.1.2.3', '192.0.2.1', '198.51.100.1')
+        ]
+
+        # Then
+        assert [
+            r.headers.get('server-timing', '').split(', ')[-1]
+            for r in results
+        ] == ['cache;desc=MISS', 'cache;desc=HIT', '']
+
+    def test_accept_encoding_is_normalised(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(origin, prefer_brotli='true')
+
+        # When
+        for i, accept_encoding in enumerate(('gzip, br', 'gzip', 'identity')):
+            engine.handle(Request(
+                'GET', '/{}'.format(i), {'Accept-Encoding': accept_encoding}
+            ))
+
+        # Then
+        assert [r.http.get('accept-encoding') for r in origin.requests] == [
+            'br', 'gzip', None
+        ]
+
+    def test_clients_over_the_rate_limit_are_blocked(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, rate_limit='block', rate_limit_writes='2',
+            rate_limit_window='1', rate_limit_penalty='60',
+        )
+
+        def post(ip, now):
+            return engine.handle(
+                Request('POST', '/form', client={'ip': ip}), now=now
+            )
+
+        # When
+        statuses = [post('192.0.2.1', now=0).status for _ in range(3)]
+        penalised = post('192.0.2.1', now=30)
+        other = post('198.51.100.1', now=30)
+        released = post('192.0.2.1', now=61)
+
+        # Then
+        assert statuses == [200, 200, 429]
+        assert penalised.status == 429
+        assert penalised.headers['retry-after'] == '60'
+        assert penalised.headers['cache-control'] == 'private, max-age=60'
+        assert (other.status, released.status) == (200, 200)
+        assert len(origin.requests) == 4
+
+    def test_log_mode_only_flags_clients_over_the_rate_limit(self):
+        # Given
+        origin = Origin(Response(200, {'Cache-Control': 'private'}))
+        engine = engine_for(
+            origin, rate_limit='log', rate_limit_reads='1',
+            rate_limit_window='1',
+            custom_vcl_deliver='set resp.http.X-Rate-Limit = '
+                               'req.http.X-Rate-Limit;',
+        )
+
+        # When
+        results = [
+            engine.handle(Request('GET', '/', client={'ip': '192.0.2.1'}))
+            for _ in range(3)
+        ]
+
+        # Then
+        assert [r.status for r in results] == [200, 200, 200]
+        assert [r.headers.get('x-rate-limit') for r in results] == [
+            None, 'exceeded', 'exceeded'
+        ]
+        assert origin.requests[2].http['x-rate-limit'] == 'penalised'
+
+    def test_only_origin_requests_count_towards_the_rate_limit(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, rate_limit='block', rate_limit_reads='1',
+            rate_limit_window='1',
+        )
+
+        # When
+        results = [
+            engine.handle(Request('GET', '/', client={'ip': '192.0.2.1'}))
+            for _ in range(5)
+        ] + [
+            engine.handle(Request('GET', '/{}'.format(i), {'Fastly-FF': 'x'}))
+            for i in range(5)
+        ]
+
+        # Then
+        assert [r.status for r in results] == [200] * 10
+        assert [r.state for r in results[:2]] == ['MISS', 'HIT']
+
+    def test_rate_limit_paths_have_their_own_limits(self):
+        # Given
+        origin = Origin(Response(200))
+        engine = engine_for(
+            origin, rate_limit='block', rate_limit_window='1',
+            rate_limit_paths={'/login': '1', '/login/sso': '3'},
+        )
+
+        def post(path):
+            return engine.handle(
+                Request('POST', path, client={'ip': '192.0.2.1'})
+            ).status
+
+        # When
+        sso = [post('/login/sso') for _ in range(3)]
+        login = [post('/login') for _ in range(2)]
+
+        # Then
+        assert sso == [200, 200, 200]
+        assert login == [200, 429]
+
+    def _regional_engine(self, region, **variables):
+        variables.update(
+            backends=[{'address': 'a'}, {'address': 'b'}],
+            env='live', domain_name='www.example.com',
+            regional_backends=[
+                {'name': 'us', 'region': '^US-', 'address': 'us'},
+                {'name': 'asia', 'region': '^(APAC|Asia)', 'address': 'ap'},
+            ],
+        )
+        origin = Origin(Response(200))
+        engine = Engine(
+            Program(render(variables)), origin,
+            tables=dictionaries(variables), server={'region': region},
+        )
+        return engine, origin
+
+    def test_misses_are_tagged_with_the_pops_origin_region(self):
+        # Given
+        us, us_origin = self._regional_engine('US-East')
+        eu, eu_origin = self._regional_engine('EU-West')
+
+        # When
+        regional = us.handle(Request('GET', '/', {'X-Origin-Region': 'x'}))
+        default = eu.handle(Request('GET', '/', {'X-Origin-Region': 'us'}))
+
+        # Then
+        assert us_origin.requests[0].http['x-origin-region'] == 'us'
+        assert regional.backend == 'regional_backend_us'
+        assert 'x-origin-region' not in eu_origin.requests[0].http
+        assert default.backend == 'origin_director'
+
+    def test_origin_region_can_follow_the_client(self):
+        # Given
+        engine, origin = self._regional_engine(
+            'EU-West', region_source='client'
+        )
+        client = {'geo.continent_code': 'Asia'}
+
+        # When
+        engine.handle(Request('GET', '/', client=client))
+
+        # Then
+        assert origin.requests[0].http['x-origin-region'] == 'asia'
+        assert engine.last_backend == 'regional_backend_asia'
+
+    def test_shields_keep_the_edges_origin_region(self):
+        # Given
+        engine, origin = self._regional_engine('EU-West')
+
+        # When
+        engine.handle(Request('GET', '/', {
+            'Fastly-FF': 'cache-lhr', 'X-Origin-Region': 'us',
+        }))
+
+        # Then
+        assert origin.requests[0].http['x-origin-region'] == 'us'
+        assert engine.last_backend == 'regional_backend_us'
+
+    def _no_cache_origin(self, headers=None):
+        def origin(bereq):
+            origin.requests.append(bereq)
+            if bereq.http.get('if-none-match') == '"v1"':
+                return Response(304, {'Cache-Control': 'no-cache'})
+            return Response(200, headers or {
+                'Cache-Control': 'no-cache', 'ETag': '"v1"',
+            }, body_size=1000)
+        origin.requests = []
+        return origin
+
+    def test_no_cache_responses_are_passed_by_default(self):
+        # Given
+        origin = self._no_cache_origin()
+        engine = engine_for(origin)
+
+        # When
+        results = [engine.handle(Request('GET', '/page')) for _ in range(2)]
+
+        # Then
+        assert [r.state for r in results] == ['MISS', 'HITPASS']
+        assert 'if-none-match' not in origin.requests[1].http
+        assert engine.stats['bytes_from_origin'] == 2000
+
+    def test_no_cache_responses_can_be_revalidated(self):
+        # Given
+        origin = self._no_cache_origin()
+        engine = engine_for(origin, revalidate_no_cache='true')
+
+        # When
+        results = [
+            engine.handle(Request('GET', '/page'), now=t) for t in range(3)
+        ]
+
+        # Then
+        assert [(r.state, r.status, r.body_size) for r in results] == \
+            [('MISS', 200, 1000)] * 3
+        assert [r.http.get('if-none-match') for r in origin.requests] == \
+            [None, '"v1"', '"v1"']
+        assert results[2].headers['etag'] == '"v1"'
+        assert engine.stats['revalidations'] == 2
+        assert engine.stats['bytes_from_origin'] == 1000
+        assert engine.stats['bytes_from_cache'] == 2000
+
+    def test_no_cache_errors_are_not_kept_for_revalidation(self):
+        # Given
+        origin = self._no_cache_origin(
+            {'Cache-Control': 'no-cache', 'ETag': '"v1"'}
+        )
+        origin_error = Origin(Response(500, {
+            'Cache-Control': 'no-cache', 'ETag': '"v1"',
+        }))
+        engine = engine_for(origin_error, revalidate_no_cache='true')
+
+        # When
+        first = engine.handle(Request('GET', '/page'), now=0)
+        engine.origin = origin
+        second = engine.handle(Request('GET', '/page'), now=10)
+
+        # Then
+        assert first.status == 500
+        assert (second.state, second.status) == ('HITPASS', 200)
+        assert 'if-none-match' not in origin.requests[0].http
+
+    def test_private_or_unvalidated_no_cache_responses_are_passed(self):
+        for headers in (
+            {'Cache-Control': 'private, no-cache', 'ETag': '"v1"'},
+            {'Cache-Control': 'no-cache'},
+        ):
+            # Given
+            origin = self._no_cache_origin(headers)
+            engine = engine_for(origin, revalidate_no_cache='true')
+
+            # When
+            engine.handle(Request('GET', '/page'))
+            second = engine.handle(Request('GET', '/page'))
+
+            # Then
+            assert second.state == 'HITPASS'
+            assert 'if-none-match' not in origin.requests[1].http
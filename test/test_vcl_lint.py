@@ -0,0 +1,118 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from tools.vcl_lint import lint, main, tokenize
+from tools.vcl_template import render
+
+
+def kinds(problems):
+    return [problem.kind for problem in problems]
+
+
+class TestVCLLint(unittest.TestCase):
+
+    def test_rendered_vcl_is_clean(self):
+        for variables in (
+            {},
+            {'caching': 'false'},
+            {
+                'backends': [{'address': 'a'}, {'address': 'b'}],
+                'env': 'live', 'domain_name': 'www.example.com',
+                'server_timing': 'true',
+                'server_timing_clients': ['10.0.0.0/8'],
+                'redirects': {'/old': '/new'},
+                'custom_vcl_recv': 'set req.http.X-Test = "1";',
+            },
+        ):
+            assert lint(render(variables)) == [], variables
+
+    def test_tokenize_skips_comments_and_keeps_strings(self):
+        # When
+        tokens, problems = tokenize(
+            '# a {\n/* b\n( */ set x = "}"; synthetic {"a\n}"};'
+        )
+
+        # Then
+        assert problems == []
+        assert [t.kind for t in tokens] == [
+            'word', 'word', 'op', 'string', 'op', 'word', 'longstring', 'op',
+        ]
+        assert tokens[0].line == 3
+
+    def test_unbalanced_brackets(self):
+        # When
+        problems = lint(render({'custom_vcl_recv': 'if (x) {'}))
+        mismatched = lint('sub vcl_recv { if (x} }')
+
+        # Then
+        assert kinds(problems) == ['brackets']
+        assert problems[0].message == "unclosed '{'"
+        assert [p.message for p in mismatched] == [
+            "'}' closes '(' from line 1"
+        ]
+
+    def test_unterminated_strings_and_comments(self):
+        assert tokenize('set x = "a;\n')[1][0].message == \
+            'unterminated string'
+        assert tokenize('set x = 1; /* open')[1][0].message == \
+            'unterminated comment'
+
+    def test_missing_and_misplaced_macros(self):
+        # Given
+        vcl = render().replace('#FASTLY deliver', '#FASTLY recv')
+
+        # When
+        problems = lint(vcl)
+
+        # Then
+        assert [p.message for p in problems] == [
+            'sub vcl_deliver has no #FASTLY deliver',
+            '#FASTLY recv in sub vcl_deliver',
+        ]
+        assert 'no sub vcl_log for #FASTLY log' in [
+            p.message for p in lint(vcl.replace('sub vcl_log', 'sub log'))
+        ]
+
+    def test_statements_after_a_return_are_unreachable(self):
+        # When
+        problems = lint(render({'custom_vcl_deliver': 'return(pass);'}))
+
+        # Then
+        assert kinds(problems) == ['unreachable']
+        assert problems[0].message.startswith('return can never run')
+
+    def test_error_response_breaking_out_of_synthetic(self):
+        # When
+        problems = lint(render({'proxy_error_response': '<p>"}</p>'}))
+
+        # Then
+        assert 'synthetic' in kinds(problems)
+
+    def test_size(self):
+        assert kinds(lint(render(), max_size=1000)) == ['size']
+
+    def test_cli(self):
+        # Given
+        f = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            json.dump({'caching': 'false'}, f)
+        output = io.StringIO()
+
+        # When
+        with redirect_stdout(output):
+            status = main([
+                '--var-file', f.name,
+                '--var', 'custom_vcl_deliver=return(pass);',
+            ])
+
+        # Then
+        assert status == 1
+        lines = output.getvalue().splitlines()
+        assert lines[0].startswith('custom.vcl:')
+        assert ': unreachable: ' in lines[0]
+        assert lines[-1].endswith(', 1 problems')
@@ -0,0 +1,479 @@
+import os
+import re
+import unittest
+
+from tools.vcl_template import (
+    ROOT, TemplateError, dictionaries, interpolate, module_defaults, render,
+    template_vars,
+)
+
+
+class TestVCLTemplate(unittest.TestCase):
+
+    def test_defaults_come_from_variables_tf(self):
+        # When
+        defaults = module_defaults()
+
+        # Then
+        assert defaults['caching'] == 'true'
+        assert defaults['connect_timeout'] == '5000'
+        assert defaults['proxy_error_response'].startswith('<!DOCTYPE html>')
+        assert 'domain_name' not in defaults
+
+    def test_caching_selects_the_default_recv_action(self):
+        assert template_vars()['vcl_recv_default_action'] == 'lookup'
+        assert template_vars({'caching': 'false'})[
+            'vcl_recv_default_action'
+        ] == 'pass'
+
+    def test_render_interpolates_custom_vcl(self):
+        # When
+        vcl = render({
+            'custom_vcl_deliver': 'set resp.http.X-Test = "1";',
+            'proxy_error_response': 'oops',
+        })
+
+        # Then
+        assert 'set resp.http.X-Test = "1";' in vcl
+        assert 'synthetic {"oops"};' in vcl
+        assert '${' not in vcl
+
+    def test_interpolate_follows_template_file_escaping(self):
+        # When
+        rendered = interpolate('$${x} ${ y } ${z}', {'y': 1, 'z': '${y}'})
+
+        # Then
+        assert rendered == '${x} 1 ${y}'
+
+    def test_interpolate_rejects_unknown_variables(self):
+        with self.assertRaises(TemplateError):
+            interpolate('${missing}', {})
+        with self.assertRaises(TemplateError):
+            interpolate('${var.x}', {'x': '1'})
+
+    def test_shield_fallback_ttl_defaults_to_the_edge_one(self):
+        assert template_vars({'fallback_ttl': '300'})[
+            'shield_fallback_ttl'
+        ] == '300'
+        assert template_vars({'shield_fallback_ttl': '86400'})[
+            'shield_fallback_ttl'
+        ] == '86400'
+
+    def test_dictionaries(self):
+        assert dictionaries() == {'ttl_policy': {}, 'redirects': {}}
+        assert dictionaries({'ttl_policy': '{"/assets/": "1d"}'})[
+            'ttl_policy'
+        ] == {'/assets/': '1d'}
+
+    def test_querystring_untouched_by_default(self):
+        # When
+        vcl = render()
+
+        # Then
+        assert 'querystring.' not in vcl
+
+    def test_querystring_normalisation(self):
+        # When
+        vcl = render({
+            'querystring_strip': ['utm_[a-z]+', 'gclid', 'fbclid'],
+            'querystring_sort': 'true',
+        })
+
+        # Then
+        assert 'set req.url = querystring.regfilter(' \
+            'req.url, "^(utm_[a-z]+|gclid|fbclid)$");' in vcl
+        assert 'set req.url = querystring.sort(req.url);' in vcl
+
+    def test_querystring_allowlist_replaces_the_strip_list(self):
+        # When
+        vcl = render({'querystring_allowlist': '["page","q"]'})
+
+        # Then
+        assert 'set req.url = querystring.regfilter_except(' \
+            'req.url, "^(page|q)$");' in vcl
+        assert 'querystring.regfilter(' not in vcl
+
+    def test_director_for_several_backends(self):
+        # When
+        vcl = render({
+            'backends': [{'address': 'a', 'weight': '200'}, {'address': 'b'}],
+            'director_type': 'hash', 'env': 'live',
+            'domain_name': 'www.example.com',
+        })
+
+        # Then
+        assert 'director origin_director hash {\n' \
+            '  .quorum = 50%;\n' \
+            '  { .backend = backend_0; .weight = 200; }\n' \
+            '  { .backend = backend_1; .weight = 100; }\n' \
+            '}\n' in vcl
+        assert 'set req.backend = origin_director;' in vcl
+
+    def test_only_random_directors_retry(self):
+        # When
+        vcl = render({
+            'backends': [{'address': 'a'}, {'address': 'b'}],
+            'env': 'live', 'domain_name': 'www.example.com',
+        })
+
+        # Then
+        assert 'director origin_director random {\n' \
+            '  .quorum = 50%;\n' \
+            '  .retries = 2;\n' \
+            '  { .backend = backend_0; .weight = 100; }\n' in vcl
+
+    def test_consistent_hashing_director(self):
+        # When
+        vcl = render({
+            'backends': [{'address': 'a', 'weight': '200'}, {'address': 'b'}],
+            'director_type': 'chash',
+            'director_chash_seed': '42',
+            'env': 'live', 'domain_name': 'www.example.com',
+        })
+
+        # Then
+        assert 'director origin_director chash {\n' \
+            '  .quorum = 50%;\n' \
+            '  .key = object;\n' \
+            '  .seed = 42;\n' \
+            '  { .backend = backend_0; .id = "backend_0"; }\n' \
+            '  { .backend = backend_1; .id = "backend_1"; }\n' \
+            '}\n' in vcl
+
+    def test_no_director_for_a_single_backend(self):
+        # When
+        vcl = render({'backends': [{'address': 'a'}]})
+
+        # Then
+        assert 'origin_director' not in vcl
+        assert 'backend backend_0 {' not in vcl
+
+    def test_director_backends_are_health_checked(self):
+        # When
+        vcl = render({
+            'backends': [
+                {'address': 'a.example.com', 'port': '8443'},
+                {
+                    'address': '192.0.2.1', 'ssl_check_cert': 'false',
+                    'healthcheck_host': 'b.example.com',
+                    'healthcheck_path': '/status',
+                },
+            ],
+            'env': 'staging', 'domain_name': 'www.example.com',
+            'healthcheck_interval': '10000',
+        })
+
+        # Then
+        assert 'backend backend_0 {\n' \
+            '  .host = "a.example.com";\n' \
+            '  .port = "8443";\n' in vcl
+        assert '  .ssl_check_cert = always;\n' in vcl
+        assert '  .between_bytes_timeout = 30000ms;\n' \
+            '  .probe = {\n' \
+            '    .request = "HEAD / HTTP/1.1" ' \
+            '"Host: staging-www.example.com" "Connection: close";\n' \
+            '    .expected_response = 200;\n' \
+            '    .interval = 10000ms;\n' \
+            '    .timeout = 5000ms;\n' in vcl
+        assert 'backend backend_1 {\n' \
+            '  .host = "192.0.2.1";\n' in vcl
+        assert '  .ssl_check_cert = never;\n' in vcl
+        assert '    .request = "HEAD /status HTTP/1.1" ' \
+            '"Host: b.example.com" "Connection: close";\n' in vcl
+
+    def test_health_checks_need_the_domain(self):
+        with self.assertRaises(TemplateError):
+            render({'backends': [{'address': 'a'}, {'address': 'b'}]})
+
+    def test_vcl_probe_matches_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+        snippet = re.search(r'\n  vcl_probe = "(.*?)"\n', main_tf) \
+            .group(1).replace('\\n', '\n').replace('\\"', '"') \
+            .replace('${var.healthcheck_interval}', '15000') \
+            .replace('${var.healthcheck_timeout}', '5000') \
+            % ('/', 'b.example.com')
+
+        # When
+        vcl = render({
+            'backends': [
+                {'address': 'a', 'healthcheck_host': 'b.example.com'},
+                {'address': 'b', 'healthcheck_host': 'b.example.com'},
+            ],
+        })
+
+        # Then
+        assert snippet + '\n}\n' in vcl
+
+    def test_accept_encoding_snippets_match_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        gzip, brotli = (
+            re.search(
+                r'accept_encoding_{} = <<EOF\n(.*?)EOF'.format(name),
+                main_tf, re.S,
+            ).group(1)
+            for name in ('gzip', 'brotli')
+        )
+
+        # Then
+        assert gzip in render()
+        assert brotli in render({'prefer_brotli': 'true'})
+        assert 'Accept-Encoding' not in render({
+            'normalise_accept_encoding': 'false'
+        })
+
+    def test_redirect_snippets_match_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippet = re.search(
+            r'redirect_querystring = <<EOF\n(.*?)EOF', main_tf, re.S
+        ).group(1)
+
+        # Then
+        assert snippet in render({'redirect_preserve_querystring': 'true'})
+        assert snippet not in render()
+        assert 'set obj.response = "Found";' in render({
+            'redirect_status': '302'
+        })
+
+    def test_server_timing_snippets_match_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippets = [
+            re.search(
+                r'\n  {} = <<EOF\n(.*?)EOF'.format(name), main_tf, re.S
+            ).group(1)
+            for name in ('server_timing', 'server_timing_strip')
+        ]
+
+        # Then
+        vcl = render({
+            'server_timing': 'true',
+            'server_timing_clients': '["10.0.0.0/8","2001:db8::1"]',
+        })
+        for snippet in snippets:
+            assert snippet in vcl
+        assert 'acl server_timing_clients {\n' \
+            '  "10.0.0.0"/8;\n' \
+            '  "2001:db8::1";\n' \
+            '}\n' in vcl
+        assert 'resp.http.Server-Timing' not in render()
+
+    def test_ttfb_snippets_match_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippets = [
+            re.search(
+                r'\n  {} = <<EOF\n(.*?)EOF'.format(name), main_tf, re.S
+            ).group(1)
+            for name in ('fetch_start', 'origin_ttfb', 'edge_ttfb')
+        ]
+
+        # Then
+        for variable in ('server_timing', 'log_ttfb', 'log_shield_origin'):
+            vcl = render({variable: 'true'})
+            for snippet in snippets:
+                assert snippet in vcl
+        assert 'TTFB = ' not in render()
+        assert 'X-Fetch-Start = ' not in render()
+
+    def test_vcl_backend_matches_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippet = re.search(
+            r'\n  vcl_backend = <<EOF\n(.*?)EOF', main_tf, re.S
+        ).group(1).replace('$${', '${')
+        for name, value in (
+            ('name', 'fallback_backend'), ('address', 'm.example.com'),
+            ('port', '443'), ('hostname', 'mirror.s3.amazonaws.com'),
+            ('check_cert', 'never'), ('probe', ''),
+            ('var.connect_timeout', '1000'),
+            ('var.first_byte_timeout', '2000'),
+            ('var.between_bytes_timeout', '3000'),
+        ):
+            snippet = snippet.replace('${%s}' % name, value)
+
+        # Then
+        assert snippet in render({
+            'fallback_backend_address': 'm.example.com',
+            'fallback_backend_host': 'mirror.s3.amazonaws.com',
+            'ssl_cert_check': 'false', 'connect_timeout': '1000',
+            'first_byte_timeout': '2000', 'between_bytes_timeout': '3000',
+        })
+
+    def test_fallback_backend_snippets_match_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippets = [
+            re.search(
+                r'\n  {} = <<EOF\n(.*?)EOF'.format(name), main_tf, re.S
+            ).group(1)
+            .replace('${var.fallback_backend_host}', 'mirror.example.com')
+            .replace('${var.max_restarts}', '2')
+            for name in (
+                'fallback_backend', 'fallback_backend_host',
+                'fallback_restart',
+            )
+        ]
+
+        # Then
+        vcl = render({
+            'fallback_backend_address': 'mirror.example.com',
+            'fallback_backend_host': 'mirror.example.com',
+            'max_restarts': '2',
+        })
+        for snippet in snippets:
+            assert snippet in vcl
+        assert 'if (req.restarts < 2 && (req.request == "GET"' in vcl
+        assert 'fallback_backend' not in render()
+
+    def test_rate_limit_snippets_match_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippets = [
+            re.search(
+                r'\n  {} = <<EOF\n(.*?)EOF'.format(name), main_tf, re.S
+            ).group(1)
+            .replace('${var.rate_limit_reads}', '100')
+            .replace('${var.rate_limit_writes}', '10')
+            .replace('${var.rate_limit_window}', '10')
+            .replace('${var.rate_limit_penalty}', '120')
+            .replace('${local.rate_limit_block}', 'error 829;')
+            .replace(
+                '${join("\\n    ", '
+                'data.template_file.rate_limit_path.*.rendered)}', ''
+            )
+            for name in (
+                'rate_limit_declarations', 'rate_limit_recv',
+                'rate_limit_check', 'rate_limit_response',
+            )
+        ]
+
+        # Then
+        vcl = render({'rate_limit': 'block'})
+        for snippet in snippets:
+            assert snippet in vcl
+        logged = render({'rate_limit': 'log'})
+        assert 'ratelimit.check_rate(' in logged
+        assert 'error 829;' not in logged
+        assert 'ratelimit.' not in render()
+
+    def test_rate_limit_paths_are_sorted_so_longer_prefixes_win(self):
+        # When
+        vcl = render({
+            'rate_limit': 'log',
+            'rate_limit_paths': {'/login/sso': '5', '/login': '2'},
+        })
+
+        # Then
+        assert 'if (std.prefixof(req.url.path, "/login")) {\n' \
+            '      set req.http.X-Rate-Limit-Class = "/login";\n' \
+            '      set req.http.X-Rate-Limit-Max = "2";\n' \
+            '    }\n' \
+            '    if (std.prefixof(req.url.path, "/login/sso")) {' in vcl
+
+    def test_origin_region_matches_templates_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'templates.tf')) as f:
+            templates_tf = f.read()
+        template = re.search(
+            r'"origin_region" \{.*?template = "(.*?)"\n', templates_tf, re.S
+        ).group(1).replace('$${', '${').replace('\\n', '\n') \
+            .replace('\\"', '"')
+
+        # When
+        vcl = render({
+            'region_source': 'client',
+            'regional_backends': [
+                {'name': 'us', 'region': '^NA$', 'address': 'us'},
+                {'name': 'eu', 'region': '^EU$', 'address': 'eu'},
+            ],
+        })
+
+        # Then
+        assert ' else '.join(
+            interpolate(template, {
+                'source': 'client.geo.continent_code',
+                'region': region, 'name': name,
+            })
+            for name, region in (('us', '^NA$'), ('eu', '^EU$'))
+        ) in vcl
+        assert 'X-Origin-Region = ' not in render()
+
+    def test_regional_backend_choice_matches_templates_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'templates.tf')) as f:
+            templates_tf = f.read()
+        template = re.search(
+            r'"regional_backend_choice" \{.*?template = "(.*?)"\n',
+            templates_tf, re.S
+        ).group(1).replace('$${', '${').replace('\\n', '\n') \
+            .replace('\\"', '"')
+
+        # When
+        vcl = render({
+            'regional_backends': [
+                {'name': 'us', 'region': '^US-', 'address': 'us.example.com'},
+                {
+                    'name': 'eu', 'region': '^EU-', 'address': '192.0.2.1',
+                    'port': '8443', 'ssl_cert_hostname': 'eu.example.com',
+                },
+            ],
+        })
+
+        # Then
+        assert ' else '.join(
+            interpolate(template, {'name': name}) for name in ('us', 'eu')
+        ) in vcl
+        assert 'backend regional_backend_us {\n' \
+            '  .host = "us.example.com";\n' \
+            '  .port = "443";\n' in vcl
+        assert 'backend regional_backend_eu {\n' \
+            '  .host = "192.0.2.1";\n' \
+            '  .port = "8443";\n' \
+            '  .ssl = true;\n' \
+            '  .ssl_cert_hostname = "eu.example.com";\n' in vcl
+        assert 'regional_backend' not in render()
+
+    def test_revalidate_no_cache_snippet_matches_main_tf(self):
+        # Given
+        with open(os.path.join(ROOT, 'main.tf')) as f:
+            main_tf = f.read()
+
+        # When
+        snippet = re.search(
+            r'\n  revalidate_no_cache = <<EOF\n(.*?)EOF', main_tf, re.S
+        ).group(1).replace('${var.stale_if_error}', '600').replace(
+            '${var.revalidate_keep}', '3600'
+        )
+
+        # Then
+        vcl = render({
+            'revalidate_no_cache': 'true', 'stale_if_error': '600',
+            'revalidate_keep': '3600',
+        })
+        assert snippet in vcl
+        assert 'REVALIDATE' not in render()
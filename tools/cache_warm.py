@@ -0,0 +1,445 @@
+"""
+Warms the cache after a purge or a new service version, so the first users
+don't all miss at once - requests the most frequent URLs in the log lines, or
+the URLs in a sitemap, from the service's domain (`full_domain_name`):
+
+    python -m tools.cache_warm https://www.example.com --logs logs/*.log \\
+        --top 5000
+    python -m tools.cache_warm https://ci-www.example.com \\
+        --sitemap https://www.example.com/sitemap.xml --debug
+
+Only the path and query string of each URL are used, so a sitemap for one
+environment can warm another. Requests go out from a fixed number of
+asyncio workers, each reusing one keep-alive connection, and send the
+`Accept-Encoding` the VCL normalises to, so they fill the same cache objects
+as browsers. A run warms the POP (and shield) the machine running it reaches;
+`X-Cache` (with `--debug`, also `Fastly-Debug-Path`) shows whether each
+response was a HIT or a MISS, so a second run confirms the warm-up.
+"""
+import argparse
+import asyncio
+import gzip
+import re
+import ssl
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import Counter, namedtuple
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+from tools import dd_logs
+from tools.log_stats import Sketch
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# cache states of requests for cacheable objects (HITPASS is a pass)
+_CACHED_STATE = re.compile(r'^(HIT(?!PASS)|MISS|STALE)')
+
+# bytes read at a time from a body that's thrown away
+_READ_SIZE = 64 * 1024
+
+Fetch = namedtuple('Fetch', 'target status latency size state error')
+
+WarmResult = namedtuple('WarmResult', 'fetches seconds connections')
+
+
+class WarmError(Exception):
+    pass
+
+
+def request_target(url):
+    """
+    The path and query string of a URL or path.
+    """
+    parts = urlsplit(url.strip())
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    return target
+
+
+def top_urls(paths, top=1000):
+    """
+    The `top` most requested URLs in log lines, weighted by `sample_rate`.
+    Only GET requests that were, or could have been, answered from cache
+    count - not passes, errors or redirects answered at the edge. Lines from
+    before cache_state was logged count if the rest matches.
+    """
+    counts = Counter()
+    for record in dd_logs.records(paths):
+        if dd_logs.get(record, 'http.method', 'GET') != 'GET':
+            continue
+        state = dd_logs.get(record, 'cache_state')
+        if state is not None and not _CACHED_STATE.match(state):
+            continue
+        if dd_logs.as_int(dd_logs.get(record, 'http.status_code')) != 200:
+            continue
+        url = dd_logs.get(record, 'http.url')
+        if url:
+            counts[url] += dd_logs.as_int(record.get('sample_rate'), 1)
+    return [url for url, _ in counts.most_common(top)]
+
+
+def _read_source(source):
+    if urlsplit(source).scheme in ('http', 'https'):
+        with urlopen(source, timeout=30) as response:
+            content = response.read()
+    else:
+        with open(source, 'rb') as f:
+            content = f.read()
+    if content[:2] == b'\x1f\x8b':
+        content = gzip.decompress(content)
+    return content
+
+
+def parse_sitemap(content):
+    """
+    Returns (page URLs, child sitemap URLs) from a sitemap or sitemap index.
+    """
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as e:
+        raise WarmError('invalid sitemap: {}'.format(e))
+    urls = []
+    sitemaps = []
+    for element in root:
+        # namespaced as {http://www.sitemaps.org/schemas/sitemap/0.9}url
+        kind = element.tag.rpartition('}')[2]
+        for loc in element:
+            if loc.tag.rpartition('}')[2] == 'loc' and loc.text:
+                (sitemaps if kind == 'sitemap' else urls).append(
+                    loc.text.strip()
+                )
+    return urls, sitemaps
+
+
+def sitemap_urls(source, read=_read_source, max_sitemaps=1000):
+    """
+    The page URLs in a sitemap (a path or URL, optionally gzipped),
+    following sitemap indexes.
+    """
+    urls = []
+    pending = [source]
+    seen = set()
+    while pending:
+        source = pending.pop(0)
+        if source in seen:
+            continue
+        seen.add(source)
+        if len(seen) > max_sitemaps:
+            raise WarmError('more than {} sitemaps'.format(max_sitemaps))
+        pages, sitemaps = parse_sitemap(read(source))
+        urls.extend(pages)
+        pending.extend(sitemaps)
+    return urls
+
+
+async def _discard(reader, size):
+    while size > 0:
+        size -= len(await reader.readexactly(min(size, _READ_SIZE)))
+
+
+async def _read_response(reader, method):
+    """
+    Reads one response, returning (status, headers, body size, whether the
+    connection can be reused). Repeated headers are joined with commas.
+    """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('connection closed')
+    parts = line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ConnectionError('bad status line {!r}'.format(line))
+    version, status = parts[0], int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name, value = name.strip().lower(), value.strip()
+        headers[name] = headers[name] + ', ' + value if name in headers \
+            else value
+    keep_alive = version == 'HTTP/1.1' and \
+        'close' not in headers.get('connection', '').lower()
+    size = 0
+    if method == 'HEAD' or status in (204, 304) or status < 200:
+        pass
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            chunk = int((await reader.readline()).split(b';')[0], 16)
+            if chunk == 0:
+                # trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await _discard(reader, chunk)
+            await reader.readline()
+            size += chunk
+    elif 'content-length' in headers:
+        size = int(headers['content-length'])
+        await _discard(reader, size)
+    else:
+        # the body ends when the connection does
+        while True:
+            data = await reader.read(_READ_SIZE)
+            if not data:
+                break
+            size += len(data)
+        keep_alive = False
+    return status, headers, size, keep_alive
+
+
+class _Connection(object):
+    """
+    One keep-alive HTTP/1.1 connection, reopened when the server closes it.
+    """
+
+    def __init__(self, host, port, ssl_context):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.reader = self.writer = None
+        self.opened = 0
+
+    async def request(self, method, target, headers):
+        message = '{} {} HTTP/1.1\r\n{}\r\n'.format(method, target, ''.join(
+            '{}: {}\r\n'.format(name, value)
+            for name, value in headers.items()
+        )).encode('latin-1')
+        for attempt in (0, 1):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port, ssl=self.ssl_context,
+                    server_hostname=self.host if self.ssl_context else None,
+                )
+                self.opened += 1
+            try:
+                self.writer.write(message)
+                await self.writer.drain()
+                status, response_headers, size, keep_alive = \
+                    await _read_response(self.reader, method)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                self.close()
+                # the server may have closed an idle connection
+                if reused and attempt == 0:
+                    continue
+                raise
+            if not keep_alive:
+                self.close()
+            return status, response_headers, size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Warmer(object):
+
+    def __init__(self, base_url, concurrency=16, timeout=30.0, debug=False,
+                 accept_encoding='gzip', headers=None, verify=True):
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise WarmError('invalid base URL {!r}'.format(base_url))
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl_context = None
+        if url.scheme == 'https':
+            self.ssl_context = ssl.create_default_context()
+            if not verify:
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.headers = {
+            'Host': url.netloc,
+            'User-Agent': 'tf_fastly_frontend-cache-warm',
+        }
+        if accept_encoding:
+            self.headers['Accept-Encoding'] = accept_encoding
+        if debug:
+            self.headers['Fastly-Debug'] = '1'
+        self.headers.update(headers or {})
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def _worker(self, targets, fetches):
+        # the workers share one iterator of targets
+        connection = _Connection(self.host, self.port, self.ssl_context)
+        try:
+            for target in targets:
+                started = time.perf_counter()
+                try:
+                    status, headers, size = await asyncio.wait_for(
+                        connection.request('GET', target, self.headers),
+                        self.timeout,
+                    )
+                except (OSError, asyncio.IncompleteReadError, ValueError,
+                        asyncio.TimeoutError) as e:
+                    connection.close()
+                    fetches.append(Fetch(
+                        target, None, time.perf_counter() - started, 0, None,
+                        str(e) or e.__class__.__name__,
+                    ))
+                    continue
+                fetches.append(Fetch(
+                    target, status, time.perf_counter() - started, size,
+                    cache_state(headers), None,
+                ))
+            return connection.opened
+        finally:
+            connection.close()
+
+    async def warm_async(self, targets):
+        targets = [request_target(target) for target in targets]
+        shared = iter(targets)
+        fetches = []
+        started = time.perf_counter()
+        opened = await asyncio.gather(*[
+            self._worker(shared, fetches)
+            for _ in range(max(1, min(self.concurrency, len(targets))))
+        ])
+        return WarmResult(
+            fetches=fetches,
+            seconds=time.perf_counter() - started,
+            connections=sum(opened),
+        )
+
+    def warm(self, targets):
+        """
+        Requests every URL (or path) and returns a WarmResult.
+        """
+        return asyncio.run(self.warm_async(targets))
+
+
+def cache_state(headers):
+    """
+    HIT or MISS at the node that answered, from `X-Cache` - with shielding
+    it lists the shield and then the edge.
+    """
+    value = headers.get('x-cache')
+    if not value:
+        return None
+    return value.rpartition(',')[2].strip() or None
+
+
+def report(result, quantiles=QUANTILES):
+    """
+    Throughput, latency percentiles in milliseconds, and counts by status and
+    cache state.
+    """
+    latency = Sketch()
+    for fetch in result.fetches:
+        latency.add(fetch.latency * 1000)
+    seconds = result.seconds or float('inf')
+    return {
+        'requests': len(result.fetches),
+        'seconds': result.seconds,
+        'requests_per_second': len(result.fetches) / seconds,
+        'bytes_per_second': sum(f.size for f in result.fetches) / seconds,
+        'connections': result.connections,
+        'latency_ms': dict(
+            [('p{:g}'.format(q * 100), latency.quantile(q))
+             for q in quantiles] + [('max', latency.quantile(1))]
+        ),
+        'statuses': Counter(
+            str(f.status) if f.status else 'error' for f in result.fetches
+        ),
+        'cache_states': Counter(
+            f.state for f in result.fetches if f.state
+        ),
+        'errors': sum(
+            1 for f in result.fetches if not f.status or f.status >= 500
+        ),
+    }
+
+
+def format_report(summary):
+    def counts(counter):
+        return ', '.join(
+            '{} {}'.format(key, count)
+            for key, count in sorted(counter.items())
+        ) or '-'
+
+    return '\n'.join((
+        '{} requests in {:.2f} s over {} connections: {:,.1f} requests/s, '
+        '{:,.0f} KB/s'.format(
+            summary['requests'], summary['seconds'], summary['connections'],
+            summary['requests_per_second'],
+            summary['bytes_per_second'] / 1024,
+        ),
+        'latency ms: ' + '  '.join(
+            '{} {}'.format(name, '-' if value is None else
+                           '{:.1f}'.format(value))
+            for name, value in summary['latency_ms'].items()
+        ),
+        'status: ' + counts(summary['statuses']),
+        'cache: ' + counts(summary['cache_states']),
+        'errors: {}'.format(summary['errors']),
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Warm the cache by requesting the most frequent URLs in '
+                    'the logs, or the URLs in a sitemap.'
+    )
+    parser.add_argument(
+        'base_url', help='the service, e.g. https://ci-www.example.com'
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        '--logs', nargs='+', metavar='PATH',
+        help='log files (- for stdin) to take the most requested URLs from',
+    )
+    source.add_argument(
+        '--sitemap', metavar='PATH_OR_URL',
+        help='sitemap or sitemap index, optionally gzipped',
+    )
+    source.add_argument(
+        '--urls', metavar='PATH', help='file of URLs or paths, one per line'
+    )
+    parser.add_argument(
+        '--top', type=int, default=1000,
+        help='how many of the most requested URLs to warm (default: 1000)',
+    )
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument(
+        '--accept-encoding', default='gzip',
+        help='Accept-Encoding to send - br if prefer_brotli is set '
+             '(default: gzip)',
+    )
+    parser.add_argument(
+        '--debug', action='store_true',
+        help='send Fastly-Debug, so responses carry Fastly-Debug-Path',
+    )
+    parser.add_argument(
+        '--insecure', action='store_true',
+        help="don't verify the TLS certificate",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        if args.logs:
+            targets = top_urls(args.logs, args.top)
+        elif args.sitemap:
+            targets = sitemap_urls(args.sitemap)
+        else:
+            with open(args.urls) as f:
+                targets = [line for line in f if line.strip()]
+        warmer = Warmer(
+            args.base_url, concurrency=args.concurrency,
+            timeout=args.timeout, debug=args.debug,
+            accept_encoding=args.accept_encoding, verify=not args.insecure,
+        )
+    except (WarmError, OSError) as e:
+        parser.error(str(e))
+    summary = report(warmer.warm(targets))
+    print(format_report(summary))
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Reading the real-time log lines this module ships to Datadog.
+
+Each syslog line is `<api key> <json record>` (see the syslog `format` in
+main.tf), optionally preceded by a syslog header, with the record shaped by
+one of the dd_log_format*.json profiles. Sampled cache hits carry the number
+of requests each line stands for in `sample_rate`.
+"""
+import json
+import sys
+from datetime import datetime, timezone
+
+
+def parse_line(line):
+    """
+    Returns the JSON record in a log line, or None if there isn't a valid one.
+    """
+    start = line.find('{')
+    if start < 0:
+        return None
+    try:
+        record = json.loads(line[start:])
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def get(record, path, default=None):
+    """
+    Looks up a dotted path such as `http.url` in a record.
+    """
+    for key in path.split('.'):
+        if not isinstance(record, dict) or key not in record:
+            return default
+        record = record[key]
+    return record
+
+
+def as_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def timestamp(value):
+    """
+    Seconds since the epoch for a `%Y-%m-%dT%H:%M:%S%Z` log timestamp.
+    """
+    try:
+        parsed = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def read_lines(paths):
+    """
+    Yields lines from each path in turn, reading stdin for `-`.
+    """
+    for path in paths or ['-']:
+        if path == '-':
+            for line in sys.stdin:
+                yield line
+            continue
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                yield line
+
+
+def records(paths):
+    for line in read_lines(paths):
+        record = parse_line(line)
+        if record is not None:
+            yield record
@@ -0,0 +1,377 @@
+"""
+Generates the dd_log_format*.json syslog formats from the declarative field
+schema in log_fields.json, and checks that they always render valid JSON:
+
+    python -m tools.log_format            # regenerate and report sizes
+    python -m tools.log_format --check    # fail if out of date or invalid
+    python -m tools.log_format --validate some_format.json
+
+A format is Fastly log directives (`%D`, `%{...}V`, `%{...}i`, ...) and
+template variables (`${sample_rate}`) inside JSON. Validation renders it with
+every sample value of each placeholder in turn - empty values, `(null)`,
+quotes and backslashes for raw strings - and parses the result, so an
+unescaped header or a number that can be empty is reported rather than
+silently dropped by Datadog.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from collections import OrderedDict, namedtuple
+
+from tools.vcl_template import ROOT
+
+SCHEMA_PATH = os.path.join(ROOT, 'log_fields.json')
+
+PROFILES = ('minimal', 'standard', 'full')
+
+# the shield-to-origin stream: fields marked `"origin": true`, and ones in
+# no other profile (`"profile": "origin"`)
+ORIGIN = 'origin'
+
+# local.log_formats in main.tf, and data.template_file.log_format_origin's -
+# options follow the profile after a `+` (minimal has no optional fields)
+OUTPUTS = OrderedDict((
+    ('minimal', 'dd_log_format_minimal.json'),
+    ('standard', 'dd_log_format_standard.json'),
+    ('standard+ttfb', 'dd_log_format_standard_ttfb.json'),
+    ('full', 'dd_log_format.json'),
+    ('full+ttfb', 'dd_log_format_ttfb.json'),
+    (ORIGIN, 'dd_log_format_origin.json'),
+))
+
+# raw string values are capped at this many bytes unless the field says
+DEFAULT_MAX_LENGTH = 256
+
+# json.escape can turn one byte into six (\u00XX)
+_ESCAPE_RATIO = 6
+
+_ESCAPED = tuple(
+    json.dumps(s)[1:-1]
+    for s in ('abc', '', '(null)', '"', '\\', '\x00\n', 'caf\xe9')
+)
+_RAW = ('abc', '', '(null)', '"', '\\', '\n')
+_INTEGER = ('1234', '0')
+_NUMBER = ('12.5', '0.000')
+_TIME = ('2018-01-01T00:00:00GMT',)
+_NULL = ('null',)
+
+# what a nullable field's value must look like to be logged as a number
+_NUMERIC = {
+    'integer': '^[0-9]+$',
+    'number': '^[0-9]+(\\.[0-9]+)?$',
+}
+
+Placeholder = namedtuple('Placeholder', 'samples max_bytes')
+
+# directive -> (whether it goes in a JSON string, placeholder)
+DIRECTIVES = {
+    '%D': (False, Placeholder(_INTEGER, 20)),
+    '%B': (False, Placeholder(_INTEGER, 20)),
+    '%s': (True, Placeholder(('200', '503'), 3)),
+    '%m': (True, Placeholder(('GET', 'FASTLYPURGE'), 16)),
+    '%H': (True, Placeholder(('HTTP/1.1', 'HTTP/2'), 8)),
+    '%h': (True, Placeholder(('192.0.2.1', '2001:db8::1'), 39)),
+    '%A': (True, Placeholder(('192.0.2.1', '2001:db8::1'), 39)),
+    '%v': (True, Placeholder(('example.com',), 256)),
+}
+
+_PLACEHOLDER = re.compile(r'(%\{[^}]*\}[A-Za-z]|%[A-Za-z]|\$\{\w+\})')
+_IF = re.compile(r'^if\((.*),\s*"([^"]*)",\s*"([^"]*)"\)$')
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%Z'
+
+Report = namedtuple(
+    'Report', 'problems typical_bytes worst_case_bytes largest'
+)
+
+
+class LogFormatError(Exception):
+    pass
+
+
+def load_schema(path=SCHEMA_PATH):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def profile_fields(schema, profile):
+    """
+    The schema's fields in the given profile (or the origin stream), in
+    schema order. Fields with an `option` are only in a profile that names
+    it, e.g. `full+ttfb`, but always in the origin stream.
+    """
+    profile, *options = profile.split('+')
+    if profile == ORIGIN:
+        return [
+            field for field in schema['fields']
+            if field.get('origin') or field.get('profile') == ORIGIN
+        ]
+    if profile not in PROFILES:
+        raise LogFormatError('unknown profile {!r}'.format(profile))
+    level = PROFILES.index(profile)
+    return [
+        field for field in schema['fields']
+        if field.get('profile') != ORIGIN
+        and PROFILES.index(field.get('profile', 'full')) <= level
+        and field.get('option') in [None] + options
+    ]
+
+
+def field_placeholder(field):
+    """
+    Returns (JSON value text, placeholder text or None, Placeholder) for a
+    schema field.
+    """
+    max_length = field.get('max_length', DEFAULT_MAX_LENGTH)
+    if 'literal' in field:
+        return json.dumps(field['literal']), None, None
+    if 'time' in field:
+        text = '%{{{}:{}}}t'.format(field['time'], _TIME_FORMAT)
+        return '"{}"'.format(text), text, Placeholder(_TIME, 32)
+    if 'directive' in field:
+        try:
+            quoted, placeholder = DIRECTIVES[field['directive']]
+        except KeyError:
+            raise LogFormatError('{}: unknown directive {!r}'.format(
+                field['name'], field['directive']
+            ))
+        text = field['directive']
+        return '"{}"'.format(text) if quoted else text, text, placeholder
+    if 'template' in field:
+        text = '${{{}}}'.format(field['template'])
+        return text, text, Placeholder(_INTEGER, 20)
+    if 'request_header' in field or 'response_header' in field:
+        field = dict(field, vcl='{}.http.{}'.format(
+            'req' if 'request_header' in field else 'resp',
+            field.get('request_header') or field['response_header'],
+        ))
+    if 'vcl' not in field:
+        raise LogFormatError('{}: no value'.format(field['name']))
+    kind = field.get('type', 'string')
+    if kind == 'string':
+        text = '%{{json.escape({})}}V'.format(field['vcl'])
+        return '"{}"'.format(text), text, Placeholder(
+            _ESCAPED, max_length * _ESCAPE_RATIO
+        )
+    if kind == 'bool':
+        text = '%{{if({}, "true", "false")}}V'.format(field['vcl'])
+        return text, text, Placeholder(('true', 'false'), 5)
+    if kind in ('integer', 'number'):
+        samples = _INTEGER if kind == 'integer' else _NUMBER
+        if field.get('nullable'):
+            # e.g. a header the VCL sets on some requests only
+            text = '%{{if({0} ~ "{1}", {0}, "null")}}V'.format(
+                field['vcl'], _NUMERIC[kind]
+            )
+            samples += _NULL
+        else:
+            text = '%{{{}}}V'.format(field['vcl'])
+        return text, text, Placeholder(samples, 24)
+    raise LogFormatError('{}: unknown type {!r}'.format(field['name'], kind))
+
+
+def generate(schema, profile):
+    """
+    Returns the minified format for a profile, and the Placeholder of each
+    placeholder in it.
+    """
+    tree = OrderedDict()
+    known = {}
+    for field in profile_fields(schema, profile):
+        value, text, placeholder = field_placeholder(field)
+        if text is not None:
+            known[text] = placeholder
+        node = tree
+        *parents, key = field['name'].split('.')
+        for parent in parents:
+            node = node.setdefault(parent, OrderedDict())
+        if key in node:
+            raise LogFormatError('duplicate field {!r}'.format(field['name']))
+        node[key] = value
+    return _serialise(tree), known
+
+
+def _serialise(node):
+    return '{' + ','.join(
+        '{}:{}'.format(
+            json.dumps(key),
+            _serialise(value) if isinstance(value, dict) else value,
+        )
+        for key, value in node.items()
+    ) + '}'
+
+
+def substitutions(placeholder):
+    """
+    Sample values a placeholder can render as, benign first.
+    """
+    if placeholder.startswith('${'):
+        return Placeholder(_INTEGER, 20)
+    if placeholder.endswith('}t'):
+        return Placeholder(_TIME, 32)
+    if placeholder in DIRECTIVES:
+        return DIRECTIVES[placeholder][1]
+    if placeholder.endswith('}V'):
+        expression = placeholder[2:-2]
+        if expression.startswith('json.escape('):
+            return Placeholder(
+                _ESCAPED, DEFAULT_MAX_LENGTH * _ESCAPE_RATIO
+            )
+        match = _IF.match(expression)
+        if match:
+            values = match.group(2, 3)
+            return Placeholder(values, max(len(v) for v in values))
+    # headers, other variables and unknown directives are raw text
+    return Placeholder(_RAW, DEFAULT_MAX_LENGTH)
+
+
+def _no_duplicates(pairs):
+    keys = [key for key, _ in pairs]
+    duplicates = sorted({key for key in keys if keys.count(key) > 1})
+    if duplicates:
+        raise ValueError('duplicate keys {}'.format(', '.join(duplicates)))
+    return dict(pairs)
+
+
+def _parse(text):
+    json.loads(text, object_pairs_hook=_no_duplicates)
+
+
+def validate(log_format, known=None):
+    """
+    Renders `log_format` with each sample value of each placeholder and
+    returns a Report; `known` overrides the Placeholder of placeholders.
+    """
+    known = known or {}
+    parts = _PLACEHOLDER.split(log_format)
+    texts = parts[1::2]
+    placeholders = [known.get(t) or substitutions(t) for t in texts]
+    values = [p.samples[0] for p in placeholders]
+
+    def render(values):
+        rendered = list(parts)
+        rendered[1::2] = values
+        return ''.join(rendered)
+
+    # "0" is valid JSON both inside and outside a string, so it stands in
+    # for the other placeholders while one is varied
+    neutral = ['0'] * len(texts)
+    problems = []
+    try:
+        _parse(render(neutral))
+    except ValueError as e:
+        problems.append(('', render(neutral), str(e)))
+    else:
+        for i, placeholder in enumerate(placeholders):
+            for sample in placeholder.samples:
+                candidate = list(neutral)
+                candidate[i] = sample
+                try:
+                    _parse(render(candidate))
+                except ValueError as e:
+                    problems.append((texts[i], sample, str(e)))
+                    break
+    typical = render(values)
+    static_bytes = sum(len(p.encode('utf-8')) for p in parts[0::2])
+    largest = sorted(
+        zip(texts, (p.max_bytes for p in placeholders)),
+        key=lambda item: -item[1],
+    )
+    return Report(
+        problems,
+        len(typical.encode('utf-8')),
+        static_bytes + sum(p.max_bytes for p in placeholders),
+        largest[:3],
+    )
+
+
+def _output_path(profile, root=ROOT):
+    return os.path.join(root, OUTPUTS[profile])
+
+
+def build(schema=None, root=ROOT, write=True):
+    """
+    Generates and validates every profile and the origin stream. Returns
+    {profile: (Report, whether the file on disk was up to date)}, writing
+    the files if `write`.
+    """
+    schema = schema or load_schema()
+    results = OrderedDict()
+    for profile in OUTPUTS:
+        log_format, known = generate(schema, profile)
+        path = _output_path(profile, root)
+        current = None
+        if os.path.exists(path):
+            with open(path) as f:
+                current = f.read()
+        if write and current != log_format:
+            # no trailing newline - the file is the syslog format verbatim
+            with open(path, 'w') as f:
+                f.write(log_format)
+        results[profile] = (validate(log_format, known), current == log_format)
+    return results
+
+
+def _print_problems(name, report):
+    for placeholder, sample, error in report.problems:
+        if placeholder:
+            print('{}: {} rendered as {!r}: {}'.format(
+                name, placeholder, sample, error
+            ))
+        else:
+            print('{}: invalid JSON: {}'.format(name, error))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate and validate the Datadog syslog formats.'
+    )
+    parser.add_argument(
+        '--check', action='store_true',
+        help="don't write anything; fail if a format is out of date or "
+             'invalid',
+    )
+    parser.add_argument(
+        '--validate', nargs='+', metavar='PATH',
+        help='validate existing format files instead',
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+    schema = load_schema()
+    if args.validate:
+        # the schema's placeholders have known types, e.g. integer variables
+        _, known = generate(schema, 'full+ttfb')
+        for path in args.validate:
+            with open(path) as f:
+                report = validate(f.read(), known)
+            _print_problems(path, report)
+            failed = failed or bool(report.problems)
+            print('{}: {} bytes typical, {} bytes worst case'.format(
+                path, report.typical_bytes, report.worst_case_bytes
+            ))
+        return 1 if failed else 0
+
+    results = build(schema, write=not args.check)
+    print('{:<14} {:>8} {:>12} {:>12}  {}'.format(
+        'profile', 'fields', 'typical', 'worst case', 'largest values'
+    ))
+    for profile, (report, up_to_date) in results.items():
+        print('{:<14} {:>8} {:>12} {:>12}  {}'.format(
+            profile, len(profile_fields(schema, profile)),
+            report.typical_bytes, report.worst_case_bytes,
+            ', '.join('{} ({})'.format(*item) for item in report.largest),
+        ))
+        _print_problems(OUTPUTS[profile], report)
+        failed = failed or bool(report.problems)
+        if args.check and not up_to_date:
+            print('{} is out of date - run python -m tools.log_format'.format(
+                OUTPUTS[profile]
+            ))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
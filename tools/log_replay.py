@@ -0,0 +1,222 @@
+"""
+Replays Datadog log lines (in a dd_log_format*.json shape) through the
+rendered custom.vcl to compare the cache efficiency of module settings:
+
+    python -m tools.log_replay logs/*.log \\
+        --scenario no-caching:caching=false \\
+        --scenario short-ttls:default_ttl=30,fallback_ttl=300
+
+Each scenario is a set of module variables. Every `server_datacenter` gets its
+own simulated cache, and the logged status, `Cache-Control` and byte count
+stand in for the origin's response. A line counts as `sample_rate` requests,
+so sampled cache hits weigh what they stand for. The replay cannot see
+response headers that the log doesn't record, such as `Set-Cookie` or
+`Surrogate-Control`.
+"""
+import argparse
+import json
+import sys
+from collections import Counter
+
+from tools import dd_logs
+from tools.vcl_engine import Engine, Program, Request, Response
+from tools.vcl_template import dictionaries, module_defaults, render
+
+_UNSET = ('', '-', '(null)')
+
+
+class Scenario(object):
+
+    def __init__(self, name, variables=None):
+        self.name = name
+        self.variables = dict(variables or {})
+        self.program = Program(render(self.variables))
+        self.dictionaries = dictionaries(self.variables)
+        self.default_ttl = float(self.variables.get(
+            'default_ttl', module_defaults()['default_ttl']
+        ))
+        self.engines = {}
+        self.response = None
+
+    def _origin(self, bereq):
+        return self.response
+
+    def replay(self, pop, now, request, response, weight=1):
+        engine = self.engines.get(pop)
+        if engine is None:
+            engine = self.engines[pop] = Engine(
+                self.program, self._origin, default_ttl=self.default_ttl,
+                tables=self.dictionaries,
+            )
+        self.response = response
+        result = engine.handle(request, now=now)
+        if weight > 1:
+            # the other requests the line stands for arrived at the same
+            # time, and each goes the way the second one does
+            before = Counter(engine.stats)
+            engine.handle(request, now=now)
+            for key, count in (engine.stats - before).items():
+                engine.stats[key] += count * (weight - 2)
+        return result
+
+    def stats(self):
+        total = Counter()
+        for engine in self.engines.values():
+            total.update(engine.stats)
+        return total
+
+
+def parse_scenario(text):
+    """
+    Parses `name:var=value,var=value` (or just `name`).
+    """
+    name, _, assignments = text.partition(':')
+    variables = {}
+    for assignment in filter(None, assignments.split(',')):
+        key, sep, value = assignment.partition('=')
+        if not sep:
+            raise ValueError('expected var=value, got {!r}'.format(assignment))
+        variables[key.strip()] = value.strip()
+    return Scenario(name, variables)
+
+
+def replay_event(record):
+    """
+    Turns a log record into (pop, timestamp, client request, origin response).
+    """
+    headers = {}
+    host = dd_logs.get(record, 'service')
+    if host not in _UNSET and host is not None:
+        headers['Host'] = host
+    request = Request(
+        dd_logs.get(record, 'http.method') or 'GET',
+        dd_logs.get(record, 'http.url') or '/',
+        headers,
+    )
+    response_headers = {}
+    cache_control = dd_logs.get(record, 'response_cache_control')
+    if cache_control not in _UNSET and cache_control is not None:
+        response_headers['Cache-Control'] = cache_control
+    response = Response(
+        dd_logs.as_int(dd_logs.get(record, 'http.status_code'), 200),
+        response_headers,
+        body_size=dd_logs.as_int(
+            dd_logs.get(record, 'network.bytes_written')
+        ),
+    )
+    pop = dd_logs.get(record, 'server_datacenter') or 'unknown'
+    return pop, dd_logs.timestamp(dd_logs.get(record, 'time_start')), \
+        request, response
+
+
+def replay(records, scenarios):
+    """
+    Feeds every record to every scenario, reading the records only once.
+    Returns the replayed duration in seconds.
+    """
+    start = now = None
+    for record in records:
+        pop, timestamp, request, response = replay_event(record)
+        weight = dd_logs.as_int(dd_logs.get(record, 'sample_rate'), 1)
+        if timestamp is not None:
+            now = timestamp
+            if start is None:
+                start = timestamp
+        elapsed = (now - start) if start is not None else 0.0
+        for scenario in scenarios:
+            scenario.replay(pop, elapsed, request, response, weight)
+    return (now - start) if start is not None else 0.0
+
+
+def report(scenarios, duration):
+    results = []
+    for scenario in scenarios:
+        stats = scenario.stats()
+        requests = stats['requests']
+        lookups = stats['hits'] + stats['misses']
+        results.append({
+            'scenario': scenario.name,
+            'variables': scenario.variables,
+            'requests': requests,
+            'hit_ratio': stats['hits'] / lookups if lookups else 0.0,
+            'origin_fetches': stats['origin_fetches'],
+            'origin_fetch_rate':
+                stats['origin_fetches'] / requests if requests else 0.0,
+            'origin_fetches_per_second':
+                stats['origin_fetches'] / duration if duration else None,
+            'bytes_from_cache': stats['bytes_from_cache'],
+            'bytes_from_origin': stats['bytes_from_origin'],
+            'pops': {
+                pop: {
+                    'requests': engine.stats['requests'],
+                    'origin_fetches': engine.stats['origin_fetches'],
+                    'hit_ratio': engine.hit_ratio(),
+                }
+                for pop, engine in sorted(scenario.engines.items())
+            },
+        })
+    return {'duration_seconds': duration, 'scenarios': results}
+
+
+def format_report(result):
+    lines = ['{:<16} {:>10} {:>9} {:>14} {:>10} {:>9} {:>14} {:>14}'.format(
+        'scenario', 'requests', 'hit ratio', 'origin fetches', 'fetch rate',
+        'origin/s', 'cache bytes', 'origin bytes',
+    )]
+    for s in result['scenarios']:
+        per_second = s['origin_fetches_per_second']
+        lines.append(
+            '{:<16} {:>10} {:>9.1%} {:>14} {:>10.1%} {:>9} {:>14} {:>14}'
+            .format(
+                s['scenario'], s['requests'], s['hit_ratio'],
+                s['origin_fetches'], s['origin_fetch_rate'],
+                '-' if per_second is None else '{:.2f}'.format(per_second),
+                s['bytes_from_cache'], s['bytes_from_origin'],
+            )
+        )
+    pops = sorted({
+        pop for s in result['scenarios'] for pop in s['pops']
+    })
+    lines += ['', 'origin fetches per POP:', '{:<10}'.format('pop') + ''.join(
+        ' {:>16}'.format(s['scenario']) for s in result['scenarios']
+    )]
+    for pop in pops:
+        lines.append('{:<10}'.format(pop) + ''.join(
+            ' {:>16}'.format(
+                s['pops'].get(pop, {}).get('origin_fetches', 0)
+            )
+            for s in result['scenarios']
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay Datadog log lines through custom.vcl and '
+                    'compare the cache efficiency of module settings.'
+    )
+    parser.add_argument(
+        'paths', nargs='*', help='log files to replay (default: stdin)'
+    )
+    parser.add_argument(
+        '--scenario', action='append', default=[],
+        help='name:var=value,... - module variables to compare (repeatable; '
+             'the current defaults are always included)',
+    )
+    parser.add_argument('--json', action='store_true', help='emit JSON')
+    args = parser.parse_args(argv)
+
+    scenarios = [Scenario('current')] + [
+        parse_scenario(text) for text in args.scenario
+    ]
+    duration = replay(dd_logs.records(args.paths), scenarios)
+    result = report(scenarios, duration)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(result))
+
+
+if __name__ == '__main__':
+    main()
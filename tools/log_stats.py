@@ -0,0 +1,512 @@
+"""
+Summarises Datadog log lines (in a dd_log_format*.json shape) without
+shipping them to Datadog - request counts, hit and error ratios, and latency,
+origin time to first byte and response size percentiles per group:
+
+    python -m tools.log_stats logs/*.log
+    python -m tools.log_stats logs/*.log --group-by prefix,pop \\
+        --where cache_state=MISS --where prefix=/api/ --prefix-depth 1
+    zcat logs/*.gz | python -m tools.log_stats - --json
+
+Files are split into chunks that are summarised in parallel, one process per
+core. Percentiles come from sketches with a fixed relative error and a fixed
+number of buckets, and groups beyond `--max-groups` are counted as
+`(other)`, so memory stays bounded however many lines there are. Each line
+counts as `sample_rate` requests.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait,
+)
+from itertools import chain
+
+from tools import dd_logs
+
+DIMENSIONS = OrderedDict((
+    ('host', 'service'),
+    ('prefix', 'http.url'),
+    ('pop', 'server_datacenter'),
+    ('status', 'http.status_code'),
+    ('cache_state', 'cache_state'),
+    ('method', 'http.method'),
+    ('backend', 'backend'),
+    ('rate_limit', 'rate_limit'),
+    ('rate_limit_class', 'rate_limit_class'),
+    ('origin_region', 'origin_region'),
+))
+
+DEFAULT_GROUP_BY = ('host', 'prefix', 'pop', 'status')
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# (name in the output, record field) of each value with percentiles
+MEASURES = (
+    ('latency', 'http.request_time_ms'),
+    ('origin_ttfb', 'http.origin_ttfb_ms'),
+    ('bytes', 'network.bytes_written'),
+)
+
+OTHER = '(other)'
+
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# lines per batch when reading stdin in parallel
+BATCH_SIZE = 50000
+
+
+class Sketch(object):
+    """
+    A quantile sketch with relative error guarantees (DDSketch): values are
+    counted in logarithmic buckets, so any quantile is within
+    `relative_accuracy` of the true value. Past `max_buckets` the lowest
+    buckets are merged, which only costs accuracy in the lowest quantiles.
+    """
+
+    __slots__ = (
+        'relative_accuracy', 'max_buckets', 'gamma', 'log_gamma', 'buckets',
+        'zeros', 'count', 'total', 'min', 'max',
+    )
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, weight=1):
+        self.count += weight
+        self.total += value * weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += weight
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        buckets = self.buckets
+        buckets[key] = buckets.get(key, 0) + weight
+        if len(buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        keys = sorted(self.buckets)
+        lowest = keys[len(keys) - self.max_buckets]
+        for key in keys[:len(keys) - self.max_buckets]:
+            self.buckets[lowest] += self.buckets.pop(key)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('sketches have different accuracies')
+        for key, weight in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + weight
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def quantile(self, q):
+        """
+        The value at quantile `q` (0 to 1), or None for an empty sketch.
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return max(self.min, 0.0)
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+def _field(path):
+    """
+    A faster `dd_logs.get` for one dotted path, for records (dicts).
+    """
+    keys = path.split('.')
+    if len(keys) == 1:
+        return lambda record: record.get(path)
+    parent, key = '.'.join(keys[:-1]), keys[-1]
+    get_parent = _field(parent)
+
+    def get(record):
+        value = get_parent(record)
+        return value.get(key) if isinstance(value, dict) else None
+    return get
+
+
+def _number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+_CACHE_STATE = _field('cache_state')
+_STATUS = _field('http.status_code')
+_SAMPLE_RATE = _field('sample_rate')
+_MEASURES = tuple(_field(field) for _, field in MEASURES)
+
+
+class Summary(object):
+    """
+    Requests, hits, misses and errors, and a Sketch of each of MEASURES, for
+    one group of log lines.
+    """
+
+    __slots__ = ('requests', 'hits', 'misses', 'errors', 'sketches')
+
+    def __init__(self, relative_accuracy=0.01):
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.sketches = OrderedDict(
+            (name, Sketch(relative_accuracy)) for name, _ in MEASURES
+        )
+
+    def add(self, record, weight=1):
+        self.requests += weight
+        state = _CACHE_STATE(record) or ''
+        # HITPASS is a pass, as in local.log_sampled_statement
+        if state == 'HIT' or state.startswith('HIT-'):
+            self.hits += weight
+        elif state.startswith('MISS'):
+            self.misses += weight
+        if dd_logs.as_int(_STATUS(record)) >= 500:
+            self.errors += weight
+        for sketch, get in zip(self.sketches.values(), _MEASURES):
+            value = _number(get(record))
+            if value is not None:
+                sketch.add(value, weight)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.hits += other.hits
+        self.misses += other.misses
+        self.errors += other.errors
+        for name, sketch in other.sketches.items():
+            self.sketches[name].merge(sketch)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+
+def path_prefix(url, depth=1):
+    """
+    The first `depth` directories of a URL's path, e.g. `/api/` for
+    `/api/v1/users?page=2`.
+    """
+    path = (url or '/').split('?', 1)[0].split('#', 1)[0]
+    directories = path.split('/', depth + 1)[1:-1]
+    return '/' + ''.join(d + '/' for d in directories[:depth])
+
+
+class Grouping(object):
+    """
+    How records are grouped and filtered: `group_by` and the keys of `where`
+    are DIMENSIONS.
+    """
+
+    def __init__(self, group_by=DEFAULT_GROUP_BY, where=None, prefix_depth=1,
+                 max_groups=10000, relative_accuracy=0.01):
+        for dimension in tuple(group_by) + tuple(where or ()):
+            if dimension not in DIMENSIONS:
+                raise ValueError('unknown dimension {!r}'.format(dimension))
+        self.group_by = tuple(group_by)
+        self.where = dict(where or {})
+        self.prefix_depth = prefix_depth
+        self.max_groups = max_groups
+        self.relative_accuracy = relative_accuracy
+
+    def _values(self, dimensions):
+        # returns a function giving a record's value in each dimension
+        getters = [
+            (_field(DIMENSIONS[d]), d == 'prefix') for d in dimensions
+        ]
+        depth = self.prefix_depth
+
+        def values(record):
+            result = []
+            for get, is_prefix in getters:
+                value = get(record)
+                if is_prefix:
+                    result.append(path_prefix(value, depth))
+                else:
+                    result.append('-' if value is None else str(value))
+            return tuple(result)
+        return values
+
+    def add(self, groups, key, summary):
+        """
+        Merges a summary into `groups`, counting new groups as OTHER once
+        there are max_groups.
+        """
+        if key not in groups and len(groups) >= self.max_groups:
+            key = (OTHER,) * len(self.group_by)
+        if key in groups:
+            groups[key].merge(summary)
+        else:
+            groups[key] = summary
+
+    def summarise(self, lines):
+        """
+        Returns {group key: Summary} for log lines.
+        """
+        key_values = self._values(self.group_by)
+        where_values = self._values(self.where)
+        wanted = tuple(self.where.values())
+        other = (OTHER,) * len(self.group_by)
+        groups = {}
+        for line in lines:
+            record = dd_logs.parse_line(line)
+            if record is None:
+                continue
+            if wanted and where_values(record) != wanted:
+                continue
+            key = key_values(record)
+            summary = groups.get(key)
+            if summary is None:
+                if len(groups) >= self.max_groups:
+                    key = other
+                    summary = groups.get(key)
+                if summary is None:
+                    summary = groups[key] = Summary(self.relative_accuracy)
+            rate = dd_logs.as_int(_SAMPLE_RATE(record), 1)
+            summary.add(record, rate if rate > 1 else 1)
+        return groups
+
+    def merge(self, groups, others):
+        for key, summary in others.items():
+            self.add(groups, key, summary)
+        return groups
+
+
+def chunks(paths, size=CHUNK_SIZE):
+    """
+    Splits files into (path, start, end) byte ranges of about `size`.
+    """
+    for path in paths:
+        length = os.path.getsize(path)
+        for start in range(0, max(length, 1), size):
+            yield path, start, min(start + size, length)
+
+
+def _chunk_lines(path, start, end):
+    # a line belongs to the chunk it starts in
+    with open(path, 'rb') as f:
+        position = start
+        if start:
+            f.seek(start - 1)
+            position += len(f.readline()) - 1
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8', 'replace')
+
+
+def _summarise_chunk(grouping, chunk):
+    return grouping.summarise(_chunk_lines(*chunk))
+
+
+def _batches(lines, size=BATCH_SIZE):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def summarise_paths(grouping, paths, jobs=None):
+    """
+    Summarises log files (`-` for stdin) in `jobs` processes, returning
+    {group key: Summary}.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    files = [path for path in paths if path != '-']
+    groups = {}
+    if jobs == 1:
+        for path in paths:
+            lines = dd_logs.read_lines([path])
+            grouping.merge(groups, grouping.summarise(lines))
+        return groups
+    # at least a few chunks per process, so they all have work
+    total = sum(os.path.getsize(path) for path in files)
+    size = max(min(CHUNK_SIZE, total // (jobs * 4)), 1024 * 1024)
+    tasks = ((_summarise_chunk, grouping, chunk)
+             for chunk in chunks(files, size))
+    if '-' in paths:
+        tasks = chain(tasks, (
+            (grouping.summarise, batch) for batch in _batches(sys.stdin)
+        ))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # at most two chunks or batches per process in flight, each merged
+        # as soon as it's done, to bound memory
+        pending = set()
+        for function, *args in tasks:
+            pending.add(pool.submit(function, *args))
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    grouping.merge(groups, future.result())
+        for future in as_completed(pending):
+            grouping.merge(groups, future.result())
+    return groups
+
+
+def report(grouping, groups, quantiles=QUANTILES, top=None):
+    """
+    The groups as dicts, busiest first.
+    """
+    rows = []
+    ordered = sorted(groups.items(), key=lambda item: -item[1].requests)
+    for key, summary in ordered[:top]:
+        row = OrderedDict(zip(grouping.group_by, key))
+        row['requests'] = summary.requests
+        row['hit_ratio'] = summary.hit_ratio()
+        row['error_ratio'] = summary.errors / summary.requests \
+            if summary.requests else None
+        for name, sketch in summary.sketches.items():
+            row[name] = OrderedDict(
+                ('p{:g}'.format(q * 100), sketch.quantile(q))
+                for q in quantiles
+            )
+            row[name]['mean'] = sketch.mean()
+        rows.append(row)
+    return rows
+
+
+def _cell(value, spec='{:.0f}'):
+    return '-' if value is None else spec.format(value)
+
+
+def format_report(grouping, rows, quantiles=QUANTILES):
+    labels = ['p{:g}'.format(q * 100) for q in quantiles]
+    widths = [
+        max([len(d)] + [len(row[d]) for row in rows])
+        for d in grouping.group_by
+    ]
+    header = ' '.join(
+        '{:<{}}'.format(d, w) for d, w in zip(grouping.group_by, widths)
+    )
+    header += ' {:>10} {:>6} {:>6}'.format('requests', 'hit', 'error')
+    for name, _ in MEASURES:
+        header += ''.join(
+            ' {:>11}'.format('{} {}'.format(name.split('_')[0], label))
+            for label in labels
+        )
+    lines = [header]
+    for row in rows:
+        line = ' '.join(
+            '{:<{}}'.format(row[d], w)
+            for d, w in zip(grouping.group_by, widths)
+        )
+        line += ' {:>10} {:>6} {:>6}'.format(
+            row['requests'], _cell(row['hit_ratio'], '{:.1%}'),
+            _cell(row['error_ratio'], '{:.1%}'),
+        )
+        for name, _ in MEASURES:
+            line += ''.join(
+                ' {:>11}'.format(_cell(row[name][label])) for label in labels
+            )
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _where(text):
+    dimension, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'expected dimension=value, got {!r}'.format(text)
+        )
+    return dimension.strip(), value.strip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Summarise Datadog log lines: hit ratio, errors and '
+                    'latency, origin and size percentiles per group.'
+    )
+    parser.add_argument(
+        'paths', nargs='*', default=['-'],
+        help='log files (default: stdin, also read for -)',
+    )
+    parser.add_argument(
+        '--group-by', default=','.join(DEFAULT_GROUP_BY),
+        help='comma separated dimensions, from {} (default: %(default)s)'
+        .format(', '.join(DIMENSIONS)),
+    )
+    parser.add_argument(
+        '--where', action='append', type=_where, default=[],
+        metavar='DIMENSION=VALUE', help='only count matching lines '
+        '(repeatable), e.g. cache_state=MISS or prefix=/api/',
+    )
+    parser.add_argument('--prefix-depth', type=int, default=1)
+    parser.add_argument(
+        '--quantiles', default=','.join('{:g}'.format(q) for q in QUANTILES),
+    )
+    parser.add_argument('--relative-accuracy', type=float, default=0.01)
+    parser.add_argument('--max-groups', type=int, default=10000)
+    parser.add_argument('--top', type=int, help='only show the busiest groups')
+    parser.add_argument(
+        '--jobs', type=int, help='processes to use (default: one per core)'
+    )
+    parser.add_argument('--json', action='store_true', help='emit JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        grouping = Grouping(
+            group_by=[d.strip() for d in args.group_by.split(',') if d],
+            where=dict(args.where), prefix_depth=args.prefix_depth,
+            max_groups=args.max_groups,
+            relative_accuracy=args.relative_accuracy,
+        )
+        quantiles = [float(q) for q in args.quantiles.split(',')]
+    except ValueError as e:
+        parser.error(str(e))
+    started = time.perf_counter()
+    groups = summarise_paths(grouping, args.paths, args.jobs)
+    seconds = time.perf_counter() - started
+    rows = report(grouping, groups, quantiles, args.top)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print(format_report(grouping, rows, quantiles))
+    print('{} requests in {} groups in {:.2f} s'.format(
+        sum(s.requests for s in groups.values()), len(groups), seconds,
+    ), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Purges the objects tagged with surrogate keys (the origin's
+`surrogate_key_name` header, copied into `Surrogate-Key`) from a Fastly
+service:
+
+    FASTLY_API_KEY=... python -m tools.purge --service-id SERVICE_ID \\
+        product-123 product-456
+    ... | python -m tools.purge --service-id ... --soft -
+
+Keys are sent in batches of up to Fastly's batch purge limit, with several
+batches in flight at once, each worker thread reusing one keep-alive
+connection. Rate limited (429), failed (5xx) and dropped requests are retried
+with exponential backoff, honouring `Retry-After`.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+API_ENDPOINT = 'https://api.fastly.com'
+
+# keys per batch purge request
+MAX_BATCH_SIZE = 256
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+PurgeResult = namedtuple(
+    'PurgeResult', 'keys batches requests retries failed seconds'
+)
+
+
+class PurgeError(Exception):
+    pass
+
+
+def batches(keys, size=MAX_BATCH_SIZE):
+    """
+    Splits keys into lists of at most `size`, dropping blanks and repeats.
+    """
+    if not 0 < size <= MAX_BATCH_SIZE:
+        raise PurgeError('batch size must be between 1 and {}'.format(
+            MAX_BATCH_SIZE
+        ))
+    seen = set()
+    batch = []
+    for key in keys:
+        key = key.strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        batch.append(key)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Purger(object):
+
+    def __init__(self, service_id, api_key, endpoint=API_ENDPOINT,
+                 soft=False, batch_size=MAX_BATCH_SIZE, concurrency=8,
+                 retries=4, backoff=0.5, timeout=10.0):
+        url = urlsplit(endpoint)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise PurgeError('invalid endpoint {!r}'.format(endpoint))
+        self._connection_class = (
+            http.client.HTTPSConnection if url.scheme == 'https'
+            else http.client.HTTPConnection
+        )
+        self._netloc = url.netloc
+        self.path = '{}/service/{}/purge'.format(
+            url.path.rstrip('/'), quote(service_id, safe='')
+        )
+        self.api_key = api_key
+        self.soft = soft
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._counts = {'requests': 0, 'retries': 0}
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connection_class(
+                self._netloc, timeout=self.timeout
+            )
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # full jitter, so retries from the workers don't line up
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def _request(self, body):
+        headers = {
+            'Fastly-Key': self.api_key,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        }
+        if self.soft:
+            headers['Fastly-Soft-Purge'] = '1'
+        connection = self._connection()
+        try:
+            connection.request('POST', self.path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.getheader('Retry-After'), \
+                response.read()
+        except (http.client.HTTPException, OSError):
+            # the pooled connection may have been closed by the server
+            connection.close()
+            raise
+
+    def purge_batch(self, keys):
+        """
+        Purges one batch of keys, retrying transient failures. Returns
+        {key: purge id}.
+        """
+        body = json.dumps({'surrogate_keys': keys})
+        attempt = 0
+        while True:
+            self._count('requests')
+            retry_after = None
+            try:
+                status, retry_after, content = self._request(body)
+            except (http.client.HTTPException, OSError) as e:
+                error = str(e) or e.__class__.__name__
+            else:
+                error = 'HTTP {}: {}'.format(
+                    status, content.decode('utf-8', 'replace')[:200]
+                )
+                if status == 200:
+                    try:
+                        return json.loads(content.decode('utf-8'))
+                    except ValueError:
+                        # e.g. a proxy's error page
+                        raise PurgeError(error)
+                if status not in _RETRY_STATUSES:
+                    raise PurgeError(error)
+            if attempt >= self.retries:
+                raise PurgeError(error)
+            time.sleep(self._delay(attempt, retry_after))
+            attempt += 1
+            self._count('retries')
+
+    def purge(self, keys):
+        """
+        Purges every key and returns a PurgeResult; `failed` maps each key
+        that couldn't be purged to the error.
+        """
+        self._counts = {'requests': 0, 'retries': 0}
+        started = time.perf_counter()
+        groups = list(batches(keys, self.batch_size))
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = [(batch, pool.submit(self.purge_batch, batch))
+                       for batch in groups]
+            for batch, future in futures:
+                try:
+                    future.result()
+                except PurgeError as e:
+                    failed.update((key, str(e)) for key in batch)
+        self.close()
+        return PurgeResult(
+            keys=sum(len(batch) for batch in groups),
+            batches=len(groups),
+            requests=self._counts['requests'],
+            retries=self._counts['retries'],
+            failed=failed,
+            seconds=time.perf_counter() - started,
+        )
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def _read_keys(values):
+    for value in values:
+        if value == '-':
+            for line in sys.stdin:
+                yield line
+        else:
+            yield value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Purge surrogate keys from a Fastly service.'
+    )
+    parser.add_argument(
+        'keys', nargs='+', metavar='KEY',
+        help='surrogate keys to purge (- reads one per line from stdin)',
+    )
+    parser.add_argument('--service-id', required=True)
+    parser.add_argument(
+        '--api-key', default=os.environ.get('FASTLY_API_KEY'),
+        help='Fastly API token (default: $FASTLY_API_KEY)',
+    )
+    parser.add_argument('--endpoint', default=API_ENDPOINT)
+    parser.add_argument(
+        '--soft', action='store_true',
+        help='mark objects stale instead of removing them, so they can '
+             'still be served stale',
+    )
+    parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=4)
+    args = parser.parse_args(argv)
+    if not args.api_key:
+        parser.error('--api-key or FASTLY_API_KEY is required')
+
+    try:
+        purger = Purger(
+            args.service_id, args.api_key, endpoint=args.endpoint,
+            soft=args.soft, batch_size=args.batch_size,
+            concurrency=args.concurrency, retries=args.retries,
+        )
+        result = purger.purge(_read_keys(args.keys))
+    except PurgeError as e:
+        parser.error(str(e))
+    print('{} keys in {} batches, {} requests ({} retries) in {:.2f} s: '
+          '{:,.0f} keys/s'.format(
+              result.keys, result.batches, result.requests, result.retries,
+              result.seconds,
+              result.keys / result.seconds if result.seconds else 0,
+          ))
+    for key, error in sorted(result.failed.items()):
+        print('failed: {}: {}'.format(key, error), file=sys.stderr)
+    return 1 if result.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Checks a redirect map for the `redirects` module variable before it is
+uploaded to the edge dictionary, and writes it as a tfvars file:
+
+    python -m tools.redirects redirects.csv --host www.example.com
+    python -m tools.redirects redirects.csv --flatten \\
+        --tfvars redirects.auto.tfvars.json
+
+The map is a JSON object, or lines of `source target` separated by a comma,
+tab or spaces (`#` after a space starts a comment). Sources are URL paths,
+matched exactly against `req.url.path`; targets are paths or URLs. A target
+that is itself a source (a path, or a URL on one of the `--host` names) makes
+a chain - two redirects for the client - or a loop. `--flatten` points chains
+straight at their final target; loops are always reported.
+"""
+import argparse
+import csv
+import json
+import re
+import sys
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlsplit
+
+# Fastly edge dictionary limits
+MAX_ITEMS = 1000
+MAX_KEY_LENGTH = 256
+MAX_VALUE_LENGTH = 8000
+
+Problem = namedtuple('Problem', 'kind source detail')
+
+_COMMENT = re.compile(r'(^|\s)#.*$')
+
+
+def load(path):
+    """
+    Reads a redirect map, returning (OrderedDict of source -> target,
+    problems with the file itself).
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            data = json.load(f, object_pairs_hook=OrderedDict)
+            if 'redirects' in data and isinstance(data['redirects'], dict):
+                data = data['redirects']
+            return data, []
+        return parse_lines(f)
+
+
+def parse_lines(lines):
+    redirects = OrderedDict()
+    problems = []
+    for number, line in enumerate(lines, 1):
+        line = _COMMENT.sub('', line).strip()
+        if not line:
+            continue
+        if ',' in line or '\t' in line:
+            fields = next(csv.reader([line], delimiter=',' if ',' in line
+                                     else '\t'))
+        else:
+            fields = line.split()
+        fields = [field.strip() for field in fields if field.strip()]
+        if len(fields) != 2:
+            problems.append(Problem(
+                'syntax', '', 'line {}: expected source and target'.format(
+                    number
+                )
+            ))
+            continue
+        source, target = fields
+        if source in redirects and redirects[source] != target:
+            problems.append(Problem(
+                'duplicate', source, 'line {}: also redirected to {}'.format(
+                    number, redirects[source]
+                )
+            ))
+            continue
+        redirects[source] = target
+    return redirects, problems
+
+
+def _local_path(target, hosts):
+    """
+    The path a target leads back to on this service, or None.
+    """
+    url = urlsplit(target)
+    if url.scheme or url.netloc:
+        if url.hostname not in hosts:
+            return None
+    return url.path or None
+
+
+def resolve(redirects, hosts=()):
+    """
+    Follows each source to its final target. Returns ({source: (final
+    target, hops)}, set of sources in or leading into a loop).
+    """
+    hosts = set(hosts)
+    final = {}
+    looping = set()
+    for start in redirects:
+        path = [start]
+        seen = {start}
+        source = start
+        while True:
+            if source in final or source in looping:
+                break
+            step = _local_path(redirects[source], hosts)
+            if step is None or step not in redirects:
+                final[source] = (redirects[source], 1)
+                break
+            if step in seen:
+                looping.update(path)
+                break
+            path.append(step)
+            seen.add(step)
+            source = step
+        # unwind, so every source on the path is answered once
+        for source in reversed(path[:-1]):
+            if source in looping:
+                continue
+            step = _local_path(redirects[source], hosts)
+            if step in looping:
+                looping.add(source)
+            else:
+                target, hops = final[step]
+                final[source] = (target, hops + 1)
+    return final, looping
+
+
+def check(redirects, hosts=(), max_items=MAX_ITEMS):
+    """
+    Returns the problems with a redirect map: sources that aren't plain
+    paths, entries too long for the dictionary, too many entries, chains and
+    loops.
+    """
+    problems = []
+    if len(redirects) > max_items:
+        problems.append(Problem(
+            'size', '', '{} entries, more than the {} an edge dictionary '
+            'holds'.format(len(redirects), max_items)
+        ))
+    for source, target in redirects.items():
+        if not source.startswith('/') or '?' in source or '#' in source:
+            problems.append(Problem(
+                'source', source, 'not a URL path - redirects match '
+                'req.url.path exactly'
+            ))
+        if len(source) > MAX_KEY_LENGTH:
+            problems.append(Problem(
+                'length', source, 'longer than {} characters'.format(
+                    MAX_KEY_LENGTH
+                )
+            ))
+        if not target or len(target) > MAX_VALUE_LENGTH:
+            problems.append(Problem('length', source, 'bad target length'))
+    final, looping = resolve(redirects, hosts)
+    for source in redirects:
+        if source in looping:
+            problems.append(Problem('loop', source, 'never gets anywhere'))
+        elif final[source][1] > 1:
+            problems.append(Problem('chain', source, '{} hops to {}'.format(
+                *reversed(final[source])
+            )))
+    return problems
+
+
+def flatten(redirects, hosts=()):
+    """
+    Points every chain straight at its final target; loops are left alone.
+    """
+    final, _ = resolve(redirects, hosts)
+    return OrderedDict(
+        (source, final[source][0] if source in final else target)
+        for source, target in redirects.items()
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check a redirect map for chains and loops before '
+                    'uploading it to the redirects edge dictionary.'
+    )
+    parser.add_argument('path', help='JSON object or source,target lines')
+    parser.add_argument(
+        '--host', action='append', default=[],
+        help='hostname the service answers for, so absolute targets on it '
+             'count towards chains (repeatable)',
+    )
+    parser.add_argument(
+        '--flatten', action='store_true',
+        help='point chains straight at their final target',
+    )
+    parser.add_argument(
+        '--tfvars', metavar='PATH',
+        help='write {"redirects": ...} here if there are no problems',
+    )
+    parser.add_argument('--max-items', type=int, default=MAX_ITEMS)
+    args = parser.parse_args(argv)
+
+    redirects, problems = load(args.path)
+    if args.flatten:
+        redirects = flatten(redirects, args.host)
+    problems += check(redirects, args.host, args.max_items)
+    for problem in problems:
+        print(': '.join(filter(None, problem)))
+    print('{} redirects, {} problems'.format(len(redirects), len(problems)))
+    if problems:
+        return 1
+    if args.tfvars:
+        with open(args.tfvars, 'w') as f:
+            json.dump({'redirects': redirects}, f, indent=2)
+            f.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
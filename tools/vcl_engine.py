@@ -0,0 +1,1196 @@
+"""
+Offline interpreter for the subset of Fastly VCL that this module emits.
+
+A rendered custom.vcl is compiled once into Python closures (`Program`), then
+an `Engine` runs synthetic requests through Fastly's state machine against a
+simulated cache and an origin callable:
+
+    from tools.vcl_template import dictionaries, render
+    from tools.vcl_engine import Engine, Program, Request, Response
+
+    engine = Engine(
+        Program(render()), lambda bereq: Response(200),
+        tables=dictionaries(),
+    )
+    engine.handle(Request('GET', '/'))   # MISS
+    engine.handle(Request('GET', '/'))   # HIT
+    engine.stats                         # counters for hit ratio, origin load
+
+`#FASTLY` macros are treated as comments, so anything main.tf configures
+outside the VCL (conditions, headers, response objects, request settings) is
+not simulated. Set `Fastly-FF` on a request to run it as a shield node would.
+"""
+import random
+import re
+from collections import Counter, deque
+from operator import attrgetter
+
+# statuses Fastly caches by default
+CACHEABLE_STATUSES = frozenset((200, 203, 300, 301, 302, 404, 410))
+
+_RTIME_UNITS = {
+    'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'y': 31536000,
+}
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*|//[^\n]*|/\*(?s:.*?)\*/)
+  | (?P<longstring>\{"(?s:.*?)"\})
+  | (?P<string>"[^"\n]*")
+  | (?P<rtime>\d+(?:\.\d+)?(?:ms|s|m|h|d|y)\b)
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_.\-:]*)
+  | (?P<op>==|!=|!~|<=|>=|&&|\|\||\+=|-=|\*=|[=~<>!(){};,+:/.%])
+''', re.VERBOSE)
+
+
+class VCLError(Exception):
+    pass
+
+
+def tokenize(source):
+    tokens = []
+    pos = 0
+    end = len(source)
+    while pos < end:
+        match = _TOKEN.match(source, pos)
+        if match is None:
+            line = source.count('\n', 0, pos) + 1
+            raise VCLError('unexpected character {!r} on line {}'.format(
+                source[pos], line
+            ))
+        kind = match.lastgroup
+        if kind != 'space':
+            tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    tokens.append(('eof', None))
+    return tokens
+
+
+def parse_rtime(text):
+    number, unit = re.match(r'([\d.]+)([a-z]+)$', text).groups()
+    return float(number) * _RTIME_UNITS[unit]
+
+
+class Message(object):
+    """
+    A request, backend response, cache object or client response.
+    """
+    __slots__ = (
+        'method', 'url', 'status', 'response', 'http', 'body_size', 'body',
+        'ttl', 'grace', 'stale_while_revalidate', 'stale_if_error',
+        'cacheable', 'hits', 'stored_at',
+    )
+
+    def __init__(self, method=None, url=None, status=None, response=None,
+                 http=None, body_size=0):
+        self.method = method
+        self.url = url
+        self.status = status
+        self.response = response
+        self.http = http if http is not None else {}
+        self.body_size = body_size
+        self.body = None
+        self.ttl = 0.0
+        self.grace = 0.0
+        self.stale_while_revalidate = 0.0
+        self.stale_if_error = 0.0
+        self.cacheable = False
+        self.hits = 0
+        self.stored_at = 0.0
+
+    def copy(self):
+        other = Message(
+            self.method, self.url, self.status, self.response,
+            dict(self.http), self.body_size,
+        )
+        other.body = self.body
+        other.ttl = self.ttl
+        other.grace = self.grace
+        other.stale_while_revalidate = self.stale_while_revalidate
+        other.stale_if_error = self.stale_if_error
+        other.cacheable = self.cacheable
+        return other
+
+
+def _headers(headers):
+    return {k.lower(): str(v) for k, v in (headers or {}).items()}
+
+
+class Request(object):
+    """
+    A client request. `client` holds `client.*` variables without the prefix,
+    e.g. `{'ip': '192.0.2.1', 'geo.continent_code': 'EU'}`.
+    """
+
+    def __init__(self, method='GET', url='/', headers=None, client=None):
+        self.method = method
+        self.url = url
+        self.headers = headers or {}
+        self.client = client or {}
+
+
+class Response(object):
+    """
+    What the origin callable returns for a backend request. `latency` is in
+    seconds.
+    """
+
+    def __init__(self, status=200, headers=None, body_size=0, latency=0.0):
+        self.status = status
+        self.headers = headers or {}
+        self.body_size = body_size
+        self.latency = latency
+
+
+class Result(object):
+
+    def __init__(self, status, headers, state, body_size, body, restarts,
+                 backend):
+        self.status = status
+        self.headers = headers
+        self.state = state
+        self.body_size = body_size
+        self.body = body
+        self.restarts = restarts
+        self.backend = backend
+
+    def __repr__(self):
+        return '<Result {} {}>'.format(self.status, self.state)
+
+
+# -- parsing ------------------------------------------------------------------
+
+class _Parser(object):
+
+    def __init__(self, source):
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, value):
+        if self.tokens[self.pos][1] == value \
+                and self.tokens[self.pos][0] in ('op', 'ident'):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        token = self.next()
+        if token[1] != value:
+            raise VCLError('expected {!r} but found {!r}'.format(
+                value, token[1]
+            ))
+        return token
+
+    def ident(self):
+        kind, value = self.next()
+        if kind != 'ident':
+            raise VCLError('expected a name but found {!r}'.format(value))
+        return value
+
+    def skip_braces(self):
+        self.expect('{')
+        depth = 1
+        while depth:
+            kind, value = self.next()
+            if kind == 'eof':
+                raise VCLError('unbalanced braces')
+            if kind == 'op' and value == '{':
+                depth += 1
+            elif kind == 'op' and value == '}':
+                depth -= 1
+
+    # top level
+
+    def program(self, program):
+        while self.peek()[0] != 'eof':
+            keyword = self.ident()
+            if keyword == 'sub':
+                name = self.ident()
+                program.subs.setdefault(name, []).extend(self.block())
+            elif keyword == 'backend':
+                program.backends.append(self.ident())
+                self.skip_braces()
+            elif keyword == 'director':
+                program.backends.append(self.ident())
+                while self.peek()[1] != '{':
+                    self.next()
+                self.skip_braces()
+            elif keyword == 'acl':
+                name = self.ident()
+                program.acls[name] = self.acl()
+            elif keyword == 'table':
+                name = self.ident()
+                if self.peek()[0] == 'ident':
+                    self.next()
+                program.tables[name] = self.table()
+            elif keyword in ('ratecounter', 'penaltybox'):
+                program.declarations[self.ident()] = keyword
+                self.skip_braces()
+            else:
+                raise VCLError('unsupported declaration {!r}'.format(keyword))
+
+    def acl(self):
+        entries = []
+        self.expect('{')
+        while not self.accept('}'):
+            negated = self.accept('!')
+            kind, address = self.next()
+            if kind != 'string':
+                raise VCLError('bad acl entry {!r}'.format(address))
+            prefix = None
+            if self.accept('/'):
+                prefix = int(self.next()[1])
+            self.expect(';')
+            entries.append((negated, address[1:-1], prefix))
+        return entries
+
+    def table(self):
+        items = {}
+        self.expect('{')
+        while not self.accept('}'):
+            key = self.next()[1][1:-1]
+            self.expect(':')
+            items[key] = self.primary()[1]
+            self.accept(',')
+        return items
+
+    # statements
+
+    def block(self):
+        self.expect('{')
+        statements = []
+        while not self.accept('}'):
+            statements.append(self.statement())
+        return statements
+
+    def statement(self):
+        keyword = self.ident()
+        if keyword == 'if':
+            return self.if_statement()
+        if keyword in ('set', 'add'):
+            name = self.ident()
+            op = self.next()[1]
+            if op not in ('=', '+=', '-=', '*='):
+                raise VCLError('bad assignment operator {!r}'.format(op))
+            value = self.expression()
+            self.expect(';')
+            return ('set', name, op, value)
+        if keyword in ('unset', 'remove'):
+            name = self.ident()
+            self.expect(';')
+            return ('unset', name)
+        if keyword == 'return':
+            action = None
+            if self.accept('('):
+                action = self.ident()
+                self.expect(')')
+            self.expect(';')
+            return ('return', action)
+        if keyword == 'restart':
+            self.expect(';')
+            return ('return', 'restart')
+        if keyword == 'error':
+            status = message = None
+            if self.peek()[1] != ';':
+                status = self.primary()
+                if self.peek()[1] != ';':
+                    message = self.expression()
+            self.expect(';')
+            return ('error', status, message)
+        if keyword == 'synthetic':
+            value = self.expression()
+            self.expect(';')
+            return ('synthetic', value)
+        if keyword == 'declare':
+            if self.ident() != 'local':
+                raise VCLError('only local declarations are supported')
+            name = self.ident()
+            kind = self.ident()
+            self.expect(';')
+            return ('declare', name, kind)
+        if keyword == 'log':
+            value = self.expression()
+            self.expect(';')
+            return ('log', value)
+        if keyword == 'call':
+            name = self.ident()
+            self.expect(';')
+            return ('call', name)
+        if keyword == 'esi':
+            self.expect(';')
+            return ('log', ('lit', ''))
+        raise VCLError('unsupported statement {!r}'.format(keyword))
+
+    def if_statement(self):
+        branches = []
+        otherwise = None
+        while True:
+            self.expect('(')
+            condition = self.expression()
+            self.expect(')')
+            branches.append((condition, self.block()))
+            if self.accept('elsif') or self.accept('elseif'):
+                continue
+            if self.accept('else'):
+                if self.accept('if'):
+                    continue
+                otherwise = self.block()
+            break
+        return ('if', branches, otherwise)
+
+    # expressions
+
+    def expression(self):
+        left = self.conjunction()
+        while self.accept('||'):
+            left = ('or', left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.accept('&&'):
+            left = ('and', left, self.negation())
+        return left
+
+    def negation(self):
+        if self.accept('!'):
+            return ('not', self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.concatenation()
+        kind, op = self.peek()
+        if kind == 'op' and op in ('~', '!~'):
+            self.next()
+            kind, pattern = self.next()
+            if kind == 'string':
+                return ('match', op == '!~', left, pattern[1:-1])
+            if kind == 'ident':
+                return ('acl', op == '!~', left, pattern)
+            raise VCLError('bad regular expression {!r}'.format(pattern))
+        if kind == 'op' and op in ('==', '!=', '<', '>', '<=', '>='):
+            self.next()
+            return ('compare', op, left, self.concatenation())
+        return left
+
+    def concatenation(self):
+        parts = [self.primary()]
+        while True:
+            kind, value = self.peek()
+            if kind == 'op' and value == '+':
+                self.next()
+            elif kind not in ('string', 'longstring', 'ident', 'number',
+                              'rtime') or value in ('elsif', 'elseif'):
+                break
+            parts.append(self.primary())
+        return parts[0] if len(parts) == 1 else ('concat', parts)
+
+    def primary(self):
+        kind, value = self.next()
+        if kind == 'string':
+            return ('lit', value[1:-1])
+        if kind == 'longstring':
+            return ('lit', value[2:-2])
+        if kind == 'number':
+            return ('lit', float(value) if '.' in value else int(value))
+        if kind == 'rtime':
+            return ('lit', parse_rtime(value))
+        if kind == 'op' and value == '(':
+            inner = self.expression()
+            self.expect(')')
+            return inner
+        if kind == 'ident':
+            if value in ('true', 'false'):
+                return ('lit', value == 'true')
+            if self.peek()[1] == '(' and self.peek()[0] == 'op':
+                self.next()
+                args = []
+                while not self.accept(')'):
+                    args.append(self.expression())
+                    self.accept(',')
+                return ('call', value, args)
+            return ('var', value)
+        raise VCLError('unexpected {!r}'.format(value))
+
+
+# -- values -------------------------------------------------------------------
+
+def to_string(value):
+    if value is None:
+        return ''
+    if value is True:
+        return '1'
+    if value is False:
+        return '0'
+    if isinstance(value, float):
+        return '{:.3f}'.format(value)
+    return str(value)
+
+
+def _to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _subfield(value, key):
+    if value is None:
+        return None
+    for part in re.split(r'[;,]\s*', value):
+        name, _, field = part.partition('=')
+        if name.strip() == key:
+            return field
+    return None
+
+
+_URL = re.compile(r'^([^?#]*)(?:\?([^#]*))?')
+
+
+def _url_path(url):
+    return _URL.match(url or '').group(1)
+
+
+def _url_qs(url):
+    return _URL.match(url or '').group(2) or ''
+
+
+def _url_ext(url):
+    basename = _url_path(url).rsplit('/', 1)[-1]
+    return basename.rsplit('.', 1)[1] if '.' in basename else ''
+
+
+def _querystring(url, keep):
+    path, sep, qs = to_string(url).partition('?')
+    if not sep:
+        return path
+    params = [p for p in qs.split('&') if p and keep(p)]
+    return path + '?' + '&'.join(params) if params else path
+
+
+def _querystring_sort(url):
+    path, sep, qs = to_string(url).partition('?')
+    if not sep:
+        return path
+    params = sorted(qs.split('&'), key=lambda p: p.partition('=')[0])
+    return path + '?' + '&'.join(params)
+
+
+def _regex(pattern):
+    # VCL regexes are PCRE; the subset used here is compatible with `re`
+    return re.compile(pattern)
+
+
+def _replacement(replacement):
+    return re.sub(r'\\(\d)', r'\\g<\1>', replacement)
+
+
+def _ip_matches(address, network, prefix):
+    import ipaddress
+    try:
+        ip = ipaddress.ip_address(address)
+        net = ipaddress.ip_network(
+            network if prefix is None else '{}/{}'.format(network, prefix),
+            strict=False,
+        )
+    except ValueError:
+        return False
+    return ip.version == net.version and ip in net
+
+
+_TIME_DELTA = re.compile(r'^\s*(\d+(?:\.\d+)?)([smhdy]?)\s*$')
+
+
+def _parse_time_delta(text):
+    # whole seconds; Fastly's units, with plain numbers as seconds
+    match = _TIME_DELTA.match(to_string(text))
+    if match is None:
+        return 0
+    number, unit = match.groups()
+    return int(float(number) * _RTIME_UNITS[unit or 's'])
+
+
+def _check_rate(ctx, entry, counter, delta, window, limit, box, ttl):
+    # counts `delta` requests for the entry, and puts it in the penalty box
+    # if its rate over the last `window` seconds is more than `limit` a second
+    engine = ctx.engine
+    entry = to_string(entry)
+    events = engine.ratecounters.setdefault((counter, entry), deque())
+    events.append((engine.now, _to_number(delta)))
+    while events[0][0] <= engine.now - _to_number(window):
+        events.popleft()
+    rate = sum(count for _, count in events) / _to_number(window)
+    if rate <= _to_number(limit):
+        return False
+    engine.penaltyboxes[(box, entry)] = engine.now + _to_number(ttl)
+    return True
+
+
+def _penaltybox_has(ctx, box, entry):
+    expires = ctx.engine.penaltyboxes.get((box, to_string(entry)))
+    return expires is not None and ctx.engine.now < expires
+
+
+# built-in functions - each takes the context followed by the evaluated
+# arguments; table, ratecounter and penaltybox arguments arrive as names
+FUNCTIONS = {
+    'regsub': lambda ctx, s, p, r: _regex(p).sub(
+        _replacement(r), to_string(s), count=1
+    ),
+    'regsuball': lambda ctx, s, p, r: _regex(p).sub(
+        _replacement(r), to_string(s)
+    ),
+    'if': lambda ctx, c, a, b: a if c else b,
+    'std.tolower': lambda ctx, s: to_string(s).lower(),
+    'std.toupper': lambda ctx, s: to_string(s).upper(),
+    'std.strlen': lambda ctx, s: len(to_string(s)),
+    'std.atoi': lambda ctx, s: int(_to_number(s)),
+    'std.itoa': lambda ctx, n: str(int(_to_number(n))),
+    'std.prefixof': lambda ctx, s, p: to_string(s).startswith(to_string(p)),
+    'std.suffixof': lambda ctx, s, p: to_string(s).endswith(to_string(p)),
+    'querystring.regfilter': lambda ctx, url, p: _querystring(
+        url, lambda param: not _regex(p).search(param.partition('=')[0])
+    ),
+    'querystring.regfilter_except': lambda ctx, url, p: _querystring(
+        url, lambda param: _regex(p).search(param.partition('=')[0])
+    ),
+    'querystring.sort': lambda ctx, url: _querystring_sort(url),
+    'parse_time_delta': lambda ctx, s: _parse_time_delta(s),
+    'randombool': lambda ctx, n, d: (
+        ctx.engine.random.random() * _to_number(d) < _to_number(n)
+    ),
+    'table.lookup': lambda ctx, table, key, default=None: (
+        ctx.engine.table(table).get(to_string(key), default)
+    ),
+    'table.contains': lambda ctx, table, key: (
+        to_string(key) in ctx.engine.table(table)
+    ),
+    'ratelimit.check_rate': _check_rate,
+    'ratelimit.penaltybox_has': _penaltybox_has,
+}
+
+# functions whose first argument names a declaration rather than a value
+_NAMED_FIRST_ARGUMENT = ('table.lookup', 'table.contains')
+
+
+class _Context(object):
+    __slots__ = (
+        'engine', 'req', 'bereq', 'beresp', 'obj', 'resp', 'client',
+        'restarts', 'backend', 'state', 'locals', 'elapsed', 'stale',
+    )
+
+    def __init__(self, engine, request):
+        self.engine = engine
+        self.req = Message(
+            request.method, request.url, http=_headers(request.headers)
+        )
+        # the edge sets Fastly-Client-IP unless the client sent one
+        if 'ip' in request.client and 'fastly-ff' not in self.req.http:
+            self.req.http.setdefault('fastly-client-ip', request.client['ip'])
+        self.bereq = None
+        self.beresp = None
+        self.obj = None
+        self.resp = None
+        self.client = request.client
+        self.restarts = 0
+        self.backend = engine.default_backend
+        self.state = None
+        self.locals = {}
+        self.elapsed = 0.0
+        # an expired object still within its stale windows
+        self.stale = None
+
+
+_SCOPES = ('req', 'bereq', 'beresp', 'obj', 'resp')
+
+_FIELDS = {
+    'request': 'method', 'method': 'method', 'url': 'url',
+    'status': 'status', 'response': 'response', 'ttl': 'ttl',
+    'grace': 'grace', 'cacheable': 'cacheable', 'hits': 'hits',
+    'stale_while_revalidate': 'stale_while_revalidate',
+    'stale_if_error': 'stale_if_error',
+}
+
+
+def _now(ctx):
+    return ctx.engine.now
+
+
+# variables that aren't a field or header of a message
+_SPECIAL_GETTERS = {
+    'req.restarts': attrgetter('restarts'),
+    'req.backend': attrgetter('backend'),
+    'req.backend.name': attrgetter('backend'),
+    'req.backend.is_origin': lambda ctx: True,
+    'bereq.backend': attrgetter('backend'),
+    'beresp.backend.name': attrgetter('backend'),
+    'req.url.path': lambda ctx: _url_path(ctx.req.url),
+    'req.url.qs': lambda ctx: _url_qs(ctx.req.url),
+    'req.url.ext': lambda ctx: _url_ext(ctx.req.url),
+    'req.is_ssl': lambda ctx: True,
+    'req.is_ipv6': lambda ctx: ':' in ctx.client.get('ip', ''),
+    'obj.age': lambda ctx: ctx.engine.now - ctx.obj.stored_at,
+    'fastly_info.state': attrgetter('state'),
+    'stale.exists': lambda ctx: ctx.stale is not None,
+    'now': _now,
+    'now.sec': lambda ctx: int(ctx.engine.now),
+    'time.elapsed': attrgetter('elapsed'),
+    'time.elapsed.msec': lambda ctx: int(ctx.elapsed * 1000),
+    'time.elapsed.usec': lambda ctx: int(ctx.elapsed * 1000000),
+}
+
+
+class Program(object):
+    """
+    A compiled VCL source. One program can back any number of engines.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.backends = []
+        self.acls = {}
+        self.tables = {}
+        self.declarations = {}
+        subs = {}
+        self.subs = subs
+        _Parser(source).program(self)
+        self.subs = {
+            name: self._block(statements)
+            for name, statements in subs.items()
+        }
+
+    # statements
+
+    def _block(self, statements):
+        compiled = [self._statement(s) for s in statements]
+        if len(compiled) == 1:
+            return compiled[0]
+
+        def block(ctx):
+            for statement in compiled:
+                action = statement(ctx)
+                if action is not None:
+                    return action
+        return block
+
+    def _statement(self, statement):
+        kind = statement[0]
+        if kind == 'if':
+            return self._if(statement[1], statement[2])
+        if kind == 'set':
+            return self._set(*statement[1:])
+        if kind == 'unset':
+            return self._unset(statement[1])
+        if kind == 'return':
+            action = statement[1] or 'default'
+            return lambda ctx: action
+        if kind == 'error':
+            return self._error(statement[1], statement[2])
+        if kind == 'synthetic':
+            value = self._expression(statement[1])
+
+            def synthetic(ctx):
+                ctx.obj.body = to_string(value(ctx))
+                ctx.obj.body_size = len(ctx.obj.body.encode('utf-8'))
+            return synthetic
+        if kind == 'declare':
+            name = statement[1]
+            initial = {
+                'STRING': None, 'BOOL': False, 'RTIME': 0.0,
+                'FLOAT': 0.0, 'INTEGER': 0,
+            }.get(statement[2])
+
+            def declare(ctx):
+                ctx.locals[name] = initial
+            return declare
+        if kind == 'log':
+            return lambda ctx: None
+        if kind == 'call':
+            name = statement[1]
+            return lambda ctx: self.subs[name](ctx)
+        raise VCLError('unsupported statement {!r}'.format(kind))
+
+    def _if(self, branches, otherwise):
+        compiled = [
+            (self._expression(condition), self._block(block))
+            for condition, block in branches
+        ]
+        otherwise = self._block(otherwise) if otherwise else None
+
+        def if_(ctx):
+            for condition, block in compiled:
+                if condition(ctx):
+                    return block(ctx)
+            if otherwise is not None:
+                return otherwise(ctx)
+        return if_
+
+    def _error(self, status, message):
+        status = self._expression(status) if status else (lambda ctx: 503)
+        message = self._expression(message) if message else None
+
+        def error(ctx):
+            obj = Message(status=int(_to_number(status(ctx))))
+            obj.response = to_string(message(ctx)) if message else None
+            ctx.obj = obj
+            return 'error'
+        return error
+
+    def _set(self, name, op, value):
+        value = self._expression(value)
+        setter = self._setter(name)
+        if op == '=':
+            return lambda ctx: setter(ctx, value(ctx))
+        getter = self._getter(name)
+        combine = {
+            '+=': lambda a, b: a + b,
+            '-=': lambda a, b: a - b,
+            '*=': lambda a, b: a * b,
+        }[op]
+
+        def update(ctx):
+            setter(ctx, combine(
+                _to_number(getter(ctx)), _to_number(value(ctx))
+            ))
+        return update
+
+    def _unset(self, name):
+        setter = self._setter(name)
+        return lambda ctx: setter(ctx, None)
+
+    # variables
+
+    def _split(self, name):
+        scope, _, rest = name.partition('.')
+        if scope in _SCOPES and rest.startswith('http.'):
+            header, _, subfield = rest[5:].partition(':')
+            return scope, 'http', header.lower(), subfield
+        if scope in _SCOPES and rest in _FIELDS:
+            return scope, 'field', _FIELDS[rest], None
+        return None, None, None, None
+
+    def _getter(self, name):
+        if name in _SPECIAL_GETTERS:
+            return _SPECIAL_GETTERS[name]
+        if name.startswith('var.'):
+            return lambda ctx: ctx.locals.get(name)
+        if name.startswith('client.'):
+            key = name[7:]
+            return lambda ctx: ctx.client.get(key)
+        if name.startswith('server.'):
+            key = name[7:]
+            return lambda ctx: ctx.engine.server.get(key)
+        # backends main.tf configures are named F_<name> in the VCL
+        if name in self.backends or name.startswith('F_'):
+            return lambda ctx: name
+        scope, kind, key, subfield = self._split(name)
+        if scope is None:
+            raise VCLError('unsupported variable {!r}'.format(name))
+        message = attrgetter(scope)
+        if kind == 'field':
+            field = attrgetter(key)
+            return lambda ctx: field(message(ctx))
+        if subfield:
+            return lambda ctx: _subfield(message(ctx).http.get(key), subfield)
+        return lambda ctx: message(ctx).http.get(key)
+
+    def _setter(self, name):
+        if name in ('req.backend', 'bereq.backend'):
+            def set_backend(ctx, value):
+                ctx.backend = value
+            return set_backend
+        if name.startswith('var.'):
+            def set_local(ctx, value):
+                ctx.locals[name] = value
+            return set_local
+        scope, kind, key, subfield = self._split(name)
+        if scope is None or subfield:
+            raise VCLError('cannot assign to {!r}'.format(name))
+        message = attrgetter(scope)
+        if kind == 'field':
+            if key in ('ttl', 'grace'):
+                def set_time(ctx, value):
+                    setattr(message(ctx), key, float(_to_number(value)))
+                return set_time
+            if key == 'status':
+                def set_status(ctx, value):
+                    message(ctx).status = int(_to_number(value))
+                return set_status
+
+            def set_field(ctx, value):
+                setattr(message(ctx), key, value)
+            return set_field
+
+        def set_header(ctx, value):
+            if value is None:
+                message(ctx).http.pop(key, None)
+            else:
+                message(ctx).http[key] = to_string(value)
+        return set_header
+
+    # expressions
+
+    def _expression(self, node):
+        kind = node[0]
+        if kind == 'lit':
+            value = node[1]
+            return lambda ctx: value
+        if kind == 'var':
+            return self._getter(node[1])
+        if kind == 'not':
+            inner = self._expression(node[1])
+            return lambda ctx: not inner(ctx)
+        if kind == 'and':
+            a, b = self._expression(node[1]), self._expression(node[2])
+            return lambda ctx: bool(a(ctx)) and bool(b(ctx))
+        if kind == 'or':
+            a, b = self._expression(node[1]), self._expression(node[2])
+            return lambda ctx: bool(a(ctx)) or bool(b(ctx))
+        if kind == 'match':
+            return self._match(*node[1:])
+        if kind == 'acl':
+            return self._acl(*node[1:])
+        if kind == 'compare':
+            return self._compare(*node[1:])
+        if kind == 'concat':
+            parts = [self._expression(part) for part in node[1]]
+            return lambda ctx: ''.join(to_string(p(ctx)) for p in parts)
+        if kind == 'call':
+            return self._call(node[1], node[2])
+        raise VCLError('unsupported expression {!r}'.format(kind))
+
+    def _match(self, negated, subject, pattern):
+        subject = self._expression(subject)
+        search = _regex(pattern).search
+        if negated:
+            return lambda ctx: search(to_string(subject(ctx))) is None
+        return lambda ctx: search(to_string(subject(ctx))) is not None
+
+    def _acl(self, negated, subject, name):
+        if name not in self.acls:
+            raise VCLError('unknown acl {!r}'.format(name))
+        subject = self._expression(subject)
+        entries = self.acls[name]
+
+        def matches(ctx):
+            address = to_string(subject(ctx))
+            for entry_negated, network, prefix in entries:
+                if _ip_matches(address, network, prefix):
+                    return not entry_negated
+            return False
+        if negated:
+            return lambda ctx: not matches(ctx)
+        return matches
+
+    def _compare(self, op, a, b):
+        a, b = self._expression(a), self._expression(b)
+        if op == '==':
+            return lambda ctx: a(ctx) == b(ctx)
+        if op == '!=':
+            return lambda ctx: a(ctx) != b(ctx)
+        compare = {
+            '<': lambda x, y: x < y, '>': lambda x, y: x > y,
+            '<=': lambda x, y: x <= y, '>=': lambda x, y: x >= y,
+        }[op]
+        return lambda ctx: compare(_to_number(a(ctx)), _to_number(b(ctx)))
+
+    def _call(self, name, args):
+        if name not in FUNCTIONS:
+            raise VCLError('unsupported function {!r}'.format(name))
+        function = FUNCTIONS[name]
+        compiled = []
+        for i, arg in enumerate(args):
+            if arg[0] == 'var' and (
+                (i == 0 and name in _NAMED_FIRST_ARGUMENT)
+                or arg[1] in self.declarations
+            ):
+                declared = arg[1]
+                compiled.append(lambda ctx, declared=declared: declared)
+            else:
+                compiled.append(self._expression(arg))
+        return lambda ctx: function(ctx, *[arg(ctx) for arg in compiled])
+
+
+# -- execution ----------------------------------------------------------------
+
+_RESTART = object()
+
+_TTL_DIRECTIVES = (
+    ('surrogate-control', re.compile(r'max-age=(\d+)')),
+    ('cache-control', re.compile(r's-maxage=(\d+)')),
+    ('cache-control', re.compile(r'max-age=(\d+)')),
+)
+
+
+# the conditional request header for each validator of a stored object
+_VALIDATORS = (
+    ('etag', 'if-none-match'),
+    ('last-modified', 'if-modified-since'),
+)
+
+
+def initial_ttl(headers, default_ttl):
+    """
+    The TTL Fastly derives from origin headers before vcl_fetch runs.
+    """
+    for header, pattern in _TTL_DIRECTIVES:
+        value = headers.get(header)
+        if value:
+            match = pattern.search(value)
+            if match:
+                return float(match.group(1))
+    return float(default_ttl)
+
+
+class Engine(object):
+    """
+    Runs requests through `program` against one simulated cache (i.e. one
+    POP). `origin` is called with the backend request (a `Message`, with
+    the chosen backend on `engine.last_backend`) and returns a `Response`,
+    or None / raises to simulate a failed fetch.
+
+    Expired objects are kept for their `stale_while_revalidate` window (served
+    as HIT-STALE, with the background fetch run straight away) and their
+    `stale_if_error` or grace window (for `stale.exists` / `deliver_stale`).
+    Fetches for an expired object with an ETag or Last-Modified are
+    conditional, and a 304 refreshes the object's headers and keeps its body.
+    """
+
+    def __init__(self, program, origin, default_ttl=60, tables=None,
+                 server=None, max_restarts=3, default_backend='F_default',
+                 seed=None):
+        self.program = program
+        self.origin = origin
+        self.default_ttl = default_ttl
+        self.tables = dict(program.tables)
+        self.tables.update(tables or {})
+        self.server = server or {}
+        self.max_restarts = max_restarts
+        self.default_backend = default_backend
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.cache = {}
+        # ratecounter entries' (time, count)s and penalty box expiry times
+        self.ratecounters = {}
+        self.penaltyboxes = {}
+        self.stats = Counter()
+        self.last_backend = None
+
+    def table(self, name):
+        try:
+            return self.tables[name]
+        except KeyError:
+            raise VCLError('unknown table {!r}'.format(name))
+
+    def handle(self, request, now=None):
+        if now is not None:
+            self.now = now
+        self.stats['requests'] += 1
+        ctx = _Context(self, request)
+        while True:
+            result = self._process(ctx)
+            if result is not _RESTART:
+                return result
+            ctx.restarts += 1
+            self.stats['restarts'] += 1
+            ctx.bereq = ctx.beresp = ctx.obj = ctx.resp = ctx.stale = None
+            ctx.state = None
+            if ctx.restarts > self.max_restarts:
+                ctx.obj = Message(status=503, response='Too many restarts')
+                if self._error(ctx) != 'deliver':
+                    ctx.resp = ctx.obj.copy()
+                return self._result(ctx)
+
+    def _call(self, name, ctx, default):
+        sub = self.program.subs.get(name)
+        action = sub(ctx) if sub is not None else None
+        return default if action in (None, 'default') else action
+
+    def _process(self, ctx):
+        action = self._call('vcl_recv', ctx, 'lookup')
+        if action == 'lookup':
+            action = self._lookup(ctx)
+        if action == 'pass':
+            action = self._pass(ctx)
+        if action == 'error':
+            action = self._error(ctx)
+        if action == 'restart':
+            return _RESTART
+        action = self._call('vcl_deliver', ctx, 'deliver')
+        if action == 'restart':
+            return _RESTART
+        return self._result(ctx)
+
+    def _lookup(self, ctx):
+        key = (ctx.req.http.get('host', ''), ctx.req.url)
+        obj = self.cache.get(key)
+        if obj is not None and self.now - obj.stored_at >= obj.ttl:
+            expired_for = self.now - obj.stored_at - obj.ttl
+            if obj.cacheable and expired_for < obj.stale_while_revalidate:
+                return self._deliver_while_revalidating(ctx, key, obj)
+            if obj.cacheable and expired_for < max(
+                obj.stale_if_error, obj.grace
+            ):
+                ctx.stale = obj
+            else:
+                del self.cache[key]
+            obj = None
+        if obj is None:
+            ctx.state = 'MISS'
+            self.stats['misses'] += 1
+            ctx.bereq = ctx.req.copy()
+            action = self._call('vcl_miss', ctx, 'fetch')
+            if action == 'fetch':
+                return self._fetch(ctx, key)
+            return action
+        if not obj.cacheable:
+            # hit-for-pass
+            ctx.state = 'HITPASS'
+            return 'pass'
+        obj.hits += 1
+        ctx.obj = obj
+        action = self._call('vcl_hit', ctx, 'deliver')
+        if action == 'deliver':
+            ctx.state = 'HIT'
+            self.stats['hits'] += 1
+            self.stats['bytes_from_cache'] += obj.body_size
+            ctx.resp = obj.copy()
+        return action
+
+    def _deliver_while_revalidating(self, ctx, key, obj):
+        ctx.state = 'HIT-STALE'
+        self.stats['hits'] += 1
+        self.stats['stale_hits'] += 1
+        self.stats['bytes_from_cache'] += obj.body_size
+        obj.hits += 1
+        ctx.resp = obj.copy()
+        # the background fetch completes before the next request
+        background = _Context(self, Request(ctx.req.method, ctx.req.url))
+        background.req = ctx.req.copy()
+        background.backend = ctx.backend
+        background.stale = obj
+        self.stats['background_fetches'] += 1
+        self._fetch(background, key)
+        return 'deliver'
+
+    def _deliver_stale(self, ctx):
+        if ctx.stale is None:
+            return False
+        ctx.state = 'STALE'
+        ctx.resp = ctx.stale.copy()
+        return True
+
+    def _pass(self, ctx):
+        if ctx.state != 'HITPASS':
+            ctx.state = 'PASS'
+        self.stats['passes'] += 1
+        ctx.bereq = ctx.req.copy()
+        action = self._call('vcl_pass', ctx, 'pass')
+        if action == 'pass':
+            return self._fetch(ctx, None)
+        return action
+
+    def _fetch(self, ctx, key):
+        # vcl_miss and vcl_pass may have changed the backend request
+        bereq = ctx.bereq or ctx.req.copy()
+        ctx.bereq = bereq
+        stale = ctx.stale if key is not None else None
+        if stale is not None:
+            for validator, condition in _VALIDATORS:
+                if validator in stale.http:
+                    bereq.http[condition] = stale.http[validator]
+        self.last_backend = ctx.backend
+        self.stats['origin_fetches'] += 1
+        try:
+            response = self.origin(bereq)
+        except Exception:
+            response = None
+        if response is None:
+            self.stats['origin_errors'] += 1
+            ctx.obj = Message(status=503, response='backend read error')
+            return 'error'
+        ctx.elapsed += response.latency
+        if response.status == 304 and stale is not None:
+            self.stats['revalidations'] += 1
+            self.stats['bytes_from_cache'] += stale.body_size
+            http = dict(stale.http)
+            http.update(_headers(response.headers))
+            beresp = Message(
+                status=stale.status, http=http, body_size=stale.body_size
+            )
+        else:
+            http = _headers(response.headers)
+            beresp = Message(
+                status=response.status, http=http,
+                body_size=response.body_size,
+            )
+            self.stats['bytes_from_origin'] += response.body_size
+        beresp.ttl = initial_ttl(http, self.default_ttl)
+        beresp.cacheable = beresp.status in CACHEABLE_STATUSES
+        ctx.beresp = beresp
+        action = self._call('vcl_fetch', ctx, 'deliver')
+        if action == 'deliver_stale':
+            if self._deliver_stale(ctx):
+                return 'deliver'
+            action = 'deliver'
+        if action == 'deliver':
+            # expired objects are kept to be served stale or revalidated
+            if key is not None and beresp.cacheable and beresp.ttl + max(
+                beresp.stale_while_revalidate, beresp.stale_if_error,
+                beresp.grace,
+            ) > 0:
+                self._store(key, beresp)
+        elif action == 'pass':
+            if key is not None:
+                self._store(key, beresp, cacheable=False)
+            action = 'deliver'
+        if action == 'deliver':
+            ctx.resp = beresp.copy()
+        return action
+
+    def _store(self, key, beresp, cacheable=True):
+        obj = beresp.copy()
+        obj.cacheable = cacheable
+        obj.stored_at = self.now
+        obj.hits = 0
+        self.cache[key] = obj
+        self.stats['stored'] += 1
+
+    def _error(self, ctx):
+        if ctx.obj is None or ctx.obj.status is None:
+            ctx.obj = Message(status=503)
+        ctx.state = 'ERROR'
+        self.stats['errors'] += 1
+        action = self._call('vcl_error', ctx, 'deliver')
+        if action == 'deliver_stale':
+            if self._deliver_stale(ctx):
+                return 'deliver'
+            action = 'deliver'
+        if action == 'deliver':
+            ctx.resp = ctx.obj.copy()
+        return action
+
+    def _result(self, ctx):
+        resp = ctx.resp
+        if ctx.state == 'STALE':
+            self.stats['stale_if_error'] += 1
+            self.stats['bytes_from_cache'] += resp.body_size
+        self.stats['status_{}'.format(resp.status)] += 1
+        return Result(
+            resp.status, resp.http, ctx.state, resp.body_size, resp.body,
+            ctx.restarts, ctx.backend,
+        )
+
+    def hit_ratio(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
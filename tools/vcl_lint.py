@@ -0,0 +1,297 @@
+"""
+Static checks on the VCL that `data.template_file.custom_vcl` renders, so a
+combination of module variables can be checked in CI without a Terraform
+toolchain:
+
+    python -m tools.vcl_lint
+    python -m tools.vcl_lint --var caching=false \\
+        --var 'custom_vcl_recv=set req.http.X = "1";' --var-file ci.tfvars.json
+    python -m tools.vcl_lint --vcl rendered.vcl
+
+It reports unbalanced braces and parentheses, unterminated strings and
+comments, a missing or misplaced `#FASTLY` macro in any of Fastly's
+subroutines, statements after a `return`, `error` or `restart` that can
+never run, `synthetic` payloads (e.g. `proxy_error_response`) that break out
+of their `{"..."}` string, and VCL larger than Fastly allows.
+"""
+import argparse
+import json
+import re
+import sys
+from collections import namedtuple
+
+from tools.vcl_template import TemplateError, render
+
+# Fastly's default limit on the size of a VCL file
+MAX_SIZE = 1024 * 1024
+
+# subroutines that must contain their `#FASTLY <name>` macro, and ones that
+# must if they are defined
+MACROS = ('recv', 'fetch', 'hit', 'miss', 'deliver', 'error', 'pass', 'log')
+OPTIONAL_MACROS = ('hash',)
+
+Problem = namedtuple('Problem', 'line kind message')
+Token = namedtuple('Token', 'kind text line')
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<macro>\#FASTLY[ \t]+\w+)
+  | (?P<comment>\#[^\n]*|//[^\n]*|/\*(?s:.*?)\*/)
+  | (?P<longstring>\{"(?s:.*?)"\})
+  | (?P<string>"[^"\n]*")
+  | (?P<word>[A-Za-z0-9_.\-:%]+)
+  | (?P<unterminated>/\*|\{"|")
+  | (?P<op>.)
+''', re.VERBOSE)
+
+_PAIRS = {'{': '}', '(': ')'}
+_TERMINATORS = ('return', 'error', 'restart')
+
+
+def tokenize(vcl):
+    """
+    Returns (tokens other than whitespace and comments, problems).
+    """
+    tokens = []
+    problems = []
+    line = 1
+    pos = 0
+    while pos < len(vcl):
+        match = _TOKEN.match(vcl, pos)
+        kind, text = match.lastgroup, match.group()
+        if kind == 'unterminated':
+            problems.append(Problem(line, 'syntax', 'unterminated {}'.format(
+                {'"': 'string', '{"': 'long string', '/*': 'comment'}[text]
+            )))
+            if text != '"':
+                # the rest of the file is inside it
+                break
+            kind = 'op'
+        if kind not in ('space', 'comment'):
+            tokens.append(Token(kind, text, line))
+        line += text.count('\n')
+        pos = match.end()
+    return tokens, problems
+
+
+def check_brackets(tokens):
+    problems = []
+    stack = []
+    for token in tokens:
+        if token.kind != 'op':
+            continue
+        if token.text in _PAIRS:
+            stack.append(token)
+        elif token.text in _PAIRS.values():
+            if not stack:
+                problems.append(Problem(
+                    token.line, 'brackets',
+                    'unmatched {!r}'.format(token.text),
+                ))
+            elif _PAIRS[stack[-1].text] != token.text:
+                opening = stack.pop()
+                problems.append(Problem(
+                    token.line, 'brackets', '{!r} closes {!r} from line '
+                    '{}'.format(token.text, opening.text, opening.line),
+                ))
+            else:
+                stack.pop()
+    for opening in stack:
+        problems.append(Problem(
+            opening.line, 'brackets', 'unclosed {!r}'.format(opening.text)
+        ))
+    return problems
+
+
+def _subs(tokens):
+    """
+    Yields (name, line, tokens in the body) for each top level `sub`.
+    """
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.kind == 'word' and token.text == 'sub' \
+                and i + 2 < len(tokens) and tokens[i + 2].text == '{':
+            depth = 0
+            for j in range(i + 2, len(tokens)):
+                if tokens[j].kind == 'op' and tokens[j].text == '{':
+                    depth += 1
+                elif tokens[j].kind == 'op' and tokens[j].text == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+            yield tokens[i + 1].text, token.line, tokens[i + 3:j]
+            i = j
+        i += 1
+
+
+def check_macros(tokens):
+    problems = []
+    defined = set()
+    for name, line, body in _subs(tokens):
+        defined.add(name)
+        expected = name[4:] if name.startswith('vcl_') else None
+        for token in body:
+            if token.kind != 'macro':
+                continue
+            macro = token.text.split()[1]
+            if macro != expected:
+                problems.append(Problem(
+                    token.line, 'macro',
+                    '{} in sub {}'.format(token.text, name),
+                ))
+        if expected in MACROS + OPTIONAL_MACROS and not any(
+            token.kind == 'macro' and token.text.split()[1] == expected
+            for token in body
+        ):
+            problems.append(Problem(
+                line, 'macro', 'sub {} has no #FASTLY {}'.format(
+                    name, expected
+                ),
+            ))
+    for macro in MACROS:
+        if 'vcl_' + macro not in defined:
+            problems.append(Problem(
+                1, 'macro', 'no sub vcl_{} for #FASTLY {}'.format(
+                    macro, macro
+                ),
+            ))
+    return problems
+
+
+def check_unreachable(tokens):
+    """
+    Statements after a `return`, `error` or `restart` in the same block.
+    """
+    problems = []
+    # for each open block, the terminating statement's line, if any
+    blocks = [None]
+    at_start = True
+    for token in tokens:
+        if token.kind == 'macro':
+            continue
+        if token.kind == 'op' and token.text == '{':
+            blocks.append(None)
+            at_start = True
+            continue
+        if token.kind == 'op' and token.text == '}':
+            if len(blocks) > 1:
+                blocks.pop()
+            at_start = True
+            continue
+        if at_start and token.kind == 'word':
+            if blocks[-1] is not None:
+                problems.append(Problem(
+                    token.line, 'unreachable',
+                    '{} can never run - line {} ends the block'.format(
+                        token.text, blocks[-1]
+                    ),
+                ))
+                # one report per block
+                blocks[-1] = None
+            elif token.text in _TERMINATORS:
+                blocks[-1] = token.line
+        at_start = token.kind == 'op' and token.text == ';'
+    return problems
+
+
+def check_synthetic(tokens):
+    """
+    `synthetic` takes strings and variables up to the `;` - anything else
+    means the payload ended its string early.
+    """
+    problems = []
+    for i, token in enumerate(tokens):
+        if token.kind != 'word' or token.text != 'synthetic':
+            continue
+        for following in tokens[i + 1:]:
+            if following.kind == 'op' and following.text == ';':
+                break
+            if following.kind not in ('string', 'longstring', 'word'):
+                problems.append(Problem(
+                    following.line, 'synthetic', 'payload breaks out of its '
+                    'string at {!r} - it must not contain "}}'.format(
+                        following.text
+                    ),
+                ))
+                break
+    return problems
+
+
+def lint(vcl, max_size=MAX_SIZE):
+    """
+    Returns the problems with a VCL source, in line order.
+    """
+    tokens, problems = tokenize(vcl)
+    size = len(vcl.encode('utf-8'))
+    if size > max_size:
+        problems.append(Problem(1, 'size', '{} bytes, more than {}'.format(
+            size, max_size
+        )))
+    brackets = check_brackets(tokens)
+    problems += brackets + check_synthetic(tokens)
+    if not brackets:
+        # subroutines and blocks can't be told apart otherwise
+        problems += check_macros(tokens) + check_unreachable(tokens)
+    return sorted(problems, key=lambda problem: problem.line)
+
+
+def _assignment(text):
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'expected name=value, got {!r}'.format(text)
+        )
+    return name.strip(), value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render custom.vcl for a set of module variables and '
+                    'check it for mistakes Fastly would reject or that '
+                    'break requests.'
+    )
+    parser.add_argument(
+        '--var', action='append', type=_assignment, default=[],
+        metavar='NAME=VALUE',
+        help='module variable (repeatable; lists and maps as JSON)',
+    )
+    parser.add_argument(
+        '--var-file', action='append', default=[], metavar='PATH',
+        help='JSON tfvars file of module variables (repeatable)',
+    )
+    parser.add_argument(
+        '--vcl', metavar='PATH',
+        help='check this VCL file instead of rendering custom.vcl',
+    )
+    parser.add_argument('--max-size', type=int, default=MAX_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.vcl:
+        name = args.vcl
+        with open(args.vcl) as f:
+            vcl = f.read()
+    else:
+        name = 'custom.vcl'
+        variables = {}
+        for path in args.var_file:
+            with open(path) as f:
+                variables.update(json.load(f))
+        variables.update(args.var)
+        try:
+            vcl = render(variables)
+        except (TemplateError, KeyError, ValueError) as e:
+            parser.error('cannot render custom.vcl: {}'.format(e))
+    problems = lint(vcl, args.max_size)
+    for problem in problems:
+        print('{}:{}: {}: {}'.format(name, *problem))
+    print('{}: {} bytes ({:.1%} of {}), {} problems'.format(
+        name, len(vcl.encode('utf-8')),
+        len(vcl.encode('utf-8')) / args.max_size, args.max_size,
+        len(problems),
+    ))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,557 @@
+"""
+Renders custom.vcl the way `data.template_file.custom_vcl` in main.tf does,
+without a Terraform toolchain:
+
+    from tools.vcl_template import render
+    vcl = render({'caching': 'false', 'custom_vcl_recv': 'unset req.http.X;'})
+
+Module variables that aren't given take their defaults from variables.tf.
+`template_vars` mirrors the `vars` block of the data source, so keep the two
+in step when either changes; `interpolate` follows template_file's rules.
+`dictionaries` gives the contents of the edge dictionaries the VCL looks up,
+to pass to the engine as tables. `tools.vcl_lint` checks the rendered VCL.
+"""
+import json
+import os
+import re
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TEMPLATE_PATH = os.path.join(ROOT, 'custom.vcl')
+VARIABLES_PATH = os.path.join(ROOT, 'variables.tf')
+
+_VARIABLE = re.compile(r'^variable "(\w+)" \{$')
+_DEFAULT = re.compile(r'^\s*default\s*=\s*(.*)$')
+_HEREDOC = re.compile(r'^<<-?(\w+)$')
+# `$${` is a literal `${`; anything else in `${...}` is an interpolation
+_INTERPOLATION = re.compile(r'\$\$\{|\$\{([^}]*)\}')
+_NAME = re.compile(r'^\s*(\w+)\s*$')
+
+# local.accept_encoding_gzip and local.accept_encoding_brotli in main.tf
+_ACCEPT_ENCODING = '''if (req.http.Accept-Encoding) {
+    %s(req.http.Accept-Encoding ~ "gzip") {
+      set req.http.Accept-Encoding = "gzip";
+    } else {
+      unset req.http.Accept-Encoding;
+    }
+  }
+'''
+_ACCEPT_ENCODING_GZIP = _ACCEPT_ENCODING % 'if '
+_ACCEPT_ENCODING_BROTLI = _ACCEPT_ENCODING % (
+    'if (req.http.Accept-Encoding ~ "br") {\n'
+    '      set req.http.Accept-Encoding = "br";\n'
+    '    } elsif '
+)
+
+# local.redirect_querystring and local.redirect_responses in main.tf
+_REDIRECT_QUERYSTRING = (
+    'if (req.url.qs != "") {\n'
+    '      if (req.http.X-Redirect-Location ~ "\\?") {\n'
+    '        set req.http.X-Redirect-Location = '
+    'req.http.X-Redirect-Location "&" req.url.qs;\n'
+    '      } else {\n'
+    '        set req.http.X-Redirect-Location = '
+    'req.http.X-Redirect-Location "?" req.url.qs;\n'
+    '      }\n'
+    '    }\n'
+)
+_REDIRECT_RESPONSES = {
+    '301': 'Moved Permanently',
+    '302': 'Found',
+    '307': 'Temporary Redirect',
+    '308': 'Permanent Redirect',
+}
+
+# local.vcl_backend in main.tf
+_VCL_BACKEND = (
+    'backend {name} {{\n'
+    '  .host = "{address}";\n'
+    '  .port = "{port}";\n'
+    '  .ssl = true;\n'
+    '  .ssl_cert_hostname = "{hostname}";\n'
+    '  .ssl_sni_hostname = "{hostname}";\n'
+    '  .ssl_check_cert = {check_cert};\n'
+    '  .connect_timeout = {connect_timeout}ms;\n'
+    '  .first_byte_timeout = {first_byte_timeout}ms;\n'
+    '  .between_bytes_timeout = {between_bytes_timeout}ms;{probe}\n'
+    '}}\n'
+)
+
+# local.vcl_probe in main.tf
+_VCL_PROBE = (
+    '\n  .probe = {{\n'
+    '    .request = "HEAD {path} HTTP/1.1" "Host: {host}" '
+    '"Connection: close";\n'
+    '    .expected_response = 200;\n'
+    '    .interval = {interval}ms;\n'
+    '    .timeout = {timeout}ms;\n'
+    '    .window = 5;\n'
+    '    .threshold = 3;\n'
+    '    .initial = 2;\n'
+    '  }}'
+)
+
+# local.fallback_backend, local.fallback_backend_host and
+# local.fallback_restart in main.tf
+_FALLBACK_BACKEND = '''if (req.restarts > 0) {
+    set req.backend = fallback_backend;
+  }
+'''
+_FALLBACK_BACKEND_HOST = '''if (req.restarts > 0) {
+    set bereq.http.Host = "%s";
+  }
+'''
+_FALLBACK_RESTART = (
+    'if (req.restarts < %s && '
+    '(req.request == "GET" || req.request == "HEAD")) {\n'
+    '     restart;\n'
+    '   }\n'
+)
+
+# local.fetch_start, local.origin_ttfb and local.edge_ttfb in main.tf
+_FETCH_START = 'set req.http.X-Fetch-Start = time.elapsed.msec;\n'
+_ORIGIN_TTFB = (
+    'declare local var.origin_ttfb INTEGER;\n'
+    '\n'
+    '  set var.origin_ttfb = time.elapsed.msec;\n'
+    '  set var.origin_ttfb -= std.atoi(req.http.X-Fetch-Start);\n'
+    '  set req.http.X-Origin-TTFB = var.origin_ttfb;\n'
+)
+_EDGE_TTFB = 'set req.http.X-Edge-TTFB = time.elapsed.msec;\n'
+
+# local.server_timing and local.server_timing_strip in main.tf
+_SERVER_TIMING = (
+    'if (!req.http.Fastly-FF) {\n'
+    '    if (resp.http.Server-Timing) {\n'
+    '      set resp.http.Server-Timing = '
+    'resp.http.Server-Timing ", edge;dur=" req.http.X-Edge-TTFB;\n'
+    '    } else {\n'
+    '      set resp.http.Server-Timing = "edge;dur=" req.http.X-Edge-TTFB;\n'
+    '    }\n'
+    '    if (req.http.X-Origin-TTFB) {\n'
+    '      set resp.http.Server-Timing = '
+    'resp.http.Server-Timing ", origin;dur=" req.http.X-Origin-TTFB;\n'
+    '    }\n'
+    '    set resp.http.Server-Timing = '
+    'resp.http.Server-Timing ", cache;desc=" fastly_info.state;\n'
+    '  }\n'
+)
+_SERVER_TIMING_STRIP = (
+    'if (!req.http.Fastly-FF && '
+    'client.ip !~ server_timing_clients) {\n'
+    '    unset resp.http.Server-Timing;\n'
+    '  }\n'
+)
+
+# local.revalidate_no_cache in main.tf
+_REVALIDATE_NO_CACHE = (
+    'if (beresp.status < 500 && '
+    'beresp.http.Cache-Control ~ "no-cache" && '
+    'beresp.http.Cache-Control !~ "private|no-store" && '
+    '(beresp.http.ETag || beresp.http.Last-Modified)) {{\n'
+    '    set req.http.Fastly-Cachetype = "REVALIDATE";\n'
+    '    set beresp.ttl = 0s;\n'
+    '    set beresp.grace = {keep}s;\n'
+    '    set beresp.stale_while_revalidate = 0s;\n'
+    '    set beresp.stale_if_error = {stale_if_error}s;\n'
+    '    return(deliver);\n'
+    '  }}\n'
+)
+
+# local.rate_limit_declarations, local.rate_limit_recv,
+# local.rate_limit_check and local.rate_limit_response in main.tf, and
+# data.template_file.rate_limit_path in templates.tf
+_RATE_LIMIT_DECLARATIONS = '''ratecounter rate_limit_counter {}
+penaltybox rate_limit_penaltybox {}
+'''
+_RATE_LIMIT_RECV = (
+    'if (req.request == "GET" || req.request == "HEAD") {{\n'
+    '      set req.http.X-Rate-Limit-Class = "reads";\n'
+    '      set req.http.X-Rate-Limit-Max = "{reads}";\n'
+    '    }} else {{\n'
+    '      set req.http.X-Rate-Limit-Class = "writes";\n'
+    '      set req.http.X-Rate-Limit-Max = "{writes}";\n'
+    '    }}\n'
+    '    {paths}\n'
+    '    set req.http.X-Rate-Limit-Key = '
+    'req.http.X-Client-IP ":" req.http.X-Rate-Limit-Class;\n'
+    '    if (ratelimit.penaltybox_has('
+    'rate_limit_penaltybox, req.http.X-Rate-Limit-Key)) {{\n'
+    '      set req.http.X-Rate-Limit = "penalised";\n'
+    '      {block}\n'
+    '    }}\n'
+)
+_RATE_LIMIT_PATH = (
+    'if (std.prefixof(req.url.path, "{0}")) {{\n'
+    '      set req.http.X-Rate-Limit-Class = "{0}";\n'
+    '      set req.http.X-Rate-Limit-Max = "{1}";\n'
+    '    }}'
+)
+_RATE_LIMIT_CHECK = (
+    'if (req.http.X-Rate-Limit-Key && req.restarts == 0) {{\n'
+    '    if (ratelimit.check_rate(req.http.X-Rate-Limit-Key, '
+    'rate_limit_counter, 1, {window}, std.atoi(req.http.X-Rate-Limit-Max), '
+    'rate_limit_penaltybox, {penalty}s)) {{\n'
+    '      set req.http.X-Rate-Limit = "exceeded";\n'
+    '      {block}\n'
+    '    }}\n'
+    '  }}\n'
+)
+_RATE_LIMIT_RESPONSE = (
+    'if (obj.status == 829) {{\n'
+    '   set obj.status = 429;\n'
+    '   set obj.response = "Too Many Requests";\n'
+    '   set obj.http.Retry-After = "{penalty}";\n'
+    '   set obj.http.Cache-Control = "private, max-age={penalty}";\n'
+    '   set obj.http.Content-Type = "text/plain";\n'
+    '   synthetic {{"Too Many Requests"}};\n'
+    '   return(deliver);\n'
+    ' }}\n'
+)
+
+
+def _parse_value(raw, lines):
+    heredoc = _HEREDOC.match(raw)
+    if heredoc:
+        body = []
+        for line in lines:
+            if line.strip() == heredoc.group(1):
+                return '\n'.join(body) + '\n'
+            body.append(line)
+        raise ValueError('unterminated heredoc {}'.format(raw))
+    if raw.startswith('[') or raw.startswith('{'):
+        closing = ']' if raw.startswith('[') else '}'
+        value = raw
+        while not value.rstrip().endswith(closing):
+            value += '\n' + next(lines)
+        # HCL lists and maps of strings are JSON apart from `=` separators
+        # and trailing commas
+        value = re.sub(r',(\s*[\]}])', r'\1', value)
+        value = re.sub(r'("[^"]*")\s*=', r'\1:', value)
+        return json.loads(value)
+    if raw.startswith('"'):
+        return json.loads(raw)
+    return raw
+
+
+def module_defaults(path=VARIABLES_PATH):
+    """
+    Returns the default value of every module variable that has one, as
+    Terraform 0.11 would see it (numbers and bools as strings).
+    """
+    defaults = {}
+    with open(path) as f:
+        lines = iter(f.read().splitlines())
+    name = None
+    for line in lines:
+        match = _VARIABLE.match(line)
+        if match:
+            name = match.group(1)
+            continue
+        match = _DEFAULT.match(line)
+        if match and name is not None:
+            defaults[name] = _parse_value(match.group(1).strip(), lines)
+        elif line.startswith('}'):
+            name = None
+    return defaults
+
+
+def _is_true(value):
+    return str(value).lower() in ('true', '1')
+
+
+def _list(value):
+    # lists given on the command line arrive as `-var` style JSON strings
+    return json.loads(value) if isinstance(value, str) else list(value)
+
+
+def _map(value):
+    return json.loads(value) if isinstance(value, str) else dict(value)
+
+
+def _alternation(items, template='{}'):
+    # locals in main.tf - "(?!)" never matches
+    return template.format('|'.join(items)) if items else '(?!)'
+
+
+def _director(backends, director_type, quorum, chash_key, chash_seed):
+    # data.template_file.director and director_backend in templates.tf
+    if len(backends) < 2:
+        return ''
+    settings = ''
+    if director_type == 'random':
+        settings = '\n  .retries = {};'.format(len(backends))
+    elif director_type == 'chash':
+        settings = '\n  .key = {};\n  .seed = {};'.format(
+            chash_key, chash_seed
+        )
+    return (
+        'director origin_director {} {{\n'
+        '  .quorum = {}%;{}\n'
+        '{}\n'
+        '}}\n'
+    ).format(director_type, quorum, settings, '\n'.join(
+        '  {{ .backend = backend_{}; {} }}'.format(
+            i, '.id = "backend_{}";'.format(i) if director_type == 'chash'
+            else '.weight = {};'.format(backend.get('weight', 100))
+        )
+        for i, backend in enumerate(backends)
+    ))
+
+
+def _full_domain_name(v):
+    # local.full_domain_name in main.tf
+    if 'env' not in v or 'domain_name' not in v:
+        raise TemplateError(
+            "the backends' health checks need env and domain_name"
+        )
+    prefix = '' if v['env'] == 'live' else v['env'] + '-'
+    return prefix + v['domain_name']
+
+
+def _vcl_backend(v, name, address, port=443, hostname='', check_cert=None,
+                 probe=''):
+    # local.vcl_backend in main.tf
+    if check_cert is None:
+        check_cert = v['ssl_cert_check']
+    return _VCL_BACKEND.format(
+        name=name, address=address, port=port, hostname=hostname or address,
+        check_cert='always' if _is_true(check_cert) else 'never',
+        connect_timeout=v['connect_timeout'],
+        first_byte_timeout=v['first_byte_timeout'],
+        between_bytes_timeout=v['between_bytes_timeout'], probe=probe,
+    )
+
+
+def _vcl_backends(v):
+    # the data.template_file.*_backend data sources in templates.tf
+    backends = []
+    director_backends = _list(v['backends'])
+    if len(director_backends) < 2:
+        director_backends = []
+    for i, backend in enumerate(director_backends):
+        # data.template_file.backend
+        backends.append(_vcl_backend(
+            v, 'backend_{}'.format(i), backend['address'],
+            port=backend.get('port', 443),
+            hostname=backend.get('ssl_cert_hostname', v['ssl_cert_hostname']),
+            check_cert=backend.get('ssl_check_cert'),
+            probe=_VCL_PROBE.format(
+                path=backend.get('healthcheck_path', v['healthcheck_path']),
+                host=backend.get('healthcheck_host') or _full_domain_name(v),
+                interval=v['healthcheck_interval'],
+                timeout=v['healthcheck_timeout'],
+            ),
+        ))
+    for backend in _list(v['regional_backends']):
+        # data.template_file.regional_backend
+        backends.append(_vcl_backend(
+            v, 'regional_backend_{}'.format(backend['name']),
+            backend['address'], port=backend.get('port', 443),
+            hostname=backend.get('ssl_cert_hostname', ''),
+            check_cert=backend.get('ssl_check_cert'),
+        ))
+    if v['fallback_backend_address']:
+        # data.template_file.fallback_backend
+        backends.append(_vcl_backend(
+            v, 'fallback_backend', v['fallback_backend_address'],
+            hostname=v['fallback_backend_host'],
+        ))
+    return ''.join(backends)
+
+
+def _server_timing_acl(clients):
+    # data.template_file.server_timing_acl in templates.tf
+    if not clients:
+        return ''
+    entries = []
+    for client in clients:
+        address, slash, prefix = client.partition('/')
+        entries.append('  "{}"{}{};'.format(address, slash, prefix))
+    return 'acl server_timing_clients {{\n{}\n}}\n'.format(
+        '\n'.join(entries)
+    )
+
+
+def _rate_limit(v):
+    # the rate_limit_* entries of the vars block
+    mode = v['rate_limit']
+    block = 'error 829;' if mode == 'block' else ''
+    paths = _map(v['rate_limit_paths'])
+    return {
+        'rate_limit_declarations':
+            _RATE_LIMIT_DECLARATIONS if mode != 'off' else '',
+        'rate_limit_recv': _RATE_LIMIT_RECV.format(
+            reads=v['rate_limit_reads'], writes=v['rate_limit_writes'],
+            paths='\n    '.join(
+                _RATE_LIMIT_PATH.format(prefix, paths[prefix])
+                for prefix in sorted(paths)
+            ),
+            block=block,
+        ) if mode != 'off' else '',
+        'rate_limit_check': _RATE_LIMIT_CHECK.format(
+            window=v['rate_limit_window'], penalty=v['rate_limit_penalty'],
+            block=block,
+        ) if mode != 'off' else '',
+        'rate_limit_response': _RATE_LIMIT_RESPONSE.format(
+            penalty=v['rate_limit_penalty']
+        ) if mode == 'block' else '',
+    }
+
+
+def _origin_region(backends, source):
+    # data.template_file.origin_region in templates.tf
+    variable = 'client.geo.continent_code' if source == 'client' \
+        else 'server.region'
+    return ' else '.join(
+        'if ({} ~ "{}") {{\n'
+        '      set req.http.X-Origin-Region = "{}";\n'
+        '    }}'.format(variable, backend['region'], backend['name'])
+        for backend in backends
+    )
+
+
+def _regional_backend(backends):
+    # data.template_file.regional_backend_choice in templates.tf
+    return ' else '.join(
+        'if (req.http.X-Origin-Region == "{0}") {{\n'
+        '      set req.backend = regional_backend_{0};\n'
+        '    }}'.format(backend['name'])
+        for backend in backends
+    )
+
+
+def _querystring_filter(allowlist, strip):
+    # data.template_file.querystring_filter in templates.tf
+    if not allowlist and not strip:
+        return ''
+    return 'set req.url = querystring.{}(req.url, "^({})$");'.format(
+        'regfilter_except' if allowlist else 'regfilter',
+        '|'.join(allowlist or strip),
+    )
+
+
+def template_vars(variables=None):
+    """
+    The `vars` passed to custom.vcl for the given module variables.
+    """
+    v = module_defaults()
+    v.update(variables or {})
+    # local.measure_ttfb in main.tf
+    measure_ttfb = any(_is_true(v[name]) for name in (
+        'server_timing', 'log_ttfb', 'log_shield_origin'
+    ))
+    values = {
+        'proxy_error_response': v['proxy_error_response'],
+        'custom_vcl_backends': v['custom_vcl_backends'],
+        'vcl_backends': _vcl_backends(v),
+        'custom_vcl_recv': v['custom_vcl_recv'],
+        'custom_vcl_recv_no_shield': v['custom_vcl_recv_no_shield'],
+        'custom_vcl_recv_shield_only': v['custom_vcl_recv_shield_only'],
+        'custom_vcl_error': v['custom_vcl_error'],
+        'custom_vcl_deliver': v['custom_vcl_deliver'],
+        'vcl_recv_default_action':
+            'lookup' if _is_true(v['caching']) else 'pass',
+        'fallback_ttl': v['fallback_ttl'],
+        'shield_fallback_ttl': v['shield_fallback_ttl'] or v['fallback_ttl'],
+        'stale_while_revalidate': v['stale_while_revalidate'],
+        'stale_if_error': v['stale_if_error'],
+        'querystring_filter': _querystring_filter(
+            _list(v['querystring_allowlist']), _list(v['querystring_strip'])
+        ),
+        'querystring_sort': 'set req.url = querystring.sort(req.url);'
+        if _is_true(v['querystring_sort']) else '',
+        'static_extensions': _alternation(
+            _list(v['static_extensions']), '(?i)^({})$'
+        ),
+        'static_path_patterns': _alternation(
+            _list(v['static_path_patterns'])
+        ),
+        'preserve_cookies': _alternation(_list(v['preserve_cookies'])),
+        'director': _director(
+            _list(v['backends']), v['director_type'], v['director_quorum'],
+            v['director_chash_key'], v['director_chash_seed'],
+        ),
+        'director_backend': 'set req.backend = origin_director;'
+        if len(_list(v['backends'])) > 1 else '',
+        'accept_encoding': (
+            _ACCEPT_ENCODING_BROTLI if _is_true(v['prefer_brotli'])
+            else _ACCEPT_ENCODING_GZIP
+        ) if _is_true(v['normalise_accept_encoding']) else '',
+        'max_restarts': v['max_restarts'],
+        'fallback_backend':
+            _FALLBACK_BACKEND if v['fallback_backend_address'] else '',
+        'fallback_backend_host': _FALLBACK_BACKEND_HOST % (
+            v['fallback_backend_host']
+        ) if v['fallback_backend_address'] and v['fallback_backend_host']
+        else '',
+        'fallback_restart': _FALLBACK_RESTART % v['max_restarts']
+        if v['fallback_backend_address'] else '',
+        'redirect_status': v['redirect_status'],
+        'redirect_response': _REDIRECT_RESPONSES[str(v['redirect_status'])],
+        'redirect_querystring': _REDIRECT_QUERYSTRING
+        if _is_true(v['redirect_preserve_querystring']) else '',
+        'fetch_start': _FETCH_START if measure_ttfb else '',
+        'origin_ttfb': _ORIGIN_TTFB if measure_ttfb else '',
+        'edge_ttfb': _EDGE_TTFB if measure_ttfb else '',
+        'server_timing':
+            _SERVER_TIMING if _is_true(v['server_timing']) else '',
+        'server_timing_acl': _server_timing_acl(
+            _list(v['server_timing_clients'])
+        ),
+        'server_timing_strip': _SERVER_TIMING_STRIP
+        if _list(v['server_timing_clients']) else '',
+        'revalidate_no_cache': _REVALIDATE_NO_CACHE.format(
+            keep=v['revalidate_keep'], stale_if_error=v['stale_if_error']
+        ) if _is_true(v['revalidate_no_cache']) else '',
+        'origin_region': _origin_region(
+            _list(v['regional_backends']), v['region_source']
+        ),
+        'regional_backend': _regional_backend(_list(v['regional_backends'])),
+    }
+    values.update(_rate_limit(v))
+    return values
+
+
+def dictionaries(variables=None):
+    """
+    The edge dictionaries main.tf configures, as {name: {key: value}}.
+    """
+    v = module_defaults()
+    v.update(variables or {})
+    return {
+        'ttl_policy': _map(v['ttl_policy']),
+        'redirects': _map(v['redirects']),
+    }
+
+
+class TemplateError(Exception):
+    pass
+
+
+def interpolate(template, values):
+    """
+    Renders a template as Terraform 0.11's template_file does, for templates
+    that only interpolate variables: values are inserted verbatim, never
+    interpolated themselves, and `$${` renders as `${`.
+    """
+    def replace(match):
+        if match.group(1) is None:
+            return '${'
+        name = _NAME.match(match.group(1))
+        if name is None:
+            raise TemplateError('unsupported interpolation ${{{}}}'.format(
+                match.group(1)
+            ))
+        try:
+            return str(values[name.group(1)])
+        except KeyError:
+            raise TemplateError('unknown variable {!r}'.format(
+                name.group(1)
+            ))
+    return _INTERPOLATION.sub(replace, template)
+
+
+def render(variables=None, template_path=TEMPLATE_PATH):
+    with open(template_path) as f:
+        template = f.read()
+    return interpolate(template, template_vars(variables))
@@ -12,7 +12,8 @@ variable "bare_redirect_domain_name" {
 
 variable "backend_address" {
   type        = "string"
-  description = "Backend address to forward all requests to"
+  description = "Backend address to forward all requests to (required unless backends is set)"
+  default     = ""
 }
 
 variable "env" {
@@ -32,6 +33,120 @@ variable "caching" {
   default     = "true"
 }
 
+variable "default_ttl" {
+  type        = "string"
+  description = "TTL in seconds Fastly starts from when the backend response has no caching headers (default: 60)"
+  default     = 60
+}
+
+variable "fallback_ttl" {
+  type        = "string"
+  description = "TTL in seconds that vcl_fetch applies on edge nodes when the backend response has no Expires, Surrogate-Control or Cache-Control max-age, and the most a shield lets edges keep an object it got a Surrogate-Control max-age for (default: 3600)"
+  default     = 3600
+}
+
+variable "shield_fallback_ttl" {
+  type        = "string"
+  description = "TTL in seconds that vcl_fetch applies on shield nodes when the backend response has no Expires, Surrogate-Control or Cache-Control max-age (default: fallback_ttl)"
+  default     = ""
+}
+
+variable "gzip_extensions" {
+  type        = "list"
+  description = "File extensions Fastly compresses when the backend response isn't already compressed"
+  default     = ["css", "js", "mjs", "json", "map", "html", "htm", "txt", "xml", "svg", "ico", "ttf", "otf", "eot"]
+}
+
+variable "gzip_content_types" {
+  type        = "list"
+  description = "Content types Fastly compresses when the backend response isn't already compressed"
+  default     = ["text/html", "text/css", "text/plain", "text/xml", "text/javascript", "application/javascript", "application/x-javascript", "application/json", "application/ld+json", "application/manifest+json", "application/xml", "application/rss+xml", "application/atom+xml", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon", "font/ttf", "font/otf", "application/x-font-ttf", "application/vnd.ms-fontobject"]
+}
+
+variable "normalise_accept_encoding" {
+  type        = "string"
+  description = "Whether to reduce Accept-Encoding to the single encoding that will be used, so compressed variants don't fragment the cache"
+  default     = "true"
+}
+
+variable "prefer_brotli" {
+  type        = "string"
+  description = "Whether Accept-Encoding normalisation prefers br (which the backend must then serve) over gzip"
+  default     = "false"
+}
+
+variable "querystring_strip" {
+  type        = "list"
+  description = "Query string parameters (regular expressions matching the whole name) removed from the URL before the cache lookup, so they don't fragment the cache, e.g. utm_[a-z]+, gclid and fbclid (default: [])"
+  default     = []
+}
+
+variable "querystring_allowlist" {
+  type        = "list"
+  description = "If set, every query string parameter except these (regular expressions matching the whole name) is removed before the cache lookup, and querystring_strip is ignored (default: [])"
+  default     = []
+}
+
+variable "querystring_sort" {
+  type        = "string"
+  description = "Whether to sort query string parameters before the cache lookup, so reordered URLs share a cache object (default: false)"
+  default     = "false"
+}
+
+variable "static_extensions" {
+  type        = "list"
+  description = "File extensions (case-insensitive) of static assets, which are cached regardless of cookies: request cookies other than preserve_cookies are stripped, and Set-Cookie is removed from the response"
+  default     = []
+}
+
+variable "static_path_patterns" {
+  type        = "list"
+  description = "Regular expressions matched against the URL path of static assets, handled as for static_extensions (default: [])"
+  default     = []
+}
+
+variable "preserve_cookies" {
+  type        = "list"
+  description = "Names of request cookies kept on static asset requests (default: viewerror, which the error response conditions read)"
+  default     = ["viewerror"]
+}
+
+variable "ttl_policy" {
+  type        = "map"
+  description = "TTLs that override the backend's caching headers, by path prefix (the first one or two directories, e.g. /assets/ or /blog/archive/, or an exact path) or file extension (e.g. css) - values are a TTL or TTL,grace in seconds or with a unit, e.g. 1h,1d. Kept in the ttl_policy edge dictionary, so rules change without a new version of the VCL (default: {})"
+  default     = {}
+}
+
+variable "redirects" {
+  type        = "map"
+  description = "URL paths redirected at the edge, without contacting a backend, to the given URL or path - kept in the redirects edge dictionary, so python -m tools.redirects can check a large map for chains and loops and write it as a tfvars file (default: {})"
+  default     = {}
+}
+
+variable "redirect_status" {
+  type        = "string"
+  description = "Status of the redirects - 301, 302, 307 or 308 (default: 301)"
+  default     = "301"
+}
+
+variable "redirect_preserve_querystring" {
+  type        = "string"
+  description = "Whether redirects keep the request's query string, appending it to the target's (default: false)"
+  default     = "false"
+}
+
+variable "stale_while_revalidate" {
+  type        = "string"
+  description = "Seconds after an object expires during which Fastly serves it while fetching a fresh copy in the background (default: 0)"
+  default     = 0
+}
+
+variable "stale_if_error" {
+  type        = "string"
+  description = "Seconds after an object expires during which Fastly serves it instead of an origin error (default: 0)"
+  default     = 0
+}
+
 variable "force_ssl" {
   type        = "string"
   description = "Whether or not to force SSL (redirect requests to HTTP to HTTPS)"
@@ -142,6 +257,168 @@ variable "bypass_busy_wait" {
   default     = "false"
 }
 
+variable "backends" {
+  type        = "list"
+  description = "Origins to balance requests over, replacing backend_address - maps with an address and optionally weight, port, ssl_check_cert, ssl_cert_hostname, healthcheck_host and healthcheck_path; they are reached through the shield"
+  default     = []
+}
+
+variable "regional_backends" {
+  type        = "list"
+  description = "Origins for the edges in a region - maps with a name, a region (regex matched against region_source), an address and optionally port, ssl_check_cert and ssl_cert_hostname; the name must be a VCL identifier, the origins are reached through the shield, the first match wins, and edges in no region use the default backends"
+  default     = []
+}
+
+variable "region_source" {
+  type        = "string"
+  description = "What regional_backends' regions are matched against - pop (server.region, e.g. US-East) or client (client.geo.continent_code, e.g. NA)"
+  default     = "pop"
+}
+
+variable "director_type" {
+  type        = "string"
+  description = "How the director picks one of several backends - random (weighted), hash (on the cache key, so each object comes from one backend), chash (consistent hashing on director_chash_key, so adding or removing a backend only moves that backend's share) or client (on the client's identity)"
+  default     = "random"
+}
+
+variable "director_chash_key" {
+  type        = "string"
+  description = "What a chash director hashes - object (the cache key) or client (the client's identity)"
+  default     = "object"
+}
+
+variable "director_chash_seed" {
+  type        = "string"
+  description = "Seed for a chash director's hash ring - directors with the same seed and backends map keys to the same backend"
+  default     = "0"
+}
+
+variable "director_quorum" {
+  type        = "string"
+  description = "Percentage of backend weight that must be healthy for the director to be used"
+  default     = "50"
+}
+
+variable "fallback_backend_address" {
+  type        = "string"
+  description = "Origin that GET and HEAD requests are restarted against when the backend returns a 500 or 503 or can't be reached, e.g. a static mirror (default: none, so restarts go back to the same backend)"
+  default     = ""
+}
+
+variable "fallback_backend_host" {
+  type        = "string"
+  description = "Host header sent to fallback_backend_address, e.g. an S3 bucket hostname (default: none, so the same as for the backend)"
+  default     = ""
+}
+
+variable "max_restarts" {
+  type        = "string"
+  description = "How many times a failed GET or HEAD request is restarted - Fastly allows at most 3 (default: 1)"
+  default     = "1"
+}
+
+variable "healthcheck_path" {
+  type        = "string"
+  description = "Path the health checks request from each of the backends"
+  default     = "/"
+}
+
+variable "healthcheck_interval" {
+  type        = "string"
+  description = "Milliseconds between health checks"
+  default     = "15000"
+}
+
+variable "healthcheck_timeout" {
+  type        = "string"
+  description = "Milliseconds to wait for a health check response"
+  default     = "5000"
+}
+
+variable "revalidate_no_cache" {
+  type        = "string"
+  description = "Whether Cache-Control: no-cache responses with an ETag or Last-Modified are cached and revalidated with the origin on every request, rather than passed"
+  default     = "false"
+}
+
+variable "revalidate_keep" {
+  type        = "string"
+  description = "Seconds a revalidate_no_cache object is kept after it is stored, so later requests can revalidate it rather than fetch it again"
+  default     = 86400
+}
+
+variable "server_timing" {
+  type        = "string"
+  description = "Whether responses from the edge get a Server-Timing header with the time to first byte at the edge and from the backend, and the cache state"
+  default     = "false"
+}
+
+variable "server_timing_clients" {
+  type        = "list"
+  description = "Addresses or CIDR blocks (e.g. 192.0.2.0/24) of the clients that may see Server-Timing headers, the backend's included - if set, they are removed from responses to everyone else (default: none, so every client sees them)"
+  default     = []
+}
+
+variable "rate_limit" {
+  type        = "string"
+  description = "Origin protection - off, log (flag clients over their limit in the log) or block (also answer them with a 429 from the edge)"
+  default     = "off"
+}
+
+variable "rate_limit_reads" {
+  type        = "string"
+  description = "Requests per second a client may send to the origin (cache misses and passes) with GET and HEAD"
+  default     = "100"
+}
+
+variable "rate_limit_writes" {
+  type        = "string"
+  description = "Requests per second a client may send to the origin with other methods"
+  default     = "10"
+}
+
+variable "rate_limit_paths" {
+  type        = "map"
+  description = "Requests per second a client may send to the origin for URL paths starting with each prefix, whatever the method, e.g. { \"/login\" = \"2\" } - the longest matching prefix wins"
+  default     = {}
+}
+
+variable "rate_limit_window" {
+  type        = "string"
+  description = "Seconds the request rate is averaged over - 1, 10 or 60"
+  default     = "10"
+}
+
+variable "rate_limit_penalty" {
+  type        = "string"
+  description = "Seconds a client over its limit stays in the penalty box, from 60 to 3600 - Fastly rounds it down to whole minutes"
+  default     = "120"
+}
+
+variable "log_profile" {
+  type        = "string"
+  description = "Fields in each sampled cache hit Datadog log line - minimal, standard or full (see the dd_log_format*.json files); errors, misses and passes always have every field"
+  default     = "full"
+}
+
+variable "log_ttfb" {
+  type        = "string"
+  description = "Whether the VCL measures time to first byte at the edge and from the backend, and logs it in the standard and full Datadog log lines"
+  default     = "false"
+}
+
+variable "log_shield_origin" {
+  type        = "string"
+  description = "Whether shield nodes log each request they fetch from the origin (misses and passes) to a second, compact Datadog stream, for origin load"
+  default     = "false"
+}
+
+variable "log_hit_sample_rate" {
+  type        = "string"
+  description = "Log one in this many cache hits at the edge - errors, misses and passes are always logged, and each line's sample_rate field says how many requests it stands for (default: 1, i.e. every hit)"
+  default     = "1"
+}
+
 variable "shield" {
   type        = "string"
   description = "PoP to use as an origin shield (e.g. london-uk for Slough)."